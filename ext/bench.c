@@ -0,0 +1,379 @@
+#include "config.h"
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include "ccan/darray/darray.h"
+#include "ccan/strgrp/strgrp.h"
+
+/* Replay a corpus of descriptions, one per line on stdin, into strgrp
+ * instances at a range of sample sizes and thresholds. As for the samples in
+ * scraps/, a sample of size n is the last n lines of the corpus.
+ *
+ * By default one CSV row with a header is printed per threshold and size,
+ * holding the fastest of the runs along with its phase times and filter
+ * counts. With -s the output instead matches scraps/\*-strgrp-samples.csv: the
+ * sample size followed by the time of each run. -j sets the number of threads
+ * candidates are scored with, by default the OpenMP default, and -l selects
+ * candidates approximately with the given MinHash bands and rows.
+ *
+ * -m gives the similarity metrics to group with, by default nlcs alone. Each
+ * metric's grouping is compared pairwise with that of the exact LCS measure:
+ * pair_precision is the share of the metric's grouped pairs also grouped by
+ * the LCS, and pair_recall the share of the LCS's grouped pairs also grouped
+ * by the metric. */
+
+#define BUF_SIZE 512
+#define DEFAULT_STEP 500
+#define DEFAULT_RUNS 10
+#define DEFAULT_THRESHOLD 0.85
+
+typedef darray(char *) darray_str;
+typedef darray(double) darray_double;
+typedef darray(enum strgrp_metric) darray_metric;
+
+static const char *const metric_names[] = { "nlcs", "jaccard", "dice" };
+
+#define N_METRICS (sizeof(metric_names) / sizeof(metric_names[0]))
+
+// A description's group, or a pair of group labels when comparing groupings
+struct label {
+    unsigned long a;
+    unsigned long b;
+};
+
+static double
+now(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void
+usage(const char *const prog) {
+    fprintf(stderr,
+            "Usage: %s [-s] [-j THREADS] [-l BANDS,ROWS] [-m METRIC[,...]] "
+            "[-r RUNS] [-t THRESHOLD[,...]] "
+            "[-n SIZE[,...] | -i STEP] < CORPUS\n", prog);
+    exit(EXIT_FAILURE);
+}
+
+static void
+parse_list(const char *const arg, darray_double *const list) {
+    char *copy = strdup(arg), *tok, *end;
+    for (tok = strtok(copy, ","); tok; tok = strtok(NULL, ",")) {
+        const double v = strtod(tok, &end);
+        if (end == tok || *end) {
+            fprintf(stderr, "Invalid value: %s\n", tok);
+            exit(EXIT_FAILURE);
+        }
+        darray_push(*list, v);
+    }
+    free(copy);
+}
+
+static void
+parse_metrics(const char *const arg, darray_metric *const list) {
+    char *copy = strdup(arg), *tok;
+    size_t m;
+    for (tok = strtok(copy, ","); tok; tok = strtok(NULL, ",")) {
+        for (m = 0; m < N_METRICS && strcmp(tok, metric_names[m]); m++) {
+            continue;
+        }
+        if (m == N_METRICS) {
+            fprintf(stderr, "Invalid metric: %s\n", tok);
+            exit(EXIT_FAILURE);
+        }
+        darray_push(*list, (enum strgrp_metric)m);
+    }
+    free(copy);
+}
+
+static int
+label_a_cmp(const void *a, const void *b) {
+    const struct label *const la = a;
+    const struct label *const lb = b;
+    return (la->a > lb->a) - (la->a < lb->a);
+}
+
+static int
+label_cmp(const void *a, const void *b) {
+    const struct label *const la = a;
+    const struct label *const lb = b;
+    if (la->a != lb->a) {
+        return label_a_cmp(a, b);
+    }
+    return (la->b > lb->b) - (la->b < lb->b);
+}
+
+/* Count the pairs of the n labels sharing a, and with by_b set, sharing b as
+ * well. The labels are sorted in place. */
+static double
+count_pairs(struct label *const labels, const size_t n, const int by_b) {
+    double pairs = 0;
+    size_t i, run = 0;
+    qsort(labels, n, sizeof(*labels), label_cmp);
+    for (i = 0; i < n; i++) {
+        if (i && labels[i].a == labels[i - 1].a &&
+                (!by_b || labels[i].b == labels[i - 1].b)) {
+            run++;
+        } else {
+            run = 0;
+        }
+        pairs += run;
+    }
+    return pairs;
+}
+
+/* Find the pairwise precision and recall of the n group labels in found
+ * against those in expected */
+static void
+agreement(const unsigned long *const expected,
+        const unsigned long *const found, const size_t n,
+        double *const precision, double *const recall) {
+    struct label *const labels = malloc((n ? n : 1) * sizeof(*labels));
+    double both, n_found, n_expected;
+    size_t i;
+    if (!labels) {
+        fprintf(stderr, "Failed to allocate the labels\n");
+        exit(EXIT_FAILURE);
+    }
+    for (i = 0; i < n; i++) {
+        labels[i].a = expected[i];
+        labels[i].b = found[i];
+    }
+    both = count_pairs(labels, n, 1);
+    n_expected = count_pairs(labels, n, 0);
+    for (i = 0; i < n; i++) {
+        labels[i].a = found[i];
+        labels[i].b = 0;
+    }
+    n_found = count_pairs(labels, n, 0);
+    *precision = n_found ? both / n_found : 1.0;
+    *recall = n_expected ? both / n_expected : 1.0;
+    free(labels);
+}
+
+/* Group the last n strings, returning the elapsed time and the instance's
+ * statistics. The group of each string is numbered in creation order into
+ * labels. */
+static double
+run(char *const *const strs, const size_t n, const double threshold,
+        const int n_threads, const int *const lsh,
+        const enum strgrp_metric metric, struct strgrp_stats *const stats,
+        unsigned long *const n_grps, unsigned long *const labels) {
+    struct strgrp *ctx = lsh ?
+        strgrp_new_lsh(threshold, lsh[0], lsh[1]) : strgrp_new(threshold);
+    struct strgrp_iter *iter;
+    const struct strgrp_grp *grp;
+    const struct strgrp_grp **grps;
+    struct label *order;
+    void **data;
+    double start, elapsed;
+    size_t i;
+    if (!ctx || !strgrp_set_metric(ctx, metric)) {
+        fprintf(stderr, "Failed to create strgrp instance\n");
+        exit(EXIT_FAILURE);
+    }
+    strgrp_set_threads(ctx, n_threads);
+    // As for fpos.bench, which adds the descriptions with add_many()
+    data = calloc(n ? n : 1, sizeof(*data));
+    grps = malloc((n ? n : 1) * sizeof(*grps));
+    if (!data || !grps) {
+        fprintf(stderr, "Failed to allocate the batch\n");
+        exit(EXIT_FAILURE);
+    }
+    start = now();
+    if (!strgrp_add_many(ctx, (const char *const *)strs, data, n, grps)) {
+        for (i = 0; i < n; i++) {
+            if (!grps[i]) {
+                fprintf(stderr, "Failed to classify %s\n", strs[i]);
+            }
+        }
+    }
+    elapsed = now() - start;
+    free(data);
+    strgrp_stats(ctx, stats);
+    // Number the groups in iteration order, then label each string by a
+    // search of the sorted group pointers
+    *n_grps = 0;
+    iter = strgrp_iter_new(ctx);
+    while (strgrp_iter_next(iter)) {
+        (*n_grps)++;
+    }
+    strgrp_iter_free(iter);
+    order = malloc((*n_grps ? *n_grps : 1) * sizeof(*order));
+    if (!order) {
+        fprintf(stderr, "Failed to allocate the labels\n");
+        exit(EXIT_FAILURE);
+    }
+    iter = strgrp_iter_new(ctx);
+    for (i = 0; (grp = strgrp_iter_next(iter)); i++) {
+        order[i].a = (unsigned long)(uintptr_t)grp;
+        order[i].b = i;
+    }
+    strgrp_iter_free(iter);
+    qsort(order, *n_grps, sizeof(*order), label_cmp);
+    for (i = 0; i < n; i++) {
+        const struct label key = { (unsigned long)(uintptr_t)grps[i], 0 };
+        const struct label *const found = bsearch(&key, order, *n_grps,
+                sizeof(*order), label_a_cmp);
+        labels[i] = found ? found->b : 0;
+    }
+    free(order);
+    free(grps);
+    strgrp_free(ctx);
+    return elapsed;
+}
+
+int main(int argc, char **argv) {
+    darray_str strs = darray_new();
+    darray_double thresholds = darray_new();
+    darray_double sizes = darray_new();
+    darray_double lsh_args = darray_new();
+    darray_metric metrics = darray_new();
+    enum strgrp_metric *metric;
+    int lsh[2];
+    double *threshold, *size;
+    char buf[BUF_SIZE];
+    unsigned long step = DEFAULT_STEP;
+    int runs = DEFAULT_RUNS;
+    int n_threads = 0;
+    int samples = 0;
+    int opt;
+    while ((opt = getopt(argc, argv, "si:j:l:m:n:r:t:")) != -1) {
+        switch (opt) {
+            case 's':
+                samples = 1;
+                break;
+            case 'i':
+                step = strtoul(optarg, NULL, 10);
+                break;
+            case 'j':
+                n_threads = atoi(optarg);
+                break;
+            case 'l':
+                parse_list(optarg, &lsh_args);
+                break;
+            case 'm':
+                parse_metrics(optarg, &metrics);
+                break;
+            case 'n':
+                parse_list(optarg, &sizes);
+                break;
+            case 'r':
+                runs = atoi(optarg);
+                break;
+            case 't':
+                parse_list(optarg, &thresholds);
+                break;
+            default:
+                usage(argv[0]);
+        }
+    }
+    if (optind != argc || runs < 1 || !step || n_threads < 0) {
+        usage(argv[0]);
+    }
+    if (!darray_empty(lsh_args)) {
+        if (darray_size(lsh_args) != 2) {
+            usage(argv[0]);
+        }
+        lsh[0] = darray_item(lsh_args, 0);
+        lsh[1] = darray_item(lsh_args, 1);
+    }
+    while (fgets(buf, BUF_SIZE, stdin)) {
+        buf[strcspn(buf, "\r\n")] = '\0';
+        darray_push(strs, strdup(buf));
+    }
+    if (darray_empty(metrics)) {
+        darray_push(metrics, STRGRP_METRIC_NLCS);
+    }
+    if (darray_empty(thresholds)) {
+        darray_push(thresholds, DEFAULT_THRESHOLD);
+    }
+    if (darray_empty(sizes)) {
+        unsigned long n;
+        for (n = step; n <= darray_size(strs); n += step) {
+            darray_push(sizes, n);
+        }
+    }
+    if (!samples) {
+        printf("threshold,size,groups,metric,pair_precision,pair_recall,"
+                "seconds,lookups_per_s,select_s,score_s,candidates,"
+                "len_rejected,cos_rejected,lcs_scored\n");
+    }
+    darray_foreach(threshold, thresholds) {
+        darray_foreach(size, sizes) {
+            const size_t n = (*size < darray_size(strs)) ?
+                (size_t)*size : darray_size(strs);
+            char *const *const tail = &strs.item[darray_size(strs) - n];
+            unsigned long *const expected = malloc((n ? n : 1) * sizeof(long));
+            unsigned long *const found = malloc((n ? n : 1) * sizeof(long));
+            int have_expected = 0;
+            if (!expected || !found) {
+                fprintf(stderr, "Failed to allocate the labels\n");
+                exit(EXIT_FAILURE);
+            }
+            darray_foreach(metric, metrics) {
+                const int *const run_lsh = darray_empty(lsh_args) ? NULL : lsh;
+                struct strgrp_stats stats, best_stats;
+                unsigned long n_grps, best_grps = 0;
+                double best = -1, precision, recall;
+                int i;
+                if (samples) {
+                    printf("%zu, ", n);
+                }
+                for (i = 0; i < runs; i++) {
+                    const double elapsed = run(tail, n, *threshold, n_threads,
+                            run_lsh, *metric, &stats, &n_grps, found);
+                    if (samples) {
+                        printf("%.2f, ", elapsed);
+                    }
+                    if (best < 0 || elapsed < best) {
+                        best = elapsed;
+                        best_stats = stats;
+                        best_grps = n_grps;
+                    }
+                }
+                if (samples) {
+                    printf("\n");
+                    continue;
+                }
+                // The groupings of all runs are identical
+                if (*metric == STRGRP_METRIC_NLCS && !run_lsh) {
+                    memcpy(expected, found, n * sizeof(*found));
+                    have_expected = 1;
+                } else if (!have_expected) {
+                    run(tail, n, *threshold, n_threads, NULL,
+                            STRGRP_METRIC_NLCS, &stats, &n_grps, expected);
+                    have_expected = 1;
+                }
+                agreement(expected, found, n, &precision, &recall);
+                printf("%.2f,%zu,%lu,%s,%.4f,%.4f,%.6f,%.0f,%.6f,%.6f,"
+                        "%lu,%lu,%lu,%lu\n",
+                        *threshold, n, best_grps, metric_names[*metric],
+                        precision, recall, best,
+                        best > 0 ? best_stats.n_lookups / best : 0.0,
+                        best_stats.t_select, best_stats.t_score,
+                        best_stats.n_cands, best_stats.n_len_rejected,
+                        best_stats.n_cos_rejected, best_stats.n_lcs);
+            }
+            free(found);
+            free(expected);
+        }
+    }
+    darray_free(thresholds);
+    darray_free(sizes);
+    darray_free(lsh_args);
+    darray_free(metrics);
+    {
+        char **str;
+        darray_foreach(str, strs) {
+            free(*str);
+        }
+    }
+    darray_free(strs);
+    return 0;
+}
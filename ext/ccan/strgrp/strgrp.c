@@ -18,17 +18,22 @@
 #include <assert.h>
 #include <limits.h>
 #include <math.h>
+#include <stdatomic.h>
 #include <stdbool.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
+#include "ccan/block_pool/block_pool.h"
 #include "ccan/darray/darray.h"
 #include "ccan/stringmap/stringmap.h"
 #include "ccan/tal/tal.h"
-#include "ccan/tal/str/str.h"
 #include "strgrp.h"
 #include "config.h"
+#if HAVE_OPENMP
+#include <omp.h>
+#endif
 
 #define CHAR_N_VALUES (1 << CHAR_BIT)
 
@@ -44,13 +49,143 @@ struct grp_score {
 
 typedef darray(struct grp_score *) darray_score;
 
+typedef uint64_t lcs_word;
+
+#define LCS_WORD_BITS 64
+#define LCS_STACK_WORDS 8
+
+struct lcs_pattern {
+    size_t len;
+    size_t n_words;
+    size_t peq_alloc;
+    // CHAR_N_VALUES rows of n_words match vectors, indexed by character
+    lcs_word *peq;
+};
+
+#define QGRAM_Q 2
+#define QGRAM_BUCKET_BITS 12
+#define QGRAM_N_BUCKETS (1 << QGRAM_BUCKET_BITS)
+#define QGRAM_REJECT LONG_MAX
+
+// Postings carry the group's index and size (see grp_size()) so that counting
+// shared q-grams does not need to dereference the group itself
+struct qgram_posting {
+    uint32_t idx;
+    uint32_t len;
+    uint32_t count;
+};
+
+typedef darray(struct qgram_posting) darray_posting;
+
+struct qgram_count {
+    uint32_t bucket;
+    uint32_t count;
+    uint32_t n_postings;
+};
+
+typedef darray(struct qgram_count) darray_qcount;
+
+#define LSH_SHINGLE 3
+#define LSH_BUCKET_BITS 16
+#define LSH_N_BUCKETS (1 << LSH_BUCKET_BITS)
+#define LSH_MAX_HASHES 1024
+
+// The band signature is kept in full so that keys sharing a bucket but not
+// the band are told apart without dereferencing the group
+struct lsh_posting {
+    uint32_t sig;
+    uint32_t idx;
+};
+
+typedef darray(struct lsh_posting) darray_lsh;
+typedef darray(darray_grp) darray_len;
+typedef darray(long) darray_need;
+typedef darray(uint32_t) darray_idx;
+
+// Per-lookup state. Each instance holds one for the lookups made by adds, and
+// concurrent lookups each need their own so they can proceed in parallel
+// against the same groups. stats collects the counters of the lookup in
+// progress until they are folded into the instance's.
+struct strgrp_query {
+    int16_t pop[CHAR_N_VALUES];
+    // Sparse form of pop for the cosine filter: the characters present in the
+    // key, and the sum of squared counts
+    unsigned char pop_chars[CHAR_N_VALUES];
+    int n_pop_chars;
+    int32_t pop_sq;
+    struct lcs_pattern pattern;
+    // Candidate selection and scoring state. scores and shared are indexed by
+    // group and have n_alloc elements
+    size_t n_alloc;
+    struct grp_score *scores;
+    uint32_t *shared;
+    darray_qcount profile;
+    darray_idx touched;
+    darray_grp cands;
+    darray_need need;
+    // The smallest LCS length meeting the threshold, by group key length
+    darray_need need_lcs;
+    // MinHash signature of the key, for instances selecting by LSH
+    darray_idx minhash;
+    // Sorted features of the key, for measures other than STRGRP_METRIC_NLCS
+    darray_idx feat;
+    // The count of each bigram of the key, for STRGRP_METRIC_DICE. Allocated
+    // on first use, and only the entries of feat are non-zero.
+    uint16_t *bigrams;
+    // The normalised key, and the length of the longest stop phrase starting
+    // at each of its characters
+    darray_char norm;
+    darray_idx stop_len;
+    struct strgrp_stats stats;
+};
+
 struct strgrp {
     double threshold;
+    enum strgrp_metric metric;
+    // Backing store for groups, items and the keys interned in known, all of
+    // which live as long as the instance
+    struct block_pool *arena;
     stringmap_grp known;
+    // The number of groups. Removed groups leave a NULL in grps until it is
+    // compacted, so group indices stay in order of creation.
     unsigned int n_grps;
     darray_grp grps;
-    struct grp_score *scores;
-    int16_t pop[CHAR_N_VALUES];
+    unsigned long n_items;
+    // Cosine similarity below which should_grp_score_cos() must reject
+    double cos_cut;
+    // Candidate index: groups by hashed q-gram, and groups by key length (or
+    // by token count for STRGRP_METRIC_JACCARD, see grp_size())
+    darray_posting *qgrams;
+    darray_len by_len;
+    // If n_bands is set, candidates are instead selected by the groups'
+    // MinHash bands, and qgrams is unused
+    unsigned int n_bands;
+    unsigned int n_rows;
+    darray_lsh *lsh;
+    // Normalisation of keys, or NULL to use them as given
+    struct strgrp_norm *norm;
+    // Normalisation of keys holding bytes outside ASCII, see strgrp_set_fold()
+    strgrp_fold_fn *fold;
+    void *fold_arg;
+    struct strgrp_query *query;
+    // Threads to score candidates with, or 0 for the OpenMP default
+    int n_threads;
+    // Accumulated lookup counters. Lookups that may run concurrently only
+    // read the instance, so these are updated atomically through the pointer.
+    struct strgrp_counters *counters;
+};
+
+struct strgrp_counters {
+    atomic_ulong n_lookups;
+    atomic_ulong n_cache_hits;
+    atomic_ulong n_cache_misses;
+    atomic_ulong n_cands;
+    atomic_ulong n_len_rejected;
+    atomic_ulong n_cos_rejected;
+    atomic_ulong n_lcs;
+    _Atomic double t_lookup;
+    _Atomic double t_select;
+    _Atomic double t_score;
 };
 
 struct strgrp_iter {
@@ -58,12 +193,25 @@ struct strgrp_iter {
     int i;
 };
 
+// A non-zero character count of a group key
+struct pop_entry {
+    unsigned char c;
+    int16_t n;
+};
+
 struct strgrp_grp {
     const char *key;
     size_t key_len;
+    unsigned int idx;
     darray_item items;
     int32_t n_items;
-    int16_t pop[CHAR_N_VALUES];
+    // Sorted features of the key, for measures other than STRGRP_METRIC_NLCS
+    uint32_t n_feat;
+    const uint32_t *feat;
+    int32_t pop_sq;
+    // Sparse character counts of the key, in ascending character order
+    uint16_t n_pop;
+    struct pop_entry pop[];
 };
 
 struct strgrp_grp_iter {
@@ -76,6 +224,13 @@ struct strgrp_item {
     void *value;
 };
 
+// The layout of the stringmap_grp entries, as declared by stringmap()
+struct known_entry {
+    char *str;
+    size_t len;
+    struct strgrp_grp *value;
+};
+
 
 /* String vector cosine similarity[1]
  *
@@ -92,18 +247,45 @@ strpopcnt(const char *const str, int16_t pop[CHAR_N_VALUES]) {
     }
 }
 
+static inline int32_t
+strpopsq(const struct pop_entry *const pop, const size_t n_pop) {
+    int32_t sq = 0;
+    size_t i;
+    for (i = 0; i < n_pop; i++) {
+        sq += pop[i].n * pop[i].n;
+    }
+    return sq;
+}
+
+// Populate q->pop for str along with its sparse form. A group's squared norm
+// never changes after creation, so only the dot product remains to be
+// computed per group, over the sparse counts of the group key against the
+// dense counts of str.
+static void
+query_popcnt(struct strgrp_query *const q, const char *const str) {
+    int c;
+    strpopcnt(str, q->pop);
+    q->n_pop_chars = 0;
+    q->pop_sq = 0;
+    for (c = 0; c < CHAR_N_VALUES; c++) {
+        if (q->pop[c]) {
+            q->pop_chars[q->n_pop_chars++] = c;
+            q->pop_sq += q->pop[c] * q->pop[c];
+        }
+    }
+}
+
 static inline double
-strcossim(const int16_t ref[CHAR_N_VALUES], const int16_t key[CHAR_N_VALUES]) {
+strcossim(const struct strgrp_query *const q,
+        const struct strgrp_grp *const grp) {
     int32_t saibi = 0;
-    int32_t sai2 = 0;
-    int32_t sbi2 = 0;
-    size_t i;
-    for (i = 0; i < CHAR_N_VALUES; i++) {
-        saibi += ref[i] * key[i];
-        sai2 += ref[i] * ref[i];
-        sbi2 += key[i] * key[i];
+    const int32_t sai2 = q->pop_sq;
+    const int32_t sbi2 = grp->pop_sq;
+    int i;
+    for (i = 0; i < grp->n_pop; i++) {
+        saibi += q->pop[grp->pop[i].c] * grp->pop[i].n;
     }
-    return 1.0 - (2 * acos(saibi / sqrt(sai2 * sbi2)) / M_PI);
+    return saibi / sqrt(sai2 * sbi2);
 }
 
 /* Low-cost filter functions */
@@ -114,314 +296,2453 @@ cossim_correction(const double s)
     return -((s - 0.5) * (s - 0.5)) + 0.33;
 }
 
+// The corrected similarity s + cossim_correction(s) increases monotonically
+// over s in [0, 1], peaking at 1.08. Inverting it and the angular distance
+// conversion gives the cosine below which a group cannot meet the threshold.
+// The cut is backed off slightly so that values close to it are left to the
+// exact computation, keeping results identical to applying it directly.
+static double
+cossim_cut(const double threshold) {
+    if (threshold > 1.08) {
+        return 2.0;
+    }
+    const double s = 1.0 - sqrt(1.08 - threshold);
+    return cos((1.0 - s) * M_PI / 2) - 1e-9;
+}
+
 static inline bool
-should_grp_score_cos(const struct strgrp *const ctx,
-        struct strgrp_grp *const grp, const char *const str) {
-    const double s1 = strcossim(ctx->pop, grp->pop);
+should_grp_score_cos(const struct strgrp_query *const q,
+        const struct strgrp_grp *const grp, const double threshold,
+        const double cos_cut) {
+    const double c = strcossim(q, grp);
+    if (c < cos_cut) {
+        return false;
+    }
+    const double s1 = 1.0 - (2 * acos(c) / M_PI);
     const double s2 = s1 + cossim_correction(s1);
-    return ctx->threshold <= s2;
+    return threshold <= s2;
 }
 
 static inline bool
-should_grp_score_len(const struct strgrp *const ctx,
-        const struct strgrp_grp *const grp, const char *const str) {
-    const double lstr = (double) strlen(str);
+should_grp_score_len(const double threshold,
+        const struct strgrp_grp *const grp, const size_t len) {
+    const double lstr = (double) len;
     const double lkey = (double) grp->key_len;
     const double lmin = (lstr > lkey) ? lkey : lstr;
     const double s = sqrt((2 * lmin * lmin) / (1.0 * lstr * lstr + lkey * lkey));
-    return ctx->threshold <= s;
+    return threshold <= s;
 }
 
 /* Scoring - Longest Common Subsequence[2]
  *
  * [2] https://en.wikipedia.org/wiki/Longest_common_subsequence_problem
+ *
+ * The LCS length is computed with the bit-parallel algorithm of Allison and
+ * Dix[3] in the formulation given by Hyyrö[4]. The query string is treated as
+ * the pattern: its match vectors are built once per lookup, and each group key
+ * is then streamed through them as the text. Each word operation advances
+ * LCS_WORD_BITS cells of a DP column, so keys of up to 64 characters need a
+ * single word of state per text character. Longer queries use a multi-word
+ * path that propagates the carry of the addition between words.
+ *
+ * Most comparisons only need to establish that a group can't beat the best
+ * score seen so far, or the threshold. Each text character extends the LCS by
+ * at most one, so after k of n characters an LCS of length l bounds the final
+ * length by l + n - k. Scoring is abandoned once this bound falls below the
+ * length required to reach the floor. As the bound drops by at most one per
+ * character it only needs evaluating once the slack over the required length
+ * is exhausted.
+ *
+ * [3] L. Allison, T. I. Dix, "A bit-string longest-common-subsequence
+ *     algorithm", Information Processing Letters 23(5), 1986
+ * [4] H. Hyyrö, "Bit-parallel LCS-length computation revisited", AWOCA 2004
  */
-#define ROWS 2
-
-static inline int cmi(int i, int j) {
-    return ROWS * j + i;
-}
-
-static inline int16_t
-lcs(const char *const a, const char *const b) {
-    const int lb = strlen(b);
-    const int lbp1 = lb + 1;
-    int16_t *const lookup = calloc(ROWS * lbp1, sizeof(int16_t));
-    if (!lookup) {
-        return -1;
-    }
-    int ia, ib;
-    for (ia = (strlen(a) - 1); ia >= 0; ia--) {
-        const char iav = a[ia];
-        const int ial = (ia + 1) & 1; // ia last
-        for (ib = lb - 1; ib >= 0; ib--) {
-            const char ibv = b[ib];
-            const int iac = ia & 1; // ia current
-            const int ibl = ib + 1; // ib last
-            // don't need separate "ib current" as it's just ib
-            if (iav == ibv) {
-                lookup[cmi(iac, ib)] = 1 + lookup[cmi(ial, ibl)];
-            } else {
-                const int16_t valb = lookup[cmi(ial, ib)];
-                const int16_t vabl = lookup[cmi(iac, ibl)];
-                lookup[cmi(iac, ib)] = (valb > vabl) ? valb : vabl;
-            }
+
+static inline int
+popcount64(const lcs_word v) {
+#if HAVE_BUILTIN_POPCOUNTL
+    return __builtin_popcountll(v);
+#else
+    lcs_word x = v - ((v >> 1) & 0x5555555555555555ULL);
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL);
+    x = (x + (x >> 4)) & 0x0f0f0f0f0f0f0f0fULL;
+    return (int)((x * 0x0101010101010101ULL) >> 56);
+#endif
+}
+
+static bool
+lcs_pattern_set(struct lcs_pattern *const p, const char *const str,
+        const size_t len) {
+    const size_t n_words = (len + LCS_WORD_BITS - 1) / LCS_WORD_BITS;
+    const size_t n_peq = CHAR_N_VALUES * n_words;
+    size_t i;
+    if (n_peq > p->peq_alloc) {
+        lcs_word *const peq = realloc(p->peq, n_peq * sizeof(*peq));
+        if (!peq) {
+            return false;
         }
+        p->peq = peq;
+        p->peq_alloc = n_peq;
     }
-    int16_t result = lookup[0];
-    free(lookup);
-    return result;
+    p->len = len;
+    p->n_words = n_words;
+    memset(p->peq, 0, n_peq * sizeof(*p->peq));
+    for (i = 0; i < len; i++) {
+        lcs_word *const row = &p->peq[(unsigned char)str[i] * n_words];
+        row[i / LCS_WORD_BITS] |= ((lcs_word)1) << (i % LCS_WORD_BITS);
+    }
+    return true;
 }
 
-#undef ROWS
-
-static inline double
-nlcs(const char *const a, const char *const b) {
-    const double lcss = lcs(a, b);
-    const double la = (double) strlen(a);
-    const double lb = (double) strlen(b);
-    const double s = sqrt((2 * lcss * lcss) / (la * la + lb * lb));
-    return s;
+static inline long
+lcs_single(const struct lcs_pattern *const p, const char *const text,
+        const long len, const long need) {
+    lcs_word v = ~((lcs_word)0);
+    long next = len - need + 1;
+    long i;
+    for (i = 0; i < len; i++) {
+        const lcs_word u = v & p->peq[(unsigned char)text[i]];
+        v = (v + u) | (v - u);
+        if (i + 1 == next) {
+            const long bound = popcount64(~v) + len - next;
+            if (bound < need) {
+                return bound;
+            }
+            next += bound - need + 1;
+        }
+    }
+    // Bits above the pattern length never have a match, so remain set
+    return popcount64(~v);
 }
 
-static inline double
-grp_score(const struct strgrp_grp *const grp, const char *const str) {
-    return nlcs(grp->key, str);
+static inline long
+lcs_multi_length(const lcs_word *const v, const size_t n_words) {
+    long result = 0;
+    size_t w;
+    for (w = 0; w < n_words; w++) {
+        result += popcount64(~v[w]);
+    }
+    return result;
 }
 
-/* Structure management */
-
-static struct strgrp_item *
-new_item(tal_t *const tctx, const char *const str, void *const data) {
-    struct strgrp_item *i = talz(tctx, struct strgrp_item);
-    if (!i) {
-        return NULL;
+static inline long
+lcs_multi(const struct lcs_pattern *const p, const char *const text,
+        const long len, const long need) {
+    const size_t n_words = p->n_words;
+    lcs_word stack[LCS_STACK_WORDS];
+    lcs_word *v = stack;
+    long next = len - need + 1;
+    long i;
+    size_t w;
+    long result;
+    if (n_words > LCS_STACK_WORDS) {
+        v = malloc(n_words * sizeof(*v));
+        if (!v) {
+            return -1;
+        }
     }
-    i->key = tal_strdup(i, str);
-    i->value = data;
-    return i;
+    for (w = 0; w < n_words; w++) {
+        v[w] = ~((lcs_word)0);
+    }
+    for (i = 0; i < len; i++) {
+        const lcs_word *const row = &p->peq[(unsigned char)text[i] * n_words];
+        lcs_word carry = 0;
+        for (w = 0; w < n_words; w++) {
+            const lcs_word vw = v[w];
+            const lcs_word u = vw & row[w];
+            const lcs_word t = vw + u;
+            const lcs_word sum = t + carry;
+            carry = (t < vw) | (sum < t);
+            // u is a subset of vw, so vw - u cannot borrow
+            v[w] = sum | (vw - u);
+        }
+        if (i + 1 == next) {
+            const long bound = lcs_multi_length(v, n_words) + len - next;
+            if (bound < need) {
+                result = bound;
+                goto out;
+            }
+            next += bound - need + 1;
+        }
+    }
+    result = lcs_multi_length(v, n_words);
+out:
+    if (v != stack) {
+        free(v);
+    }
+    return result;
 }
 
-static bool
-add_item(struct strgrp_grp *const ctx, const char *const str,
-        void *const data) {
-    struct strgrp_item *i = new_item(ctx, str, data);
-    if (!i) {
-        return false;
+// Compute the LCS of the pattern and text, unless it is shorter than need. In
+// that case some length less than need is returned.
+static inline long
+lcs(const struct lcs_pattern *const p, const char *const text,
+        const size_t len, const long need) {
+    if (!p->n_words) {
+        return 0;
     }
-    darray_push(ctx->items, i);
-    ctx->n_items++;
-    return true;
+    return (1 == p->n_words) ?
+        lcs_single(p, text, len, need) : lcs_multi(p, text, len, need);
 }
 
-static void
-free_grp(struct strgrp_grp *grp) {
-    darray_free(grp->items);
+static inline double
+nlcs_score(const double lcss, const double la, const double lb) {
+    return sqrt((2 * lcss * lcss) / (la * la + lb * lb));
 }
 
-static struct strgrp_grp *
-new_grp(tal_t *const tctx, const char *const str, void *const data) {
-    struct strgrp_grp *b = talz(tctx, struct strgrp_grp);
-    if (!b) {
-        return NULL;
+// Find the smallest LCS length for which strings of lengths la and lb score at
+// least floor_score, using the same arithmetic as scoring so the bound is exact.
+// A length greater than min(la, lb) is returned if the score is unreachable.
+static long
+lcs_need(const double floor_score, const size_t la, const size_t lb) {
+    const long lmin = (long)((la < lb) ? la : lb);
+    long l = (long) floor(floor_score * sqrt((la * la + lb * lb) / 2.0)) - 1;
+    if (l < 0) {
+        l = 0;
     }
-    b->key = tal_strdup(b, str);
-    b->key_len = strlen(str);
-    b->n_items = 0;
-    darray_init(b->items);
-    tal_add_destructor(b, free_grp);
-    if (!add_item(b, str, data)) {
-        return tal_free(b);
+    while (l <= lmin && nlcs_score(l, la, lb) < floor_score) {
+        l++;
     }
-    return b;
-}
-
-static struct strgrp_grp *
-add_grp(struct strgrp *const ctx, const char *const str,
-        void *const data) {
-    struct strgrp_grp *b = new_grp(ctx, str, data);
-    if (!b) {
-        return NULL;
+    if (l > lmin) {
+        return l;
     }
-    memcpy(b->pop, ctx->pop, sizeof(ctx->pop));
-    darray_push(ctx->grps, b);
-    ctx->n_grps++;
-    if (ctx->scores) {
-        if (!tal_resize(&ctx->scores, ctx->n_grps)) {
-            return NULL;
-        }
-    } else {
-        ctx->scores = tal_arr(ctx, struct grp_score, ctx->n_grps);
-        if (!ctx->scores) {
-            return NULL;
-        }
+    while (l > 0 && nlcs_score(l - 1, la, lb) >= floor_score) {
+        l--;
     }
-    return b;
+    return l;
 }
 
-struct strgrp *
-strgrp_new(const double threshold) {
-    struct strgrp *ctx = talz(NULL, struct strgrp);
-    ctx->threshold = threshold;
-    stringmap_init(ctx->known, NULL);
-    // n threads compare strings
-    darray_init(ctx->grps);
-    return ctx;
+// A lower bound on lcs_need() that is cheap enough to evaluate per group. It
+// differs from the exact value by at most two, which is still enough to
+// abandon most hopeless comparisons.
+static inline long
+lcs_need_min(const double floor_score, const size_t la, const size_t lb) {
+    return (long) floor(floor_score * sqrt((la * la + lb * lb) / 2.0)) - 1;
 }
 
-static inline void
-cache(struct strgrp *const ctx, struct strgrp_grp *const grp,
-        const char *const str) {
-    *(stringmap_enter(ctx->known, str)) = grp;
+// Score the group against the pattern. If the LCS is shorter than need, as
+// found by lcs_need(), scoring may be abandoned early and some value less than
+// the corresponding floor is returned.
+static inline double
+grp_score(const struct strgrp_grp *const grp,
+        const struct lcs_pattern *const p, const long need) {
+    const size_t lmin = (p->len < grp->key_len) ? p->len : grp->key_len;
+    const long lcss = (need > (long)lmin) ?
+        (long)lmin : lcs(p, grp->key, grp->key_len, need);
+    return nlcs_score(lcss, (double) p->len, (double) grp->key_len);
 }
 
-static struct strgrp_grp *
-grp_for(struct strgrp *const ctx, const char *const str) {
-    // Ensure ctx->pop is always populated. Returning null here indicates a new
-    // group should be created, at which point add_grp() copies ctx->pop into
-    // the new group's struct.
-    strpopcnt(str, ctx->pop);
-    if (!ctx->n_grps) {
-        return NULL;
-    }
-    {
-        struct strgrp_grp **const grp = stringmap_lookup(ctx->known, str);
-        if (grp) {
-            return *grp;
+/* Token and bigram similarity
+ *
+ * Bank descriptions mostly differ in store numbers, terminal IDs and dates, so
+ * comparing their tokens or bigrams as sets often groups them as well as the
+ * LCS does, at a fraction of the cost. Each key's features are computed once
+ * and kept sorted. For STRGRP_METRIC_JACCARD the features are the distinct
+ * 32-bit FNV-1a hashes of the tokens, and scoring a group merges its few
+ * tokens with the query's. For STRGRP_METRIC_DICE the features are the
+ * distinct bigrams with their counts, and the query's counts are spread over
+ * a table indexed by bigram, so scoring a group is a lookup per bigram rather
+ * than a branchy merge.
+ *
+ * As for the LCS, the score depends only on the number of shared features
+ * given the feature counts of the two keys, so the number of shared features
+ * needed to reach the threshold serves as the bound for the q-gram index. For
+ * STRGRP_METRIC_JACCARD the index holds the hashed tokens rather than the
+ * bigrams, and is bounded by token counts rather than key lengths.
+ */
+
+#define BIGRAM_N_VALUES (1 << (QGRAM_Q * CHAR_BIT))
+#define BIGRAM_COUNT_MAX UINT16_MAX
+
+static inline bool
+is_space(const char c) {
+    return c == ' ' || (c >= '\t' && c <= '\r');
+}
+
+static inline size_t
+n_bigrams(const size_t len) {
+    return (len < QGRAM_Q) ? 0 : len - QGRAM_Q + 1;
+}
+
+static int
+feat_cmp(const void *a, const void *b) {
+    const uint32_t fa = *(const uint32_t *)a;
+    const uint32_t fb = *(const uint32_t *)b;
+    return (fa > fb) - (fa < fb);
+}
+
+// Find the sorted features of str: its distinct token hashes for
+// STRGRP_METRIC_JACCARD, otherwise its distinct bigrams, each in the upper 16
+// bits above its count
+static void
+features(const struct strgrp *const ctx, const char *const str,
+        const size_t len, darray_idx *const feat) {
+    size_t i = 0, n = 0;
+    darray_resize(*feat, 0);
+    if (ctx->metric != STRGRP_METRIC_JACCARD) {
+        for (i = 0; i + QGRAM_Q <= len; i++) {
+            darray_push(*feat, ((unsigned char)str[i] << CHAR_BIT) |
+                    (unsigned char)str[i + 1]);
+        }
+    } else {
+        while (i < len) {
+            uint32_t h = 2166136261U;
+            if (is_space(str[i])) {
+                i++;
+                continue;
+            }
+            for (; i < len && !is_space(str[i]); i++) {
+                h = (h ^ (unsigned char)str[i]) * 16777619U;
+            }
+            darray_push(*feat, h);
         }
     }
-    int i;
-// Keep ccanlint happy in reduced feature mode
-#if HAVE_OPENMP
-    #pragma omp parallel for schedule(dynamic)
-#endif
-    for (i = 0; i < ctx->n_grps; i++) {
-        struct strgrp_grp *grp = darray_item(ctx->grps, i);
-        ctx->scores[i].grp = grp;
-        ctx->scores[i].score = 0;
-        if (should_grp_score_len(ctx, grp, str)) {
-            if (should_grp_score_cos(ctx, grp, str)) {
-                ctx->scores[i].score = grp_score(grp, str);
+    qsort(feat->item, darray_size(*feat), sizeof(*feat->item), feat_cmp);
+    for (i = 0; i < darray_size(*feat); i++) {
+        const uint32_t f = darray_item(*feat, i);
+        if (ctx->metric == STRGRP_METRIC_JACCARD) {
+            if (!n || darray_item(*feat, n - 1) != f) {
+                darray_item(*feat, n++) = f;
+            }
+        } else if (n && (darray_item(*feat, n - 1) >> 16) == f) {
+            if ((darray_item(*feat, n - 1) & BIGRAM_COUNT_MAX) <
+                    BIGRAM_COUNT_MAX) {
+                darray_item(*feat, n - 1)++;
             }
+        } else {
+            darray_item(*feat, n++) = (f << 16) | 1;
         }
     }
-    struct grp_score *max = NULL;
-    for (i = 0; i < ctx->n_grps; i++) {
-        if (!max || ctx->scores[i].score > max->score) {
-            max = &(ctx->scores[i]);
+    darray_resize(*feat, n);
+}
+
+// Set the features of the query for str, and for STRGRP_METRIC_DICE spread
+// the bigram counts over the query's table
+static bool
+query_features(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const size_t len) {
+    uint32_t *f;
+    if (ctx->metric != STRGRP_METRIC_DICE) {
+        features(ctx, str, len, &q->feat);
+        return true;
+    }
+    if (!q->bigrams) {
+        q->bigrams = calloc(BIGRAM_N_VALUES, sizeof(*q->bigrams));
+        if (!q->bigrams) {
+            return false;
         }
     }
-    return (max && max->score >= ctx->threshold) ? max->grp : NULL;
+    darray_foreach(f, q->feat) {
+        q->bigrams[*f >> 16] = 0;
+    }
+    features(ctx, str, len, &q->feat);
+    darray_foreach(f, q->feat) {
+        q->bigrams[*f >> 16] = *f & BIGRAM_COUNT_MAX;
+    }
+    return true;
 }
 
-const struct strgrp_grp *
-strgrp_grp_for(struct strgrp *const ctx, const char *const str) {
-    return grp_for(ctx, str);
+static inline double
+feat_score_shared(const enum strgrp_metric metric, const size_t shared,
+        const size_t na, const size_t nb) {
+    return (metric == STRGRP_METRIC_JACCARD) ?
+        (double)shared / (double)(na + nb - shared) :
+        2.0 * shared / (double)(na + nb);
 }
 
-const struct strgrp_grp *
-strgrp_add(struct strgrp *const ctx, const char *const str,
-        void *const data) {
-    bool inserted = false;
-    // grp_for() populates the ctx->pop memory. add_grp() copies this memory
-    // into the strgrp_grp that it creates. It's assumed the ctx->pop memory
-    // has not been modified between the grp_for() and add_grp() calls.
-    struct strgrp_grp *pick = grp_for(ctx, str);
-    if (pick) {
-        inserted = add_item(pick, str, data);
-    } else {
-        pick = add_grp(ctx, str, data);
-        inserted = (NULL != pick);
+// Find the smallest number of shared features for which keys with na and nb
+// features score at least threshold, using the same arithmetic as scoring,
+// or QGRAM_REJECT if they cannot
+static long
+feat_need(const enum strgrp_metric metric, const double threshold,
+        const size_t na, const size_t nb) {
+    const long lmin = (long)((na < nb) ? na : nb);
+    const double scale = (metric == STRGRP_METRIC_JACCARD) ?
+        1.0 / (1.0 + threshold) : 0.5;
+    long s;
+    if (!na && !nb) {
+        // Leave degenerate comparisons to scoring
+        return 0;
     }
-    if (inserted) {
-        assert(NULL != pick);
-        cache(ctx, pick, str);
+    s = (long) floor(threshold * (na + nb) * scale) - 1;
+    if (s < 0) {
+        s = 0;
     }
-    return pick;
+    while (s <= lmin && feat_score_shared(metric, s, na, nb) < threshold) {
+        s++;
+    }
+    if (s > lmin) {
+        return QGRAM_REJECT;
+    }
+    while (s > 0 && feat_score_shared(metric, s - 1, na, nb) >= threshold) {
+        s--;
+    }
+    return s;
 }
 
-struct strgrp_iter *
-strgrp_iter_new(struct strgrp *const ctx) {
-    struct strgrp_iter *iter = talz(ctx, struct strgrp_iter);
-    if (!iter) {
-        return NULL;
+// Score the group by the features of the query, whose key is str
+static double
+feat_score(const struct strgrp *const ctx, const struct strgrp_query *const q,
+        const struct strgrp_grp *const grp, const char *const str,
+        const size_t len) {
+    const uint32_t *const a = q->feat.item;
+    const uint32_t *const b = grp->feat;
+    size_t na, nb, i = 0, j = 0, shared = 0;
+    if (ctx->metric == STRGRP_METRIC_DICE) {
+        na = n_bigrams(len);
+        nb = n_bigrams(grp->key_len);
+        for (j = 0; j < grp->n_feat; j++) {
+            const uint32_t qc = q->bigrams[b[j] >> 16];
+            const uint32_t gc = b[j] & BIGRAM_COUNT_MAX;
+            shared += (qc < gc) ? qc : gc;
+        }
+    } else {
+        na = darray_size(q->feat);
+        nb = grp->n_feat;
+        while (i < na && j < nb) {
+            if (a[i] < b[j]) {
+                i++;
+            } else if (a[i] > b[j]) {
+                j++;
+            } else {
+                shared++;
+                i++;
+                j++;
+            }
+        }
     }
-    iter->ctx = ctx;
-    iter->i = 0;
-    return iter;
+    if (!na && !nb) {
+        return (len == grp->key_len && !memcmp(str, grp->key, len)) ?
+            1.0 : 0.0;
+    }
+    return feat_score_shared(ctx->metric, shared, na, nb);
 }
 
-const struct strgrp_grp *
-strgrp_iter_next(struct strgrp_iter *const iter) {
-    return (iter->ctx->n_grps == iter->i) ?
-        NULL : darray_item(iter->ctx->grps, iter->i++);
+// The size bounding the groups that can match: the key length, or for
+// STRGRP_METRIC_JACCARD the number of distinct tokens
+static inline size_t
+grp_size(const struct strgrp *const ctx, const struct strgrp_grp *const grp) {
+    return (ctx->metric == STRGRP_METRIC_JACCARD) ? grp->n_feat : grp->key_len;
 }
 
-void
-strgrp_iter_free(struct strgrp_iter *const iter) {
-    tal_free(iter);
+/* Candidate selection - q-gram index[5]
+ *
+ * Strings within edit distance k of one another share at least
+ * max(|a|, |b|) - q + 1 - kq of their q-grams, counted with multiplicity[5].
+ * For a group to score at or above the threshold its LCS with the query must
+ * be at least some L that depends only on the two string lengths, and an LCS
+ * of L bounds the edit distance by |a| + |b| - 2L. The index maps q-grams to
+ * the groups containing them, so a lookup counts the q-grams each group
+ * shares with the query and only scores groups that can meet the bound.
+ *
+ * q-grams are hashed into a fixed number of buckets. Collisions can only
+ * inflate the shared counts, so the candidate set remains a superset of the
+ * groups able to reach the threshold and the result matches a linear scan.
+ * Where the bound is vacuous for a key length, every group of that length is
+ * a candidate; these are found through a second index of groups by key
+ * length.
+ *
+ * Frequent q-grams have long posting lists. If the query's q-grams with the
+ * longest lists together occur fewer times than the smallest bound, any group
+ * that can meet its bound must also appear in one of the remaining lists, so
+ * the longest lists are skipped and their occurrences are instead credited to
+ * every group in full.
+ *
+ * [5] E. Ukkonen, "Approximate string-matching with q-grams and maximal
+ *     matches", Theoretical Computer Science 92(1), 1992
+ */
+
+static inline uint32_t
+qgram_bucket(const char *const str) {
+    const uint32_t q = ((unsigned char)str[0] << CHAR_BIT) | (unsigned char)str[1];
+    return (q * 2654435761U) >> (32 - QGRAM_BUCKET_BITS);
 }
 
-struct strgrp_grp_iter *
-strgrp_grp_iter_new(const struct strgrp_grp *const grp) {
-    struct strgrp_grp_iter *iter = talz(grp, struct strgrp_grp_iter);
-    if (!iter) {
-        return NULL;
-    }
-    iter->grp = grp;
-    iter->i = 0;
-    return iter;
+static int
+qgram_count_cmp(const void *a, const void *b) {
+    const uint32_t ba = ((const struct qgram_count *)a)->bucket;
+    const uint32_t bb = ((const struct qgram_count *)b)->bucket;
+    return (ba > bb) - (ba < bb);
 }
 
-const struct strgrp_item *
-strgrp_grp_iter_next(struct strgrp_grp_iter *const iter) {
-    return (iter->grp->n_items == iter->i) ?
-        NULL : darray_item(iter->grp->items, iter->i++);
+// Sort the buckets of the profile and collapse runs of them into counts
+static void
+qgram_collapse(darray_qcount *const profile) {
+    struct qgram_count *qc;
+    size_t n = 0;
+    qsort(profile->item, darray_size(*profile), sizeof(*profile->item),
+            qgram_count_cmp);
+    darray_foreach(qc, *profile) {
+        if (n && darray_item(*profile, n - 1).bucket == qc->bucket) {
+            darray_item(*profile, n - 1).count++;
+        } else {
+            darray_item(*profile, n++) = *qc;
+        }
+    }
+    darray_resize(*profile, n);
 }
 
-void
-strgrp_grp_iter_free(struct strgrp_grp_iter *iter) {
-    tal_free(iter);
+// Find the q-gram profile of str, or for STRGRP_METRIC_JACCARD the profile of
+// its n_feat token hashes
+static void
+qgram_profile(const struct strgrp *const ctx, const char *const str,
+        const size_t len, const uint32_t *const feat, const size_t n_feat,
+        darray_qcount *const profile) {
+    size_t i;
+    darray_resize(*profile, 0);
+    if (ctx->metric == STRGRP_METRIC_JACCARD) {
+        for (i = 0; i < n_feat; i++) {
+            struct qgram_count c =
+                { (feat[i] * 2654435761U) >> (32 - QGRAM_BUCKET_BITS), 1, 0 };
+            darray_push(*profile, c);
+        }
+    } else {
+        for (i = 0; i + QGRAM_Q <= len; i++) {
+            struct qgram_count c = { qgram_bucket(&str[i]), 1, 0 };
+            darray_push(*profile, c);
+        }
+    }
+    qgram_collapse(profile);
 }
 
-const char *
-strgrp_grp_key(const struct strgrp_grp *const grp) {
-    return grp->key;
+static bool
+qgram_index_add(struct strgrp *const ctx, struct strgrp_grp *const grp) {
+    struct qgram_count *qc;
+    if (!ctx->qgrams) {
+        ctx->qgrams = tal_arrz(ctx, darray_posting, QGRAM_N_BUCKETS);
+        if (!ctx->qgrams) {
+            return false;
+        }
+    }
+    qgram_profile(ctx, grp->key, grp->key_len, grp->feat, grp->n_feat,
+            &ctx->query->profile);
+    darray_foreach(qc, ctx->query->profile) {
+        struct qgram_posting posting =
+            { grp->idx, grp_size(ctx, grp), qc->count };
+        darray_push(ctx->qgrams[qc->bucket], posting);
+    }
+    return true;
 }
 
-const char *
-strgrp_item_key(const struct strgrp_item *const item) {
-    return item->key;
+/* The number of q-grams a group key of length lb must share with a query of
+ * length la for the group to possibly score at or above the threshold, or
+ * QGRAM_REJECT if no key of that length can. l is the LCS length required to
+ * meet the threshold, as found by lcs_need(). */
+static long
+qgram_need(const size_t la, const size_t lb, const long l) {
+    const long lmin = (long)((la < lb) ? la : lb);
+    const long lmax = (long)((la < lb) ? lb : la);
+    if (!lmax) {
+        // Leave degenerate comparisons to the filters
+        return 0;
+    }
+    if (l > lmin) {
+        return QGRAM_REJECT;
+    }
+    return lmax - (QGRAM_Q - 1) - QGRAM_Q * ((long)(la + lb) - 2 * l);
 }
 
-void *
-strgrp_item_value(const struct strgrp_item *const item) {
-    return item->value;
+static long
+need_for(const struct strgrp_query *const q, const size_t len) {
+    return darray_item(q->need, len);
 }
 
-void
-strgrp_free(struct strgrp *const ctx) {
-    darray_free(ctx->grps);
-    stringmap_free(ctx->known);
-    tal_free(ctx);
+static int
+qgram_postings_cmp(const void *a, const void *b) {
+    const uint32_t na = ((const struct qgram_count *)a)->n_postings;
+    const uint32_t nb = ((const struct qgram_count *)b)->n_postings;
+    return (na < nb) - (na > nb);
 }
 
-void
-strgrp_free_cb(struct strgrp *const ctx, void (*cb)(void *data)) {
-    struct strgrp_grp **grp;
-    struct strgrp_item **item;
-    darray_foreach(grp, ctx->grps) {
-        darray_foreach(item, (*grp)->items) {
-            cb((*item)->value);
+// Find the LCS and q-gram bounds for each group size (see grp_size()),
+// returning the smallest positive q-gram bound. For measures other than
+// STRGRP_METRIC_NLCS the query's features must already be set.
+static long
+set_needs(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const size_t len, const double threshold) {
+    const size_t n_feat = (ctx->metric == STRGRP_METRIC_JACCARD) ?
+        darray_size(q->feat) : n_bigrams(len);
+    long min_need = QGRAM_REJECT;
+    size_t l;
+    darray_resize(q->need, darray_size(ctx->by_len));
+    darray_resize(q->need_lcs, darray_size(ctx->by_len));
+    for (l = 0; l < darray_size(ctx->by_len); l++) {
+        long need = QGRAM_REJECT;
+        darray_item(q->need_lcs, l) = 0;
+        if (darray_empty(darray_item(ctx->by_len, l))) {
+            // No groups of this size
+        } else if (ctx->metric == STRGRP_METRIC_NLCS) {
+            darray_item(q->need_lcs, l) = lcs_need(threshold, len, l);
+            need = qgram_need(len, l, darray_item(q->need_lcs, l));
+        } else {
+            need = feat_need(ctx->metric, threshold, n_feat,
+                    (ctx->metric == STRGRP_METRIC_JACCARD) ? l : n_bigrams(l));
+        }
+        darray_item(q->need, l) = need;
+        if (need > 0 && need < min_need) {
+            min_need = need;
         }
     }
-    strgrp_free(ctx);
+    return min_need;
 }
 
 static void
-print_item(const struct strgrp_item *item) {
-    printf("\t%s\n", item->key);
-}
+select_qgram_cands(const struct strgrp *const ctx,
+        struct strgrp_query *const q, const char *const str, const size_t len,
+        const double threshold) {
+    struct qgram_count *qc;
+    struct strgrp_grp **grp;
+    uint32_t *idx;
+    const long min_need = set_needs(ctx, q, len, threshold);
+    long skipped = 0;
+    size_t l;
+    darray_resize(q->cands, 0);
+    darray_resize(q->touched, 0);
+    // Count the q-grams each group shares with the query, skipping the
+    // longest posting lists while their occurrences stay below the bound
+    qgram_profile(ctx, str, len, q->feat.item, darray_size(q->feat),
+            &q->profile);
+    darray_foreach(qc, q->profile) {
+        qc->n_postings = darray_size(ctx->qgrams[qc->bucket]);
+    }
+    qsort(q->profile.item, darray_size(q->profile),
+            sizeof(*q->profile.item), qgram_postings_cmp);
+    darray_foreach(qc, q->profile) {
+        const darray_posting *const postings = &ctx->qgrams[qc->bucket];
+        struct qgram_posting *p;
+        if (min_need == QGRAM_REJECT) {
+            break;
+        }
+        if (skipped + qc->count < min_need) {
+            skipped += qc->count;
+            continue;
+        }
+        darray_foreach(p, *postings) {
+            const long need = need_for(q, p->len);
+            if (need <= 0 || need == QGRAM_REJECT) {
+                continue;
+            }
+            if (!q->shared[p->idx]) {
+                darray_push(q->touched, p->idx);
+            }
+            q->shared[p->idx] += (qc->count < p->count) ? qc->count : p->count;
+        }
+    }
+    darray_foreach(idx, q->touched) {
+        struct strgrp_grp *const cand = darray_item(ctx->grps, *idx);
+        if (q->shared[*idx] + skipped >= need_for(q, grp_size(ctx, cand))) {
+            darray_push(q->cands, cand);
+        }
+        q->shared[*idx] = 0;
+    }
+    // Groups of sizes for which the bound is vacuous
+    for (l = 0; l < darray_size(ctx->by_len); l++) {
+        if (need_for(q, l) <= 0) {
+            darray_foreach(grp, darray_item(ctx->by_len, l)) {
+                darray_push(q->cands, *grp);
+            }
+        }
+    }
+}
+
+/* Candidate selection - locality-sensitive hashing[6][7]
+ *
+ * The q-gram index finds every group able to reach the threshold, but its
+ * posting lists grow with the number of groups, so lookups remain linear in
+ * the groups. Instances created by strgrp_new_lsh() instead summarise each key
+ * by a MinHash signature over its character trigrams: the minimum of each of
+ * n_bands * n_rows hash functions over the trigrams. Two keys agree on any one
+ * value with probability equal to the Jaccard similarity s of their trigram
+ * sets[6]. The signature is cut into n_bands bands of n_rows values, and the
+ * index maps each band to the groups whose signatures hold that band. A group
+ * sharing any band with the query is a candidate, which happens with
+ * probability 1 - (1 - s^n_rows)^n_bands[7], so lookups only visit the groups
+ * in the query's buckets.
+ *
+ * Candidates are still filtered and scored exactly, so no group below the
+ * threshold is ever picked. However a group that could reach the threshold
+ * may be missed, in which case the key joins a worse group or starts a new
+ * one. More bands raise the chance of finding such groups, and more rows
+ * reduce the number of dissimilar candidates.
+ *
+ * [6] A. Broder, "On the resemblance and containment of documents",
+ *     Compression and Complexity of Sequences, 1997
+ * [7] J. Leskovec, A. Rajaraman and J. Ullman, "Mining of Massive Datasets",
+ *     chapter 3, Cambridge University Press, 2014
+ */
+
+static inline uint32_t
+mix32(uint32_t h) {
+    h ^= h >> 16;
+    h *= 0x85ebca6bU;
+    h ^= h >> 13;
+    h *= 0xc2b2ae35U;
+    h ^= h >> 16;
+    return h;
+}
+
+// Find the MinHash signature of str. Keys shorter than a shingle are treated
+// as a single shingle.
+static void
+lsh_signature(const char *const str, const size_t len, const size_t n_hashes,
+        darray_idx *const minhash) {
+    const size_t n_shingles = (len < LSH_SHINGLE) ? 1 : len - LSH_SHINGLE + 1;
+    size_t i, j;
+    darray_resize(*minhash, n_hashes);
+    for (i = 0; i < n_hashes; i++) {
+        darray_item(*minhash, i) = UINT32_MAX;
+    }
+    for (i = 0; i < n_shingles; i++) {
+        uint32_t shingle = 0, h;
+        for (j = i; j < i + LSH_SHINGLE && j < len; j++) {
+            shingle = (shingle << CHAR_BIT) | (unsigned char)str[j];
+        }
+        h = mix32(shingle);
+        for (j = 0; j < n_hashes; j++) {
+            const uint32_t v = mix32(h ^ ((j + 1) * 2654435761U));
+            if (v < darray_item(*minhash, j)) {
+                darray_item(*minhash, j) = v;
+            }
+        }
+    }
+}
+
+static inline uint32_t
+lsh_band_sig(const struct strgrp *const ctx, const darray_idx *const minhash,
+        const unsigned int band) {
+    const uint32_t *const rows = &minhash->item[band * ctx->n_rows];
+    uint32_t sig = mix32(band + 1);
+    unsigned int i;
+    for (i = 0; i < ctx->n_rows; i++) {
+        sig = mix32(sig ^ rows[i]);
+    }
+    return sig;
+}
+
+static inline uint32_t
+lsh_bucket(const uint32_t sig) {
+    return sig >> (32 - LSH_BUCKET_BITS);
+}
+
+static bool
+lsh_index_add(struct strgrp *const ctx, const struct strgrp_grp *const grp) {
+    darray_idx *const minhash = &ctx->query->minhash;
+    unsigned int b;
+    if (!ctx->lsh) {
+        ctx->lsh = tal_arrz(ctx, darray_lsh, LSH_N_BUCKETS);
+        if (!ctx->lsh) {
+            return false;
+        }
+    }
+    lsh_signature(grp->key, grp->key_len, ctx->n_bands * ctx->n_rows, minhash);
+    for (b = 0; b < ctx->n_bands; b++) {
+        const uint32_t sig = lsh_band_sig(ctx, minhash, b);
+        struct lsh_posting posting = { sig, grp->idx };
+        darray_push(ctx->lsh[lsh_bucket(sig)], posting);
+    }
+    return true;
+}
+
+static void
+lsh_index_remove(struct strgrp *const ctx,
+        const struct strgrp_grp *const grp) {
+    darray_idx *const minhash = &ctx->query->minhash;
+    unsigned int b;
+    size_t i, n;
+    lsh_signature(grp->key, grp->key_len, ctx->n_bands * ctx->n_rows, minhash);
+    for (b = 0; b < ctx->n_bands; b++) {
+        darray_lsh *const postings =
+            &ctx->lsh[lsh_bucket(lsh_band_sig(ctx, minhash, b))];
+        for (i = n = 0; i < darray_size(*postings); i++) {
+            if (darray_item(*postings, i).idx != grp->idx) {
+                darray_item(*postings, n++) = darray_item(*postings, i);
+            }
+        }
+        darray_resize(*postings, n);
+    }
+}
+
+static void
+select_lsh_cands(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const size_t len, const double threshold,
+        const size_t first) {
+    struct lsh_posting *p;
+    uint32_t *idx;
+    unsigned int b;
+    set_needs(ctx, q, len, threshold);
+    darray_resize(q->cands, 0);
+    darray_resize(q->touched, 0);
+    if (!ctx->lsh) {
+        return;
+    }
+    lsh_signature(str, len, ctx->n_bands * ctx->n_rows, &q->minhash);
+    for (b = 0; b < ctx->n_bands; b++) {
+        const uint32_t sig = lsh_band_sig(ctx, &q->minhash, b);
+        darray_foreach(p, ctx->lsh[lsh_bucket(sig)]) {
+            if (p->sig != sig || p->idx < first || q->shared[p->idx]) {
+                continue;
+            }
+            q->shared[p->idx] = 1;
+            darray_push(q->touched, p->idx);
+        }
+    }
+    // Groups of lengths unable to reach the threshold are rejected here, as
+    // the q-gram index would have
+    darray_foreach(idx, q->touched) {
+        struct strgrp_grp *const cand = darray_item(ctx->grps, *idx);
+        if (need_for(q, grp_size(ctx, cand)) != QGRAM_REJECT) {
+            darray_push(q->cands, cand);
+        }
+        q->shared[*idx] = 0;
+    }
+}
+
+// Select every group from index first onwards able to reach the threshold.
+// Bulk additions check these groups, created since the key was last looked
+// up, which are few enough that the q-gram index wouldn't save anything.
+static void
+select_recent_cands(const struct strgrp *const ctx,
+        struct strgrp_query *const q, const size_t len,
+        const double threshold, const size_t first) {
+    size_t i;
+    set_needs(ctx, q, len, threshold);
+    darray_resize(q->cands, 0);
+    for (i = first; i < darray_size(ctx->grps); i++) {
+        struct strgrp_grp *const cand = darray_item(ctx->grps, i);
+        if (cand && need_for(q, grp_size(ctx, cand)) != QGRAM_REJECT) {
+            darray_push(q->cands, cand);
+        }
+    }
+}
+
+// Select the candidates among the groups from index first onwards
+static void
+select_cands(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const size_t len, const double threshold,
+        const size_t first) {
+    if (ctx->n_bands) {
+        select_lsh_cands(ctx, q, str, len, threshold, first);
+    } else if (first) {
+        select_recent_cands(ctx, q, len, threshold, first);
+    } else {
+        select_qgram_cands(ctx, q, str, len, threshold);
+    }
+}
+
+// Index grp for candidate selection
+static bool
+index_add(struct strgrp *const ctx, struct strgrp_grp *const grp) {
+    const bool added = ctx->n_bands ?
+        lsh_index_add(ctx, grp) : qgram_index_add(ctx, grp);
+    const size_t size = grp_size(ctx, grp);
+    if (!added) {
+        return false;
+    }
+    if (size >= darray_size(ctx->by_len)) {
+        darray_resize0(ctx->by_len, size + 1);
+    }
+    darray_push(darray_item(ctx->by_len, size), grp);
+    return true;
+}
+
+/* Statistics */
+
+static inline double
+seconds(void) {
+#if HAVE_CLOCK_GETTIME
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+#else
+    return (double)clock() / CLOCKS_PER_SEC;
+#endif
+}
+
+// Compound assignment to an atomic double may need libatomic, so spell out the
+// compare-and-swap loop
+static inline void
+atomic_add_seconds(_Atomic double *const to, const double t) {
+    double cur = atomic_load_explicit(to, memory_order_relaxed);
+    while (!atomic_compare_exchange_weak_explicit(to, &cur, cur + t,
+                memory_order_relaxed, memory_order_relaxed)) {
+    }
+}
+
+// Add the counters collected by q to the instance's, and clear them
+static void
+stats_fold(const struct strgrp *const ctx, struct strgrp_query *const q) {
+    struct strgrp_counters *const to = ctx->counters;
+    const struct strgrp_stats *const from = &q->stats;
+    atomic_fetch_add_explicit(&to->n_lookups, from->n_lookups,
+            memory_order_relaxed);
+    atomic_fetch_add_explicit(&to->n_cache_hits, from->n_cache_hits,
+            memory_order_relaxed);
+    atomic_fetch_add_explicit(&to->n_cache_misses, from->n_cache_misses,
+            memory_order_relaxed);
+    atomic_fetch_add_explicit(&to->n_cands, from->n_cands,
+            memory_order_relaxed);
+    atomic_fetch_add_explicit(&to->n_len_rejected, from->n_len_rejected,
+            memory_order_relaxed);
+    atomic_fetch_add_explicit(&to->n_cos_rejected, from->n_cos_rejected,
+            memory_order_relaxed);
+    atomic_fetch_add_explicit(&to->n_lcs, from->n_lcs, memory_order_relaxed);
+    atomic_add_seconds(&to->t_lookup, from->t_lookup);
+    atomic_add_seconds(&to->t_select, from->t_select);
+    atomic_add_seconds(&to->t_score, from->t_score);
+    memset(&q->stats, 0, sizeof(q->stats));
+}
+
+/* Key normalisation[8]
+ *
+ * Callers would otherwise prepare each key themselves, typically replacing
+ * boilerplate phrases and then folding case and collapsing whitespace, with
+ * repeated passes over the key. Here the stop phrases are found in a single
+ * pass by an Aho-Corasick automaton over all of them, rather than a search per
+ * phrase, and the case and whitespace are then handled in a single pass over
+ * the result.
+ * The automaton's transitions form a dense table over the classes of bytes
+ * appearing in the phrases, as any other byte returns it to the root.
+ *
+ * [8] A. Aho and M. Corasick, "Efficient string matching: an aid to
+ *     bibliographic search", Communications of the ACM 18(6), 1975
+ */
+
+struct strgrp_norm {
+    unsigned int flags;
+    // The stop phrases as given, for strgrp_save()
+    char **stop;
+    size_t n_stop;
+    // Byte classes of the automaton, 0 for bytes absent from the phrases
+    unsigned char cls[CHAR_N_VALUES];
+    size_t n_cls;
+    // By state, with the root as state 0: the transitions by class, the length
+    // of the phrase ending at the state or 0, and the nearest state along the
+    // failure links that ends a phrase, or 0
+    uint32_t *next;
+    uint32_t *out;
+    uint32_t *out_link;
+};
+
+// The ASCII whitespace, as Python's str.split() sees it
+static inline bool
+norm_is_space(const char c) {
+    return is_space(c) || (c >= '\x1c' && c <= '\x1f');
+}
+
+static bool
+is_ascii(const char *str) {
+    for (; *str; str++) {
+        if ((unsigned char)*str >= 0x80) {
+            return false;
+        }
+    }
+    return true;
+}
+
+// Copy str to buf, which must have space for it, folding case and collapsing
+// whitespace as flags requires. Returns the length of the copy.
+static size_t
+norm_fold(const unsigned int flags, const char *str, char *const buf) {
+    bool space = false;
+    size_t n = 0;
+    for (; *str; str++) {
+        const char c = *str;
+        if ((flags & STRGRP_NORM_COLLAPSE) && norm_is_space(c)) {
+            space = true;
+            continue;
+        }
+        if (space && n) {
+            buf[n++] = ' ';
+        }
+        space = false;
+        buf[n++] = ((flags & STRGRP_NORM_UPPER) && c >= 'a' && c <= 'z') ?
+            c - 'a' + 'A' : c;
+    }
+    buf[n] = '\0';
+    return n;
+}
+
+// Replace each of the stop phrases in the key in buf with a space, leftmost
+// and then longest first, using stop_len as scratch. Returns the new length.
+static size_t
+norm_strip(const struct strgrp_norm *const norm, char *const buf,
+        const size_t len, uint32_t *const stop_len) {
+    uint32_t s = 0;
+    size_t i, n = 0;
+    memset(stop_len, 0, len * sizeof(*stop_len));
+    for (i = 0; i < len; i++) {
+        uint32_t t;
+        s = norm->next[s * norm->n_cls + norm->cls[(unsigned char)buf[i]]];
+        for (t = norm->out[s] ? s : norm->out_link[s]; t;
+                t = norm->out_link[t]) {
+            uint32_t *const at = &stop_len[i + 1 - norm->out[t]];
+            if (*at < norm->out[t]) {
+                *at = norm->out[t];
+            }
+        }
+    }
+    // The output never overtakes the input, so rewrite buf in place
+    for (i = 0; i < len;) {
+        if (stop_len[i]) {
+            i += stop_len[i];
+            buf[n++] = ' ';
+            continue;
+        }
+        buf[n++] = buf[i++];
+    }
+    buf[n] = '\0';
+    return n;
+}
+
+static struct strgrp_norm *
+new_norm(struct strgrp *const ctx, const unsigned int flags,
+        const char *const *const stop, const size_t n_stop) {
+    struct strgrp_norm *const norm = talz(ctx, struct strgrp_norm);
+    uint32_t *depth, *fail, *queue;
+    size_t n_alloc = 1, n_states = 1, head = 0, tail = 0, i, c;
+    if (!norm) {
+        return NULL;
+    }
+    norm->flags = flags;
+    norm->n_stop = n_stop;
+    norm->stop = tal_arr(norm, char *, n_stop);
+    if (!norm->stop) {
+        goto fail;
+    }
+    norm->n_cls = 1;
+    for (i = 0; i < n_stop; i++) {
+        const size_t len = strlen(stop[i]);
+        const char *f;
+        if (!len) {
+            goto fail;
+        }
+        norm->stop[i] = tal_dup_arr(norm, char, stop[i], len + 1, 0);
+        if (!norm->stop[i]) {
+            goto fail;
+        }
+        for (f = stop[i]; *f; f++) {
+            if (!norm->cls[(unsigned char)*f]) {
+                norm->cls[(unsigned char)*f] = norm->n_cls++;
+            }
+        }
+        n_alloc += len;
+    }
+    norm->next = tal_arrz(norm, uint32_t, n_alloc * norm->n_cls);
+    norm->out = tal_arrz(norm, uint32_t, n_alloc);
+    norm->out_link = tal_arrz(norm, uint32_t, n_alloc);
+    depth = tal_arrz(norm, uint32_t, n_alloc);
+    fail = tal_arrz(norm, uint32_t, n_alloc);
+    queue = tal_arr(norm, uint32_t, n_alloc);
+    if (!norm->next || !norm->out || !norm->out_link || !depth || !fail ||
+            !queue) {
+        goto fail;
+    }
+    // Build the trie of the phrases. No transition leads back to the root, so
+    // 0 marks the transitions not yet present.
+    for (i = 0; i < n_stop; i++) {
+        const char *f;
+        uint32_t s = 0;
+        for (f = stop[i]; *f; f++) {
+            uint32_t *const t =
+                &norm->next[s * norm->n_cls + norm->cls[(unsigned char)*f]];
+            if (!*t) {
+                depth[n_states] = depth[s] + 1;
+                *t = n_states++;
+            }
+            s = *t;
+        }
+        norm->out[s] = depth[s];
+    }
+    // Complete the transitions in breadth-first order, so each state's failure
+    // state is complete before the state itself
+    for (c = 0; c < norm->n_cls; c++) {
+        if (norm->next[c]) {
+            queue[tail++] = norm->next[c];
+        }
+    }
+    while (head < tail) {
+        const uint32_t u = queue[head++];
+        const uint32_t f = fail[u];
+        norm->out_link[u] = norm->out[f] ? f : norm->out_link[f];
+        for (c = 0; c < norm->n_cls; c++) {
+            uint32_t *const t = &norm->next[u * norm->n_cls + c];
+            if (*t) {
+                fail[*t] = norm->next[f * norm->n_cls + c];
+                queue[tail++] = *t;
+            } else {
+                *t = norm->next[f * norm->n_cls + c];
+            }
+        }
+    }
+    tal_free(depth);
+    tal_free(fail);
+    tal_free(queue);
+    return norm;
+
+fail:
+    tal_free(norm);
+    return NULL;
+}
+
+bool
+strgrp_set_normalise(struct strgrp *const ctx, const unsigned int flags,
+        const char *const *const stop, const size_t n_stop) {
+    struct strgrp_norm *norm = NULL;
+    if (ctx->n_items || (flags & ~(STRGRP_NORM_UPPER | STRGRP_NORM_COLLAPSE))) {
+        return false;
+    }
+    if ((flags || n_stop) && !(norm = new_norm(ctx, flags, stop, n_stop))) {
+        return false;
+    }
+    tal_free(ctx->norm);
+    ctx->norm = norm;
+    return true;
+}
+
+void
+strgrp_set_fold(struct strgrp *const ctx, strgrp_fold_fn *const fold,
+        void *const arg) {
+    ctx->fold = fold;
+    ctx->fold_arg = arg;
+}
+
+bool
+strgrp_set_metric(struct strgrp *const ctx, const enum strgrp_metric metric) {
+    if (ctx->n_items || (unsigned int)metric > STRGRP_METRIC_DICE) {
+        return false;
+    }
+    ctx->metric = metric;
+    return true;
+}
+
+enum strgrp_metric
+strgrp_metric(const struct strgrp *const ctx) {
+    return ctx->metric;
+}
+
+// Normalise str into q's scratch space, which holds it until the next call
+// with q
+static const char *
+normalise(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str) {
+    const struct strgrp_norm *const norm = ctx->norm;
+    const char *key = str;
+    size_t len;
+    if (!norm) {
+        return str;
+    }
+    len = strlen(str);
+    darray_resize(q->norm, len + 1);
+    if (norm->n_stop && len) {
+        // Stop phrases match the key as given, before its case and whitespace
+        // are normalised, and both passes rewrite the scratch copy in place
+        memcpy(q->norm.item, str, len + 1);
+        darray_resize(q->stop_len, len);
+        norm_strip(norm, q->norm.item, len, q->stop_len.item);
+        key = q->norm.item;
+    }
+    if (norm->flags && ctx->fold && !is_ascii(key)) {
+        char *const folded = ctx->fold(key, norm->flags, ctx->fold_arg);
+        if (folded) {
+            len = strlen(folded);
+            darray_resize(q->norm, len + 1);
+            memcpy(q->norm.item, folded, len + 1);
+            free(folded);
+            return q->norm.item;
+        }
+    }
+    norm_fold(norm->flags, key, q->norm.item);
+    return q->norm.item;
+}
+
+/* Structure management */
+
+// Keys are interned in the lookup map, and groups and items reference its copy
+// rather than holding their own. The entry value is NULL for a new key.
+static inline struct known_entry *
+intern(struct strgrp *const ctx, const char *const str, const size_t len) {
+    return stringmap_lookup_real(&ctx->known.t, str, len, 1,
+            sizeof(*ctx->known.last));
+}
+
+// str must be interned
+static struct strgrp_item *
+new_item(struct strgrp *const ctx, const char *const str, void *const data) {
+    struct strgrp_item *i = block_pool_alloc(ctx->arena, sizeof(*i));
+    if (!i) {
+        return NULL;
+    }
+    i->key = str;
+    i->value = data;
+    return i;
+}
+
+static bool
+add_item(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const char *const str, void *const data) {
+    struct strgrp_item *i = new_item(ctx, str, data);
+    if (!i) {
+        return false;
+    }
+    darray_push(grp->items, i);
+    grp->n_items++;
+    ctx->n_items++;
+    return true;
+}
+
+static void
+free_index(struct strgrp *ctx) {
+    darray_grp *grps;
+    size_t i;
+    if (ctx->qgrams) {
+        for (i = 0; i < QGRAM_N_BUCKETS; i++) {
+            darray_free(ctx->qgrams[i]);
+        }
+    }
+    if (ctx->lsh) {
+        for (i = 0; i < LSH_N_BUCKETS; i++) {
+            darray_free(ctx->lsh[i]);
+        }
+    }
+    darray_foreach(grps, ctx->by_len) {
+        darray_free(*grps);
+    }
+    darray_free(ctx->by_len);
+}
+
+// Queries are allocated with malloc() rather than tal, as tal links every
+// allocation into its parent and so can't be called concurrently for the same
+// parent, including the implicit NULL parent
+static void
+free_query(struct strgrp_query *q) {
+    if (!q) {
+        return;
+    }
+    darray_free(q->profile);
+    darray_free(q->touched);
+    darray_free(q->cands);
+    darray_free(q->need);
+    darray_free(q->need_lcs);
+    darray_free(q->minhash);
+    darray_free(q->feat);
+    darray_free(q->norm);
+    darray_free(q->stop_len);
+    free(q->bigrams);
+    free(q->pattern.peq);
+    free(q->scores);
+    free(q->shared);
+    free(q);
+}
+
+static struct strgrp_query *
+new_query(void) {
+    struct strgrp_query *q = calloc(1, sizeof(*q));
+    if (!q) {
+        return NULL;
+    }
+    darray_init(q->profile);
+    darray_init(q->touched);
+    darray_init(q->cands);
+    darray_init(q->need);
+    darray_init(q->need_lcs);
+    darray_init(q->minhash);
+    darray_init(q->feat);
+    darray_init(q->norm);
+    darray_init(q->stop_len);
+    return q;
+}
+
+// Ensure the per-group arrays of the query cover n_grps groups
+static bool
+query_reserve(struct strgrp_query *const q, const size_t n_grps) {
+    size_t n_alloc = q->n_alloc ? q->n_alloc : 16;
+    if (n_grps <= q->n_alloc) {
+        return true;
+    }
+    while (n_alloc < n_grps) {
+        n_alloc *= 2;
+    }
+    {
+        struct grp_score *const scores =
+            realloc(q->scores, n_alloc * sizeof(*scores));
+        if (!scores) {
+            return false;
+        }
+        q->scores = scores;
+    }
+    {
+        uint32_t *const shared = realloc(q->shared, n_alloc * sizeof(*shared));
+        if (!shared) {
+            return false;
+        }
+        q->shared = shared;
+    }
+    memset(&q->shared[q->n_alloc], 0,
+            (n_alloc - q->n_alloc) * sizeof(*q->shared));
+    q->n_alloc = n_alloc;
+    return true;
+}
+
+// Prepare the query for scoring the groups against str, of length len
+static bool
+query_key(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const size_t len) {
+    if (!query_reserve(q, darray_size(ctx->grps))) {
+        return false;
+    }
+    if (ctx->metric != STRGRP_METRIC_NLCS) {
+        return query_features(ctx, q, str, len);
+    }
+    return lcs_pattern_set(&q->pattern, str, len);
+}
+
+// str must be interned. The caller fills in the n_pop entries of pop.
+static struct strgrp_grp *
+new_grp(struct strgrp *const ctx, const char *const str, const size_t len,
+        const size_t n_pop) {
+    struct strgrp_grp *b = block_pool_alloc_align(ctx->arena,
+            sizeof(*b) + n_pop * sizeof(b->pop[0]), sizeof(void *));
+    if (!b) {
+        return NULL;
+    }
+    memset(b, 0, sizeof(*b));
+    b->key = str;
+    b->key_len = len;
+    b->n_pop = n_pop;
+    darray_init(b->items);
+    return b;
+}
+
+static bool
+insert_grp(struct strgrp *const ctx, struct strgrp_grp *const b) {
+    if (ctx->metric != STRGRP_METRIC_NLCS) {
+        // Not in ctx->query->feat, which holds the table's bigrams
+        darray_idx feat = darray_new();
+        uint32_t *copy = NULL;
+        features(ctx, b->key, b->key_len, &feat);
+        b->n_feat = darray_size(feat);
+        if (b->n_feat) {
+            copy = block_pool_alloc_align(ctx->arena,
+                    b->n_feat * sizeof(*copy), sizeof(*copy));
+            if (copy) {
+                memcpy(copy, feat.item, b->n_feat * sizeof(*copy));
+            }
+        }
+        darray_free(feat);
+        if (b->n_feat && !copy) {
+            return false;
+        }
+        b->feat = copy;
+    }
+    b->idx = darray_size(ctx->grps);
+    darray_push(ctx->grps, b);
+    ctx->n_grps++;
+    return index_add(ctx, b);
+}
+
+static struct strgrp_grp *
+add_grp(struct strgrp *const ctx, const char *const str, const size_t len,
+        void *const data) {
+    const struct strgrp_query *const q = ctx->query;
+    struct strgrp_grp *b = new_grp(ctx, str, len, q->n_pop_chars);
+    int i;
+    if (!b) {
+        return NULL;
+    }
+    if (!add_item(ctx, b, str, data)) {
+        darray_free(b->items);
+        return NULL;
+    }
+    for (i = 0; i < q->n_pop_chars; i++) {
+        b->pop[i].c = q->pop_chars[i];
+        b->pop[i].n = q->pop[q->pop_chars[i]];
+    }
+    b->pop_sq = q->pop_sq;
+    if (!insert_grp(ctx, b)) {
+        return NULL;
+    }
+    return b;
+}
+
+struct strgrp *
+strgrp_new(const double threshold) {
+    struct strgrp *ctx = talz(NULL, struct strgrp);
+    ctx->threshold = threshold;
+    ctx->cos_cut = cossim_cut(threshold);
+    ctx->arena = block_pool_new(NULL);
+    // The map allocates from its own pool, parented to the arena
+    stringmap_init(ctx->known, ctx->arena);
+    // n threads compare strings
+    darray_init(ctx->grps);
+    darray_init(ctx->by_len);
+    tal_add_destructor(ctx, free_index);
+    ctx->query = new_query();
+    ctx->counters = talz(ctx, struct strgrp_counters);
+    if (!ctx->query || !ctx->counters) {
+        strgrp_free(ctx);
+        return NULL;
+    }
+    return ctx;
+}
+
+struct strgrp *
+strgrp_new_lsh(const double threshold, const int n_bands, const int n_rows) {
+    struct strgrp *ctx;
+    if (n_bands < 1 || n_rows < 1 || n_bands > LSH_MAX_HASHES / n_rows) {
+        return NULL;
+    }
+    ctx = strgrp_new(threshold);
+    if (ctx) {
+        ctx->n_bands = n_bands;
+        ctx->n_rows = n_rows;
+    }
+    return ctx;
+}
+
+/* Candidates per thread below which scoring stays serial: starting a parallel
+ * region costs more than scoring this many candidates. */
+#define PARALLEL_CANDS_PER_THREAD 64
+
+/* Candidates per chunk of the parallel scoring loop. Chunks are dealt out in
+ * turn, which spreads the runs of similar candidates left by the index across
+ * the threads without dynamic scheduling's per-chunk synchronisation. */
+#define PARALLEL_CANDS_PER_CHUNK 16
+
+/* Score the groups from index first onwards that may match str at or above
+ * threshold into q->scores, returning the number scored. The query's population and key must
+ * already be set by query_key(), and the groups are spread over up to n_threads threads if
+ * there are enough of them. Groups that can't reach the threshold may be
+ * given some lower score. If prune is set, scoring is also abandoned for groups that
+ * can't reach the best score found so far. This is enough to find the best
+ * group, but leaves the scores of the others unreliable. */
+static int
+score_cands(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const size_t len, const double threshold,
+        const bool prune, const int n_threads, const size_t first) {
+    const double cos_cut = (threshold == ctx->threshold) ?
+        ctx->cos_cut : cossim_cut(threshold);
+    const double start = seconds();
+    select_cands(ctx, q, str, len, threshold, first);
+    const double selected = seconds();
+    const int n_cands = darray_size(q->cands);
+    const int n_parallel =
+        (n_cands >= n_threads * PARALLEL_CANDS_PER_THREAD) ? n_threads : 1;
+    unsigned long n_len_rejected = 0, n_cos_rejected = 0, n_lcs = 0;
+    int i;
+    // The best score found so far by any thread when pruning. Groups that
+    // can't reach it or the threshold are abandoned early. Only scores
+    // strictly below the floor are pruned, so ties are still scored and
+    // broken as before.
+    double best = threshold;
+// Keep ccanlint happy in reduced feature mode
+#if HAVE_OPENMP
+    #pragma omp parallel for schedule(static, PARALLEL_CANDS_PER_CHUNK) \
+        num_threads(n_parallel) if(n_parallel > 1) \
+        reduction(+:n_len_rejected,n_cos_rejected,n_lcs)
+#endif
+    for (i = 0; i < n_cands; i++) {
+        struct strgrp_grp *grp = darray_item(q->cands, i);
+        q->scores[i].grp = grp;
+        q->scores[i].score = 0;
+        if (ctx->metric != STRGRP_METRIC_NLCS) {
+            // The length and cosine filters only bound the LCS
+            q->scores[i].score = feat_score(ctx, q, grp, str, len);
+            n_lcs++;
+            continue;
+        }
+        if (should_grp_score_len(threshold, grp, len)) {
+            if (should_grp_score_cos(q, grp, threshold, cos_cut)) {
+                double floor_score;
+#if HAVE_OPENMP
+                #pragma omp atomic read
+#endif
+                floor_score = best;
+                long need = darray_item(q->need_lcs, grp->key_len);
+                if (floor_score > threshold) {
+                    const long best_need =
+                        lcs_need_min(floor_score, len, grp->key_len);
+                    need = (best_need > need) ? best_need : need;
+                }
+                const double score = grp_score(grp, &q->pattern, need);
+                n_lcs++;
+                q->scores[i].score = score;
+                if (prune && score > floor_score) {
+#if HAVE_OPENMP
+                    #pragma omp critical(strgrp_best)
+#endif
+                    {
+                        if (score > best) {
+#if HAVE_OPENMP
+                            #pragma omp atomic write
+#endif
+                            best = score;
+                        }
+                    }
+                }
+            } else {
+                n_cos_rejected++;
+            }
+        } else {
+            n_len_rejected++;
+        }
+    }
+    q->stats.n_cands += n_cands;
+    q->stats.n_len_rejected += n_len_rejected;
+    q->stats.n_cos_rejected += n_cos_rejected;
+    q->stats.n_lcs += n_lcs;
+    q->stats.t_select += selected - start;
+    q->stats.t_score += seconds() - selected;
+    return n_cands;
+}
+
+double
+strgrp_threshold(const struct strgrp *const ctx) {
+    return ctx->threshold;
+}
+
+void
+strgrp_stats(const struct strgrp *const ctx, struct strgrp_stats *const stats) {
+    const struct strgrp_counters *const c = ctx->counters;
+    stats->n_grps = ctx->n_grps;
+    stats->n_items = ctx->n_items;
+    stats->n_lookups = c->n_lookups;
+    stats->n_cache_hits = c->n_cache_hits;
+    stats->n_cache_misses = c->n_cache_misses;
+    stats->n_cands = c->n_cands;
+    stats->n_len_rejected = c->n_len_rejected;
+    stats->n_cos_rejected = c->n_cos_rejected;
+    stats->n_lcs = c->n_lcs;
+    stats->t_lookup = c->t_lookup;
+    stats->t_select = c->t_select;
+    stats->t_score = c->t_score;
+}
+
+void
+strgrp_reset_stats(struct strgrp *const ctx) {
+    struct strgrp_counters *const c = ctx->counters;
+    c->n_lookups = 0;
+    c->n_cache_hits = 0;
+    c->n_cache_misses = 0;
+    c->n_cands = 0;
+    c->n_len_rejected = 0;
+    c->n_cos_rejected = 0;
+    c->n_lcs = 0;
+    c->t_lookup = 0;
+    c->t_select = 0;
+    c->t_score = 0;
+}
+
+// stringmap_lookup() records its result in the map itself, so lookups that may
+// run concurrently call through to the underlying search instead
+static inline struct strgrp_grp *
+cached(const struct strgrp *const ctx, const char *const str) {
+    const struct known_entry *const entry = stringmap_lookup_real(
+            (struct stringmap *)&ctx->known.t, str, (size_t)-1, 0,
+            sizeof(*ctx->known.last));
+    return entry ? entry->value : NULL;
+}
+
+// Find the best group for str from index first onwards, storing its score in
+// score if not NULL. The query's population must already be set.
+static struct strgrp_grp *
+best_grp(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const size_t first, const int n_threads,
+        double *const score) {
+    const size_t len = strlen(str);
+    if (!query_key(ctx, q, str, len)) {
+        return NULL;
+    }
+    const int n_cands =
+        score_cands(ctx, q, str, len, ctx->threshold, true, n_threads, first);
+    int i;
+    // Candidates are not in group order, so break ties on the group index to
+    // pick the same group as a scan over all groups would
+    struct grp_score *max = NULL;
+    for (i = 0; i < n_cands; i++) {
+        struct grp_score *const cur = &(q->scores[i]);
+        if (!max || cur->score > max->score ||
+                (cur->score == max->score && cur->grp->idx < max->grp->idx)) {
+            max = cur;
+        }
+    }
+    if (!max || max->score < ctx->threshold) {
+        return NULL;
+    }
+    if (score) {
+        *score = max->score;
+    }
+    return max->grp;
+}
+
+static struct strgrp_grp *
+search_grp(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const int n_threads) {
+    // Ensure q->pop is always populated. Returning null here indicates a new
+    // group should be created, at which point add_grp() copies q->pop into
+    // the new group's struct.
+    query_popcnt(q, str);
+    if (!ctx->n_grps) {
+        q->stats.n_cache_misses++;
+        return NULL;
+    }
+    {
+        struct strgrp_grp *const grp = cached(ctx, str);
+        if (grp) {
+            q->stats.n_cache_hits++;
+            return grp;
+        }
+        q->stats.n_cache_misses++;
+    }
+    return best_grp(ctx, q, str, 0, n_threads, NULL);
+}
+
+static struct strgrp_grp *
+grp_for(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const int n_threads) {
+    const double start = seconds();
+    struct strgrp_grp *const grp = search_grp(ctx, q, str, n_threads);
+    q->stats.n_lookups++;
+    q->stats.t_lookup += seconds() - start;
+    return grp;
+}
+
+static int
+default_threads(void) {
+#if HAVE_OPENMP
+    return omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+static int
+ctx_threads(const struct strgrp *const ctx) {
+    return ctx->n_threads ? ctx->n_threads : default_threads();
+}
+
+void
+strgrp_set_threads(struct strgrp *const ctx, const int n_threads) {
+    ctx->n_threads = (n_threads > 0) ? n_threads : 0;
+}
+
+int
+strgrp_threads(const struct strgrp *const ctx) {
+    return ctx->n_threads;
+}
+
+struct strgrp_query *
+strgrp_query_new(void) {
+    return new_query();
+}
+
+void
+strgrp_query_free(struct strgrp_query *const q) {
+    free_query(q);
+}
+
+const struct strgrp_grp *
+strgrp_grp_for_query(const struct strgrp *const ctx,
+        struct strgrp_query *const q, const char *const str) {
+    const struct strgrp_grp *const grp =
+        grp_for(ctx, q, normalise(ctx, q, str), ctx_threads(ctx));
+    stats_fold(ctx, q);
+    return grp;
+}
+
+const struct strgrp_grp *
+strgrp_grp_for(struct strgrp *const ctx, const char *const str) {
+    return strgrp_grp_for_query(ctx, ctx->query, str);
+}
+
+// Batch lookups hand each thread whole queries once there are enough to keep
+// the threads busy, as this avoids synchronising within each lookup. Smaller
+// batches share each lookup's candidates between the threads instead, where
+// there are enough of them for that to pay.
+#define BATCH_QUERIES_PER_THREAD 4
+
+// The queries are allocated for each call rather than taken from the
+// instance, so batches may run concurrently with other lookups
+bool
+strgrp_grp_for_many(const struct strgrp *const ctx,
+        const char *const *const strs, const size_t n,
+        const struct strgrp_grp **const grps, int n_threads) {
+    struct strgrp_query **queries;
+    int n_queries;
+    long i;
+    if (n_threads <= 0) {
+        n_threads = ctx_threads(ctx);
+    }
+    n_queries = (n_threads == 1 ||
+            n < (size_t)n_threads * BATCH_QUERIES_PER_THREAD) ? 1 : n_threads;
+    queries = calloc(n_queries, sizeof(*queries));
+    if (!queries) {
+        return false;
+    }
+    for (i = 0; i < n_queries; i++) {
+        queries[i] = new_query();
+        if (!queries[i]) {
+            break;
+        }
+    }
+    if (i < n_queries) {
+        while (i--) {
+            free_query(queries[i]);
+        }
+        free(queries);
+        return false;
+    }
+    if (n_queries == 1) {
+        for (i = 0; i < (long)n; i++) {
+            grps[i] = grp_for(ctx, queries[0],
+                    normalise(ctx, queries[0], strs[i]), n_threads);
+        }
+    } else {
+#if HAVE_OPENMP
+        #pragma omp parallel for schedule(dynamic) num_threads(n_queries)
+#endif
+        for (i = 0; i < (long)n; i++) {
+#if HAVE_OPENMP
+            struct strgrp_query *const q = queries[omp_get_thread_num()];
+#else
+            struct strgrp_query *const q = queries[0];
+#endif
+            grps[i] = grp_for(ctx, q, normalise(ctx, q, strs[i]), 1);
+        }
+    }
+    for (i = 0; i < n_queries; i++) {
+        stats_fold(ctx, queries[i]);
+        free_query(queries[i]);
+    }
+    free(queries);
+    return true;
+}
+
+// Order by descending score, then by creation to match grp_for()
+static int
+grp_score_cmp(const void *a, const void *b) {
+    const struct grp_score *const sa = a;
+    const struct grp_score *const sb = b;
+    if (sa->score != sb->score) {
+        return (sa->score < sb->score) ? 1 : -1;
+    }
+    return (sa->grp->idx > sb->grp->idx) - (sa->grp->idx < sb->grp->idx);
+}
+
+static size_t
+rank_grps(const struct strgrp *const ctx, struct strgrp_query *const q,
+        const char *const str, const double threshold,
+        const struct strgrp_grp **const grps, double *const scores,
+        const size_t n) {
+    size_t n_match = 0;
+    size_t i;
+    query_popcnt(q, str);
+    if (!ctx->n_grps) {
+        return 0;
+    }
+    const size_t len = strlen(str);
+    if (!query_key(ctx, q, str, len)) {
+        return 0;
+    }
+    const size_t n_cands =
+        score_cands(ctx, q, str, len, threshold, false, ctx_threads(ctx), 0);
+    for (i = 0; i < n_cands; i++) {
+        if (q->scores[i].score >= threshold) {
+            q->scores[n_match++] = q->scores[i];
+        }
+    }
+    qsort(q->scores, n_match, sizeof(*q->scores), grp_score_cmp);
+    for (i = 0; i < n_match && i < n; i++) {
+        grps[i] = q->scores[i].grp;
+        scores[i] = q->scores[i].score;
+    }
+    return n_match;
+}
+
+size_t
+strgrp_grps_for_query(const struct strgrp *const ctx,
+        struct strgrp_query *const q, const char *const str,
+        const double threshold, const struct strgrp_grp **const grps,
+        double *const scores, const size_t n) {
+    const double start = seconds();
+    const size_t n_match = rank_grps(ctx, q, normalise(ctx, q, str),
+            threshold, grps, scores, n);
+    q->stats.n_lookups++;
+    q->stats.t_lookup += seconds() - start;
+    stats_fold(ctx, q);
+    return n_match;
+}
+
+size_t
+strgrp_grps_for(struct strgrp *const ctx, const char *const str,
+        const double threshold, const struct strgrp_grp **const grps,
+        double *const scores, const size_t n) {
+    return strgrp_grps_for_query(ctx, ctx->query, str, threshold, grps,
+            scores, n);
+}
+
+const struct strgrp_grp *
+strgrp_add(struct strgrp *const ctx, const char *const str,
+        void *const data) {
+    bool inserted = false;
+    const char *const key = normalise(ctx, ctx->query, str);
+    // grp_for() populates the ctx->query->pop memory. add_grp() copies this
+    // memory into the strgrp_grp that it creates. It's assumed the pop memory
+    // has not been modified between the grp_for() and add_grp() calls.
+    struct strgrp_grp *pick = grp_for(ctx, ctx->query, key, ctx_threads(ctx));
+    struct known_entry *const entry = intern(ctx, key, (size_t)-1);
+    stats_fold(ctx, ctx->query);
+    if (!entry) {
+        return NULL;
+    }
+    if (pick) {
+        inserted = add_item(ctx, pick, entry->str, data);
+    } else {
+        pick = add_grp(ctx, entry->str, entry->len, data);
+        inserted = (NULL != pick);
+    }
+    if (inserted) {
+        assert(NULL != pick);
+        entry->value = pick;
+    }
+    return pick;
+}
+
+/* Bulk additions
+ *
+ * Adding keys one at a time is inherently sequential, as each lookup depends
+ * on the groups created by the additions before it. However a group is scored
+ * by its key alone, so a lookup made against the groups present at some
+ * earlier point remains valid for those groups, and only the groups created
+ * since need to be checked. strgrp_add_many() first interns the keys, leaving
+ * a lookup for each distinct key not yet added. The distinct keys are then
+ * looked up in batches, in parallel against the groups present before the
+ * batch, and the result for each key is settled in order against the groups
+ * created by the keys before it in the batch. Groups are created in the same
+ * order and ties are broken towards the earlier group, so the outcome is
+ * exactly that of adding the keys one at a time, for any number of threads.
+ */
+
+// Distinct keys looked up by each thread per batch. Larger batches keep the
+// threads busier, but leave more of the groups they create to be checked
+// serially.
+#define BULK_KEYS_PER_THREAD 16
+
+struct bulk_key {
+    struct known_entry *entry;
+    // The index of the key's first occurrence
+    size_t at;
+    // The best group before the key's batch, and its score
+    struct strgrp_grp *grp;
+    double score;
+};
+
+// Marks the entries of the distinct keys until their group is settled
+static char bulk_pending;
+
+bool
+strgrp_add_many(struct strgrp *const ctx, const char *const *const strs,
+        void *const *const data, const size_t n,
+        const struct strgrp_grp **const grps) {
+    struct strgrp_grp *const pending = (struct strgrp_grp *)&bulk_pending;
+    struct known_entry **const entries = malloc((n ? n : 1) * sizeof(*entries));
+    struct bulk_key *const keys = malloc((n ? n : 1) * sizeof(*keys));
+    struct strgrp_query **queries = NULL;
+    struct strgrp_query *const q = ctx->query;
+    const int n_threads = ctx_threads(ctx);
+    int n_queries = 0;
+    size_t n_keys = 0, n_batch, i, j;
+    bool ok = false;
+    for (i = 0; i < n; i++) {
+        grps[i] = NULL;
+    }
+    if (!entries || !keys) {
+        goto out;
+    }
+    for (i = 0; i < n; i++) {
+        struct known_entry *const entry =
+            intern(ctx, normalise(ctx, q, strs[i]), (size_t)-1);
+        if (!entry) {
+            goto out;
+        }
+        entries[i] = entry;
+        if (!entry->value) {
+            entry->value = pending;
+            keys[n_keys].entry = entry;
+            keys[n_keys].at = i;
+            n_keys++;
+        }
+    }
+    // Later occurrences are answered by the keys added before them
+    q->stats.n_lookups += n - n_keys;
+    q->stats.n_cache_hits += n - n_keys;
+    n_queries = (n_threads == 1 ||
+            n_keys < (size_t)n_threads * BULK_KEYS_PER_THREAD) ? 1 : n_threads;
+    n_batch = (n_queries == 1) ? 1 : (size_t)n_queries * BULK_KEYS_PER_THREAD;
+    queries = calloc(n_queries, sizeof(*queries));
+    if (!queries) {
+        goto out;
+    }
+    for (j = 0; j < (size_t)n_queries; j++) {
+        if (!(queries[j] = new_query())) {
+            goto out;
+        }
+    }
+    for (i = 0; i < n_keys; i += n_batch) {
+        const size_t first = darray_size(ctx->grps);
+        const size_t end = (i + n_batch < n_keys) ? i + n_batch : n_keys;
+        long k;
+#if HAVE_OPENMP
+        #pragma omp parallel for schedule(dynamic) num_threads(n_queries) \
+            if(n_queries > 1)
+#endif
+        for (k = i; k < (long)end; k++) {
+#if HAVE_OPENMP
+            struct strgrp_query *const kq = queries[omp_get_thread_num()];
+#else
+            struct strgrp_query *const kq = queries[0];
+#endif
+            struct bulk_key *const key = &keys[k];
+            const double start = seconds();
+            query_popcnt(kq, key->entry->str);
+            key->grp = ctx->n_grps ?
+                best_grp(ctx, kq, key->entry->str, 0, 1, &key->score) : NULL;
+            kq->stats.n_lookups++;
+            kq->stats.n_cache_misses++;
+            kq->stats.t_lookup += seconds() - start;
+        }
+        for (j = i; j < end; j++) {
+            struct bulk_key *const key = &keys[j];
+            struct strgrp_grp *pick = key->grp;
+            if (darray_size(ctx->grps) > first) {
+                const double start = seconds();
+                double score;
+                struct strgrp_grp *recent;
+                query_popcnt(q, key->entry->str);
+                recent = best_grp(ctx, q, key->entry->str, first, 1, &score);
+                if (recent && (!pick || score > key->score)) {
+                    pick = recent;
+                }
+                q->stats.t_lookup += seconds() - start;
+            }
+            if (!pick) {
+                // add_grp() takes the key's population from ctx->query
+                query_popcnt(q, key->entry->str);
+                pick = add_grp(ctx, key->entry->str, key->entry->len,
+                        data[key->at]);
+                if (!pick) {
+                    goto out;
+                }
+                grps[key->at] = pick;
+            }
+            key->entry->value = pick;
+        }
+    }
+    // Add the remaining items in order, so each group's items are too
+    for (i = 0; i < n; i++) {
+        if (grps[i]) {
+            continue;
+        }
+        if (!add_item(ctx, entries[i]->value, entries[i]->str, data[i])) {
+            goto out;
+        }
+        grps[i] = entries[i]->value;
+    }
+    ok = true;
+
+out:
+    // Keys without an item after a failure are left as if never added
+    for (j = 0; j < n_keys; j++) {
+        if (keys[j].entry->value == pending || !grps[keys[j].at]) {
+            keys[j].entry->value = NULL;
+        }
+    }
+    for (j = 0; queries && j < (size_t)n_queries; j++) {
+        if (queries[j]) {
+            stats_fold(ctx, queries[j]);
+            free_query(queries[j]);
+        }
+    }
+    stats_fold(ctx, q);
+    free(queries);
+    free(keys);
+    free(entries);
+    return ok;
+}
+
+/* Removal */
+
+// Compact grps once the gaps left by removed groups outnumber the groups, plus
+// some slack so small instances aren't compacted on every removal
+#define GRPS_SLACK 64
+
+static void
+qgram_index_remove(struct strgrp *const ctx,
+        const struct strgrp_grp *const grp) {
+    struct qgram_count *qc;
+    size_t i, n;
+    qgram_profile(ctx, grp->key, grp->key_len, grp->feat, grp->n_feat,
+            &ctx->query->profile);
+    darray_foreach(qc, ctx->query->profile) {
+        darray_posting *const postings = &ctx->qgrams[qc->bucket];
+        for (i = n = 0; i < darray_size(*postings); i++) {
+            if (darray_item(*postings, i).idx != grp->idx) {
+                darray_item(*postings, n++) = darray_item(*postings, i);
+            }
+        }
+        darray_resize(*postings, n);
+    }
+}
+
+static void
+index_remove(struct strgrp *const ctx, const struct strgrp_grp *const grp) {
+    darray_grp *const by_len = &darray_item(ctx->by_len, grp_size(ctx, grp));
+    size_t i, n;
+    if (ctx->n_bands) {
+        lsh_index_remove(ctx, grp);
+    } else {
+        qgram_index_remove(ctx, grp);
+    }
+    for (i = n = 0; i < darray_size(*by_len); i++) {
+        if (darray_item(*by_len, i) != grp) {
+            darray_item(*by_len, n++) = darray_item(*by_len, i);
+        }
+    }
+    darray_resize(*by_len, n);
+}
+
+// Close the gaps left in grps by removed groups, renumbering the remaining
+// groups and their postings. Group order is preserved.
+static void
+compact_grps(struct strgrp *const ctx) {
+    uint32_t *const remap = tal_arr(ctx, uint32_t, darray_size(ctx->grps));
+    struct qgram_posting *p;
+    struct lsh_posting *lp;
+    size_t i, n = 0;
+    if (!remap) {
+        // The gaps are harmless, so try again on a later removal
+        return;
+    }
+    for (i = 0; i < darray_size(ctx->grps); i++) {
+        struct strgrp_grp *const grp = darray_item(ctx->grps, i);
+        if (grp) {
+            remap[i] = grp->idx = n;
+            darray_item(ctx->grps, n++) = grp;
+        }
+    }
+    darray_resize(ctx->grps, n);
+    for (i = 0; ctx->qgrams && i < QGRAM_N_BUCKETS; i++) {
+        darray_foreach(p, ctx->qgrams[i]) {
+            p->idx = remap[p->idx];
+        }
+    }
+    for (i = 0; ctx->lsh && i < LSH_N_BUCKETS; i++) {
+        darray_foreach(lp, ctx->lsh[i]) {
+            lp->idx = remap[lp->idx];
+        }
+    }
+    tal_free(remap);
+}
+
+// Groups are allocated from the arena, so the struct remains readable as an
+// empty group through any outstanding pointers
+static void
+remove_grp(struct strgrp *const ctx, struct strgrp_grp *const grp) {
+    index_remove(ctx, grp);
+    darray_item(ctx->grps, grp->idx) = NULL;
+    ctx->n_grps--;
+    darray_free(grp->items);
+    darray_init(grp->items);
+    if (darray_size(ctx->grps) > 2 * ctx->n_grps + GRPS_SLACK) {
+        compact_grps(ctx);
+    }
+}
+
+bool
+strgrp_remove(struct strgrp *const ctx, const char *const str,
+        int (*match)(void *data, void *arg), void *const arg,
+        void **const data) {
+    struct known_entry *const entry = stringmap_lookup_real(&ctx->known.t,
+            normalise(ctx, ctx->query, str), (size_t)-1, 0,
+            sizeof(*ctx->known.last));
+    struct strgrp_grp *grp;
+    struct strgrp_item *item = NULL;
+    size_t i, at = 0;
+    if (!entry || !(grp = entry->value)) {
+        return false;
+    }
+    // Keys are interned, so the group's items for str share its pointer
+    for (i = 0; !item && i < darray_size(grp->items); i++) {
+        struct strgrp_item *const cur = darray_item(grp->items, i);
+        if (cur->key == entry->str) {
+            const int rc = match ? match(cur->value, arg) : 1;
+            if (rc < 0) {
+                return false;
+            }
+            if (rc) {
+                item = cur;
+                at = i;
+            }
+        }
+    }
+    if (!item) {
+        return false;
+    }
+    if (data) {
+        *data = item->value;
+    }
+    // Like groups, removed items stay readable, but no longer hold the data
+    item->value = NULL;
+    memmove(&grp->items.item[at], &grp->items.item[at + 1],
+            (darray_size(grp->items) - at - 1) * sizeof(*grp->items.item));
+    darray_resize(grp->items, darray_size(grp->items) - 1);
+    grp->n_items--;
+    ctx->n_items--;
+    // Keep str cached only while the group holds another item for it
+    entry->value = NULL;
+    for (i = 0; i < darray_size(grp->items); i++) {
+        if (darray_item(grp->items, i)->key == entry->str) {
+            entry->value = grp;
+            break;
+        }
+    }
+    if (!grp->n_items) {
+        remove_grp(ctx, grp);
+    }
+    return true;
+}
+
+/* Serialisation
+ *
+ * Integers are little-endian and strings are NUL-terminated:
+ *
+ *     "SGRP" u32:version u64:threshold u16:n_bands u16:n_rows u8:metric
+ *     u8:norm_flags u32:n_stop n_stop * { str:phrase } u32:n_grps
+ *     n_grps * {
+ *         str:key u16:n_pop n_pop * { u8:char u16:count }
+ *         u32:n_items n_items * { str:key }
+ *     }
+ *
+ * The threshold is stored as the bit pattern of the double, and n_bands is 0
+ * for instances using the q-gram index. The metric is the strgrp_metric value.
+ * Keys are saved normalised, along with
+ * the flags and stop phrases as they were given to strgrp_set_normalise().
+ * Version 1 lacks n_bands and n_rows, and is loaded as an instance using the
+ * q-gram index. Versions 1 and 2 lack the normalisation, and are loaded as
+ * instances using keys as given. Versions 1 to 3 lack the metric, and are
+ * loaded as instances using STRGRP_METRIC_NLCS. Item values are opaque to strgrp and are not
+ * serialised; strgrp_load() takes them in group, then item iteration order.
+ */
+
+#define STRGRP_MAGIC "SGRP"
+#define STRGRP_MAGIC_LEN 4
+#define STRGRP_VERSION 4
+
+typedef darray(unsigned char) darray_byte;
+
+struct reader {
+    const unsigned char *pos;
+    const unsigned char *end;
+};
+
+static void
+put_uint(darray_byte *const buf, uint64_t v, const size_t n) {
+    size_t i;
+    for (i = 0; i < n; i++) {
+        darray_push(*buf, v & 0xff);
+        v >>= 8;
+    }
+}
+
+static void
+put_str(darray_byte *const buf, const char *const str, const size_t len) {
+    darray_append_items(*buf, (const unsigned char *)str, len + 1);
+}
+
+static bool
+get_uint(struct reader *const r, uint64_t *const v, const size_t n) {
+    size_t i;
+    if ((size_t)(r->end - r->pos) < n) {
+        return false;
+    }
+    *v = 0;
+    for (i = n; i > 0; i--) {
+        *v = (*v << 8) | r->pos[i - 1];
+    }
+    r->pos += n;
+    return true;
+}
+
+static const char *
+get_str(struct reader *const r, size_t *const len) {
+    const unsigned char *const str = r->pos;
+    const unsigned char *const nul = memchr(str, '\0', r->end - str);
+    if (!nul) {
+        return NULL;
+    }
+    *len = nul - str;
+    r->pos = nul + 1;
+    return (const char *)str;
+}
+
+void *
+strgrp_save(const struct strgrp *const ctx, size_t *const len) {
+    darray_byte buf = darray_new();
+    struct strgrp_grp *const *grp;
+    struct strgrp_item *const *item;
+    uint64_t bits;
+    size_t i;
+    memcpy(&bits, &ctx->threshold, sizeof(bits));
+    darray_append_items(buf, (const unsigned char *)STRGRP_MAGIC,
+            STRGRP_MAGIC_LEN);
+    put_uint(&buf, STRGRP_VERSION, 4);
+    put_uint(&buf, bits, 8);
+    put_uint(&buf, ctx->n_bands, 2);
+    put_uint(&buf, ctx->n_rows, 2);
+    put_uint(&buf, ctx->metric, 1);
+    put_uint(&buf, ctx->norm ? ctx->norm->flags : 0, 1);
+    put_uint(&buf, ctx->norm ? ctx->norm->n_stop : 0, 4);
+    for (i = 0; ctx->norm && i < ctx->norm->n_stop; i++) {
+        put_str(&buf, ctx->norm->stop[i], strlen(ctx->norm->stop[i]));
+    }
+    put_uint(&buf, ctx->n_grps, 4);
+    darray_foreach(grp, ctx->grps) {
+        if (!*grp) {
+            continue;
+        }
+        put_str(&buf, (*grp)->key, (*grp)->key_len);
+        put_uint(&buf, (*grp)->n_pop, 2);
+        for (i = 0; i < (*grp)->n_pop; i++) {
+            put_uint(&buf, (*grp)->pop[i].c, 1);
+            put_uint(&buf, (uint16_t)(*grp)->pop[i].n, 2);
+        }
+        put_uint(&buf, (*grp)->n_items, 4);
+        darray_foreach(item, (*grp)->items) {
+            put_str(&buf, (*item)->key, strlen((*item)->key));
+        }
+    }
+    *len = darray_size(buf);
+    return buf.item;
+}
+
+struct strgrp *
+strgrp_load(const void *const buf, const size_t len,
+        void *const *const values, const size_t n_values) {
+    struct reader r = { buf, (const unsigned char *)buf + len };
+    struct strgrp *ctx;
+    const char *key;
+    size_t key_len;
+    size_t n_used = 0;
+    uint64_t version, bits, n_bands = 0, n_rows = 0, n_grps, n_pop, n_items;
+    uint64_t metric = STRGRP_METRIC_NLCS, flags = 0, n_stop = 0;
+    const char **stop = NULL;
+    uint64_t c, count;
+    double threshold;
+    uint64_t i, j;
+    if (len < STRGRP_MAGIC_LEN || memcmp(buf, STRGRP_MAGIC, STRGRP_MAGIC_LEN)) {
+        return NULL;
+    }
+    r.pos += STRGRP_MAGIC_LEN;
+    if (!get_uint(&r, &version, 4) || !version || version > STRGRP_VERSION) {
+        return NULL;
+    }
+    if (!get_uint(&r, &bits, 8)) {
+        return NULL;
+    }
+    if (version > 1 && (!get_uint(&r, &n_bands, 2) || !get_uint(&r, &n_rows, 2))) {
+        return NULL;
+    }
+    if (version > 3 && !get_uint(&r, &metric, 1)) {
+        return NULL;
+    }
+    if (version > 2 && (!get_uint(&r, &flags, 1) || !get_uint(&r, &n_stop, 4))) {
+        return NULL;
+    }
+    // Each phrase takes at least two bytes
+    if (n_stop > (size_t)(r.end - r.pos) / 2) {
+        return NULL;
+    }
+    memcpy(&threshold, &bits, sizeof(threshold));
+    ctx = n_bands ?
+        strgrp_new_lsh(threshold, n_bands, n_rows) : strgrp_new(threshold);
+    if (!ctx) {
+        return NULL;
+    }
+    if (!strgrp_set_metric(ctx, metric)) {
+        goto fail;
+    }
+    if (n_stop && !(stop = tal_arr(ctx, const char *, n_stop))) {
+        goto fail;
+    }
+    for (i = 0; i < n_stop; i++) {
+        if (!(stop[i] = get_str(&r, &key_len))) {
+            goto fail;
+        }
+    }
+    if (!strgrp_set_normalise(ctx, flags, stop, n_stop)) {
+        goto fail;
+    }
+    tal_free(stop);
+    if (!get_uint(&r, &n_grps, 4)) {
+        goto fail;
+    }
+    for (i = 0; i < n_grps; i++) {
+        struct strgrp_grp *grp;
+        struct known_entry *entry;
+        if (!(key = get_str(&r, &key_len)) || !get_uint(&r, &n_pop, 2)) {
+            goto fail;
+        }
+        if (n_pop > CHAR_N_VALUES || !(entry = intern(ctx, key, key_len))) {
+            goto fail;
+        }
+        // Allocated from the arena, so released by strgrp_free() on failure
+        grp = new_grp(ctx, entry->str, key_len, n_pop);
+        if (!grp) {
+            goto fail;
+        }
+        for (j = 0; j < n_pop; j++) {
+            if (!get_uint(&r, &c, 1) || !get_uint(&r, &count, 2)) {
+                goto fail;
+            }
+            // Counts are saved once per character, in ascending order
+            if (j && c <= grp->pop[j - 1].c) {
+                goto fail;
+            }
+            grp->pop[j].c = c;
+            grp->pop[j].n = (int16_t)count;
+        }
+        grp->pop_sq = strpopsq(grp->pop, grp->n_pop);
+        // Added before the items so strgrp_free() releases them on failure
+        if (!insert_grp(ctx, grp)) {
+            goto fail;
+        }
+        if (!get_uint(&r, &n_items, 4) || !n_items) {
+            goto fail;
+        }
+        for (j = 0; j < n_items; j++) {
+            if (n_used == n_values || !(key = get_str(&r, &key_len))) {
+                goto fail;
+            }
+            if (!(entry = intern(ctx, key, key_len))) {
+                goto fail;
+            }
+            if (!add_item(ctx, grp, entry->str, values[n_used++])) {
+                goto fail;
+            }
+            // A key is only ever cached against the first group it joined
+            if (!entry->value) {
+                entry->value = grp;
+            }
+        }
+    }
+    if (n_used != n_values || r.pos != r.end) {
+        goto fail;
+    }
+    return ctx;
+
+fail:
+    strgrp_free(ctx);
+    return NULL;
+}
+
+struct strgrp_iter *
+strgrp_iter_new(struct strgrp *const ctx) {
+    struct strgrp_iter *iter = talz(ctx, struct strgrp_iter);
+    if (!iter) {
+        return NULL;
+    }
+    iter->ctx = ctx;
+    iter->i = 0;
+    return iter;
+}
+
+const struct strgrp_grp *
+strgrp_iter_next(struct strgrp_iter *const iter) {
+    const darray_grp *const grps = &iter->ctx->grps;
+    while ((size_t)iter->i < darray_size(*grps)) {
+        const struct strgrp_grp *const grp = darray_item(*grps, iter->i++);
+        if (grp) {
+            return grp;
+        }
+    }
+    return NULL;
+}
+
+void
+strgrp_iter_free(struct strgrp_iter *const iter) {
+    tal_free(iter);
+}
+
+struct strgrp_grp_iter *
+strgrp_grp_iter_new(const struct strgrp_grp *const grp) {
+    struct strgrp_grp_iter *iter = talz(NULL, struct strgrp_grp_iter);
+    if (!iter) {
+        return NULL;
+    }
+    iter->grp = grp;
+    iter->i = 0;
+    return iter;
+}
+
+const struct strgrp_item *
+strgrp_grp_iter_next(struct strgrp_grp_iter *const iter) {
+    return (iter->grp->n_items <= iter->i) ?
+        NULL : darray_item(iter->grp->items, iter->i++);
+}
+
+void
+strgrp_grp_iter_free(struct strgrp_grp_iter *iter) {
+    tal_free(iter);
+}
+
+const char *
+strgrp_grp_key(const struct strgrp_grp *const grp) {
+    return grp->key;
+}
+
+const char *
+strgrp_item_key(const struct strgrp_item *const item) {
+    return item->key;
+}
+
+void *
+strgrp_item_value(const struct strgrp_item *const item) {
+    return item->value;
+}
+
+void
+strgrp_free(struct strgrp *const ctx) {
+    struct strgrp_grp **grp;
+    darray_foreach(grp, ctx->grps) {
+        if (*grp) {
+            darray_free((*grp)->items);
+        }
+    }
+    darray_free(ctx->grps);
+    // Also releases the pool of known
+    block_pool_free(ctx->arena);
+    free_query(ctx->query);
+    tal_free(ctx);
+}
+
+void
+strgrp_free_cb(struct strgrp *const ctx, void (*cb)(void *data)) {
+    struct strgrp_grp **grp;
+    struct strgrp_item **item;
+    darray_foreach(grp, ctx->grps) {
+        if (!*grp) {
+            continue;
+        }
+        darray_foreach(item, (*grp)->items) {
+            cb((*item)->value);
+        }
+    }
+    strgrp_free(ctx);
+}
+
+static void
+print_item(const struct strgrp_item *item) {
+    printf("\t%s\n", item->key);
+}
 
 static void
 print_grp(const struct strgrp_grp *const grp) {
@@ -437,6 +2758,8 @@ void
 strgrp_print(const struct strgrp *const ctx) {
     struct strgrp_grp **grp;
     darray_foreach(grp, ctx->grps) {
-        print_grp(*grp);
+        if (*grp) {
+            print_grp(*grp);
+        }
     }
 }
@@ -3,12 +3,23 @@
 #ifndef STRGRP_H
 #define STRGRP_H
 #include <stdbool.h>
+#include <stddef.h>
 
 struct strgrp;
 struct strgrp_iter;
 struct strgrp_grp;
 struct strgrp_grp_iter;
 struct strgrp_item;
+struct strgrp_query;
+
+/*
+ * Concurrency: strgrp_grp_for_query(), strgrp_grps_for_query(),
+ * strgrp_grp_for_many(), the iterators, the accessors and strgrp_stats() only
+ * read the instance, and may be called concurrently from any number of threads
+ * provided each thread passes its own query. All other functions, including
+ * strgrp_grp_for() and strgrp_grps_for() which use scratch space held by the
+ * instance, require exclusive access.
+ */
 
 /**
  * Constructs a new strgrp instance.
@@ -22,6 +33,228 @@ struct strgrp_item;
 struct strgrp *
 strgrp_new(double threshold);
 
+/**
+ * Constructs a new strgrp instance selecting candidate groups approximately.
+ * @threshold: A value in [0.0, 1.0] describing the desired similarity of
+ *     strings in a cluster
+ * @n_bands: The number of bands of the MinHash signatures
+ * @n_rows: The number of hashes in each band
+ *
+ * strgrp_new() scores every group that can reach the threshold, and while an
+ * index avoids scoring most of them the cost of each lookup still grows with
+ * the number of groups. Instead, this instance indexes groups by bands of a
+ * MinHash signature over the trigrams of their keys, and only scores groups
+ * sharing a band with the lookup key. Lookups then cost roughly the same
+ * regardless of the number of groups, but may miss the best group, in which
+ * case the key joins a lesser group scoring at or above the threshold or
+ * starts a new group. No key is ever placed in a group scoring below the
+ * threshold.
+ *
+ * More bands find more of the matching groups at the cost of more hashing and
+ * index memory. More rows reduce the number of unrelated groups scored but
+ * miss more matching groups. Adding the 463 descriptions of
+ * examples/transactions.csv at a threshold of 0.85:
+ *
+ *     n_bands  n_rows  groups  pair precision  pair recall  candidates
+ *     exact    exact   28      1.000           1.000        649
+ *     32       2       28      1.000           1.000        523
+ *     32       4       28      1.000           1.000        242
+ *     16       4       29      0.999           0.998        215
+ *     8        4       39      0.998           0.974        182
+ *     8        8       69      0.993           0.920        122
+ *
+ * Pair precision is the fraction of the pairs of descriptions grouped together
+ * that the exact instance also groups together, pair recall is the fraction
+ * of the exact instance's pairs that are also grouped together, and
+ * candidates is the number of groups scored over all of the additions.
+ *
+ * @return A heap-allocated strgrp instance, or NULL if n_bands or n_rows is
+ * less than 1, there are more than 1024 hashes in total, or initialisation
+ * fails. The instance must be freed with strgrp_free.
+ */
+struct strgrp *
+strgrp_new_lsh(double threshold, int n_bands, int n_rows);
+
+/**
+ * Extract the similarity threshold of a strgrp instance.
+ * @ctx: The strgrp instance in question
+ */
+double
+strgrp_threshold(const struct strgrp *ctx);
+
+/**
+ * Set the number of threads a strgrp instance scores candidates with.
+ * @ctx: The strgrp instance in question
+ * @n_threads: The maximum number of threads, or 0 for the OpenMP default
+ *
+ * Lookups that select few candidates are scored serially regardless, as
+ * starting the threads would cost more than it saves.
+ */
+void
+strgrp_set_threads(struct strgrp *ctx, int n_threads);
+
+/**
+ * Extract the number of threads a strgrp instance scores candidates with.
+ * @ctx: The strgrp instance in question
+ *
+ * @return The thread count set by strgrp_set_threads(), or 0 if the OpenMP
+ * default is used.
+ */
+int
+strgrp_threads(const struct strgrp *ctx);
+
+/**
+ * Similarity measures for scoring string keys against groups.
+ * @STRGRP_METRIC_NLCS: The length of the longest common subsequence,
+ *     normalised by the root mean square of the key lengths. The default.
+ * @STRGRP_METRIC_JACCARD: The Jaccard similarity of the sets of
+ *     whitespace-separated tokens of the keys
+ * @STRGRP_METRIC_DICE: The Dice coefficient of the multisets of character
+ *     bigrams of the keys
+ *
+ * The token and bigram measures compare sorted features computed once per
+ * key, and so cost far less to score than the LCS. Keys without a token or
+ * bigram are similar only to themselves.
+ */
+enum strgrp_metric {
+    STRGRP_METRIC_NLCS,
+    STRGRP_METRIC_JACCARD,
+    STRGRP_METRIC_DICE,
+};
+
+/**
+ * Set the similarity measure of a strgrp instance.
+ * @ctx: The strgrp instance in question, which must not yet hold any items
+ * @metric: The measure to score keys against groups with
+ *
+ * @return true if the measure was set, or false if the instance holds items
+ * or metric is unknown.
+ */
+bool
+strgrp_set_metric(struct strgrp *ctx, enum strgrp_metric metric);
+
+/**
+ * Extract the similarity measure of a strgrp instance.
+ * @ctx: The strgrp instance in question
+ */
+enum strgrp_metric
+strgrp_metric(const struct strgrp *ctx);
+
+// Normalisations of string keys, for strgrp_set_normalise()
+#define STRGRP_NORM_UPPER (1 << 0)
+#define STRGRP_NORM_COLLAPSE (1 << 1)
+
+/**
+ * Normalise the string keys passed to a strgrp instance.
+ * @ctx: The strgrp instance in question, which must not yet hold any items
+ * @flags: STRGRP_NORM_UPPER folds ASCII letters to upper case, and
+ *     STRGRP_NORM_COLLAPSE replaces each run of ASCII whitespace, as Python's
+ *     str.split() sees it, with a single space and removes leading and
+ *     trailing whitespace. See strgrp_set_fold() for keys beyond ASCII.
+ * @stop: Phrases replaced by a space wherever they occur in a key. The
+ *     phrases match case-sensitively and must not be empty, and the strings
+ *     are copied.
+ * @n_stop: The number of elements in stop
+ *
+ * Keys are normalised by strgrp_add(), strgrp_remove() and the lookup
+ * functions before they are used, and the groups and items hold the
+ * normalised keys. Stop phrases are matched against the key as given, before
+ * the flags are applied, all at once, and where matches overlap the leftmost
+ * is replaced, preferring the longest of those starting at the same
+ * character. Removing a stop phrase may join its neighbours into another,
+ * which is not then removed.
+ *
+ * @return true if the normalisation was set, or false if the instance holds
+ * items, flags holds unknown bits, a stop phrase is empty or allocation
+ * fails, in which case the previous normalisation remains.
+ */
+bool
+strgrp_set_normalise(struct strgrp *ctx, unsigned int flags,
+        const char *const *stop, size_t n_stop);
+
+/**
+ * Normalise a key holding bytes outside ASCII, for strgrp_set_fold()
+ * @str: The key, valid UTF-8 with its stop phrases replaced
+ * @flags: The flags given to strgrp_set_normalise()
+ * @arg: The argument given to strgrp_set_fold()
+ *
+ * @return The key with its case folded and whitespace collapsed as flags
+ * requires, in memory from malloc() which strgrp frees, or NULL to fold only
+ * the key's ASCII characters.
+ */
+typedef char *strgrp_fold_fn(const char *str, unsigned int flags, void *arg);
+
+/**
+ * Fold case and collapse whitespace beyond ASCII with a function of the
+ * caller's
+ * @ctx: The strgrp instance in question
+ * @fold: Called for keys still holding bytes outside ASCII once their stop
+ *     phrases are replaced, if any flags are set, or NULL to treat them as
+ *     any other key. It may be called from several threads at once.
+ * @arg: Passed to fold
+ *
+ * strgrp's own folding knows only ASCII letters and whitespace, so a caller
+ * wanting Unicode case and whitespace rules supplies them here. The function
+ * is not saved, so set it on a loaded instance before using it.
+ */
+void
+strgrp_set_fold(struct strgrp *ctx, strgrp_fold_fn *fold, void *arg);
+
+/**
+ * Counters describing the work done by lookups against a strgrp instance.
+ * @n_grps: The number of groups
+ * @n_items: The number of items
+ * @n_lookups: Lookups of a string key, whether to add it or only to find its
+ *     group
+ * @n_cache_hits: Lookups for a group answered from the keys already added,
+ *     without scoring
+ * @n_cache_misses: Lookups for a group of keys not yet added, which go on to
+ *     score candidates. strgrp_grps_for() scores candidates without
+ *     consulting the added keys, so is counted as neither a hit nor a miss.
+ * @n_cands: Groups selected for filtering by the q-gram index
+ * @n_len_rejected: Candidates rejected by the key length filter
+ * @n_cos_rejected: Candidates rejected by the character cosine filter
+ * @n_lcs: Candidates passing both filters and so scored by LCS, or for
+ *     measures other than STRGRP_METRIC_NLCS, which skip the filters, all
+ *     candidates
+ * @t_lookup: Seconds spent in lookups, including the following phases
+ * @t_select: Seconds spent selecting candidates
+ * @t_score: Seconds spent filtering and scoring candidates
+ *
+ * The group and item counts describe the instance's current state, while the
+ * remaining counters accumulate until reset. Counters are updated atomically
+ * as each lookup completes, so concurrent lookups are all accounted for.
+ */
+struct strgrp_stats {
+    unsigned long n_grps;
+    unsigned long n_items;
+    unsigned long n_lookups;
+    unsigned long n_cache_hits;
+    unsigned long n_cache_misses;
+    unsigned long n_cands;
+    unsigned long n_len_rejected;
+    unsigned long n_cos_rejected;
+    unsigned long n_lcs;
+    double t_lookup;
+    double t_select;
+    double t_score;
+};
+
+/**
+ * Fetch the lookup counters accumulated by a strgrp instance.
+ * @ctx: The strgrp instance in question
+ * @stats: Receives the counters
+ */
+void
+strgrp_stats(const struct strgrp *ctx, struct strgrp_stats *stats);
+
+/**
+ * Zero the lookup counters of a strgrp instance.
+ * @ctx: The strgrp instance in question
+ */
+void
+strgrp_reset_stats(struct strgrp *ctx);
+
 /**
  * Find a group which best matches the provided string key.
  * @ctx: The strgrp instance to search
@@ -37,6 +270,100 @@ strgrp_new(double threshold);
 const struct strgrp_grp *
 strgrp_grp_for(struct strgrp *ctx, const char *str);
 
+/**
+ * Allocate scratch space for lookups.
+ *
+ * A query may be used with any strgrp instance, but by only one lookup at a
+ * time. Reusing a query for many lookups avoids reallocating its buffers.
+ *
+ * @return A heap-allocated query, or NULL if allocation fails. The caller must
+ * release it with strgrp_query_free().
+ */
+struct strgrp_query *
+strgrp_query_new(void);
+
+/**
+ * Release the scratch space allocated by strgrp_query_new().
+ * @q: The query to free
+ */
+void
+strgrp_query_free(struct strgrp_query *q);
+
+/**
+ * Find a group which best matches the provided string key, as for
+ * strgrp_grp_for(), using the caller's scratch space.
+ * @ctx: The strgrp instance to search
+ * @q: Scratch space from strgrp_query_new(), not in use by any other lookup
+ * @str: The string key to cluster
+ *
+ * Lookups through distinct queries may run concurrently with each other.
+ */
+const struct strgrp_grp *
+strgrp_grp_for_query(const struct strgrp *ctx, struct strgrp_query *q,
+        const char *str);
+
+/**
+ * Find the groups which best match each of the provided string keys.
+ * @ctx: The strgrp instance to search
+ * @strs: An array of n string keys
+ * @n: The number of keys
+ * @grps: An array of n elements to receive the group found for each key, as
+ *     strgrp_grp_for() would return
+ * @n_threads: The number of threads to search with, or 0 for the instance's
+ *     setting
+ *
+ * Large batches are searched with a key per thread, while small batches
+ * divide the candidates of each search between the threads where there are
+ * enough of them.
+ *
+ * @return True if the keys were searched, or false if allocation failed.
+ */
+bool
+strgrp_grp_for_many(const struct strgrp *ctx, const char *const *strs,
+        size_t n, const struct strgrp_grp **grps, int n_threads);
+
+/**
+ * Rank the groups which match the provided string key.
+ * @ctx: The strgrp instance to search
+ * @str: The string key to score
+ * @threshold: The minimum score of groups to rank. This may differ from the
+ *     instance's threshold; lower values consider more groups.
+ * @grps: An array of at least n elements to receive the best groups
+ * @scores: An array of at least n elements to receive the groups' scores
+ * @n: The maximum number of groups to store
+ *
+ * Groups are ranked by descending score, with ties ordered by group creation.
+ * Unlike strgrp_grp_for(), each group's score is computed regardless of
+ * whether str has been seen before, so the best group may differ from the one
+ * str was added to.
+ *
+ * @return The number of groups scoring at or above threshold. If this exceeds
+ * n, only the n best are stored. Ownership of the stored group pointers
+ * resides with the strgrp instance and they become invalid if the strgrp
+ * instance is freed.
+ */
+size_t
+strgrp_grps_for(struct strgrp *ctx, const char *str, double threshold,
+        const struct strgrp_grp **grps, double *scores, size_t n);
+
+/**
+ * Rank the groups which match the provided string key, as for
+ * strgrp_grps_for(), using the caller's scratch space.
+ * @ctx: The strgrp instance to search
+ * @q: Scratch space from strgrp_query_new(), not in use by any other lookup
+ * @str: The string key to score
+ * @threshold: The minimum score of groups to rank
+ * @grps: An array of at least n elements to receive the best groups
+ * @scores: An array of at least n elements to receive the groups' scores
+ * @n: The maximum number of groups to store
+ *
+ * Lookups through distinct queries may run concurrently with each other.
+ */
+size_t
+strgrp_grps_for_query(const struct strgrp *ctx, struct strgrp_query *q,
+        const char *str, double threshold, const struct strgrp_grp **grps,
+        double *scores, size_t n);
+
 /**
  * Add a string key and arbitrary data value (together, an item) to the
  * appropriate group.
@@ -55,6 +382,47 @@ strgrp_grp_for(struct strgrp *ctx, const char *str);
 const struct strgrp_grp *
 strgrp_add(struct strgrp *ctx, const char *str, void *data);
 
+/**
+ * Add a batch of string keys and data values to the appropriate groups.
+ * @ctx: The strgrp instance to add the strings and data
+ * @strs: The string keys, as for strgrp_add()
+ * @data: The data values, one for each key
+ * @n: The number of keys
+ * @grps: Receives the group each item was added to, or NULL if it was not
+ *     added
+ *
+ * The groups are exactly those strgrp_add() would give if called for each key
+ * in turn, but each distinct key is looked up only once, and the lookups are
+ * spread over the threads set by strgrp_set_threads().
+ *
+ * @return true if every item was added, or false if allocation failed, in
+ * which case only the items with a group in grps were added.
+ */
+bool
+strgrp_add_many(struct strgrp *ctx, const char *const *strs,
+        void *const *data, size_t n, const struct strgrp_grp **grps);
+
+/**
+ * Remove an item from its group.
+ * @ctx: The strgrp instance holding the item
+ * @str: The string key the item was added with
+ * @match: Selects the item to remove by its data value. It is called with
+ *     the data of each item added under str, in order, and arg, until it
+ *     returns a positive value. A negative return abandons the removal. If
+ *     NULL, the first item added under str is removed.
+ * @arg: Passed through to match
+ * @data: If not NULL, receives the data of the removed item
+ *
+ * A group left without items is removed along with the item. Pointers to
+ * removed groups and items remain valid until the strgrp instance is freed,
+ * but removed groups have no items and removed items have NULL data.
+ *
+ * Returns true if an item was removed.
+ */
+bool
+strgrp_remove(struct strgrp *ctx, const char *str,
+        int (*match)(void *data, void *arg), void *arg, void **data);
+
 /**
  * Create an iterator over the current groups.
  * @ctx: The strgrp instance to iterate over
@@ -159,6 +527,40 @@ strgrp_item_key(const struct strgrp_item *item);
 void *
 strgrp_item_value(const struct strgrp_item *item);
 
+/**
+ * Serialise a strgrp instance to a compact binary representation
+ * @ctx: The strgrp instance to serialise
+ * @len: Set to the length of the returned buffer
+ *
+ * The representation holds the threshold, the similarity measure, the key
+ * normalisation, the groups with their keys and character populations, and
+ * the keys of each group's items. Item values are not serialised, and must be
+ * provided to strgrp_load() in iteration order.
+ *
+ * @return A heap-allocated buffer which the caller must release with free().
+ */
+void *
+strgrp_save(const struct strgrp *ctx, size_t *len);
+
+/**
+ * Reconstruct a strgrp instance from the output of strgrp_save()
+ * @buf: The serialised representation
+ * @len: The length of buf in bytes
+ * @values: The item values, ordered as the items are visited by iterating
+ *     over each group in turn
+ * @n_values: The number of elements in values, which must equal the number of
+ *     serialised items
+ *
+ * The reconstructed instance groups further strings exactly as the original
+ * would have.
+ *
+ * @return A heap-allocated strgrp instance, or NULL if buf is malformed,
+ * n_values does not match or allocation fails. Ownership of the pointer resides
+ * with the caller, which must be freed with strgrp_free.
+ */
+struct strgrp *
+strgrp_load(const void *buf, size_t len, void *const *values, size_t n_values);
+
 /**
  * Destroy the strgrp instance
  *
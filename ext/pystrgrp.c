@@ -1,17 +1,157 @@
 #include <Python.h>
+#include <errno.h>
+#include <pthread.h>
+#include <stdbool.h>
+#include <string.h>
 #include "ccan/strgrp/strgrp.h"
 
+//
+// Strgrp instance state
+//
+
+typedef struct {
+    PyObject_HEAD;
+    double thresh;
+    struct strgrp *grp;
+    struct strgrp_iter *iter;
+    // Guards grp, as lookups and batch operations run without the GIL. Lookups
+    // share the lock, while operations that change the clusters take it
+    // exclusively.
+    pthread_rwlock_t lock;
+    bool lock_init;
+    // The thread holding the lock for writing, valid while writing is set.
+    // Both are only accessed with the GIL held.
+    pthread_t writer;
+    bool writing;
+    // Scratch space for lookups, reused between calls. Only accessed with the
+    // GIL held.
+    struct strgrp_query **queries;
+    Py_ssize_t n_queries;
+    Py_ssize_t queries_alloc;
+} StrgrpObject;
+
+/* Report a failed rwlock operation, unless an exception is already set.
+ * Returns -1. */
+static int
+Strgrp_lock_error(int err) {
+    if (!PyErr_Occurred()) {
+        errno = err;
+        PyErr_SetFromErrno(PyExc_OSError);
+    }
+    return -1;
+}
+
+/* Refuse to lock from within a change to the clusters on the same thread,
+ * such as from a value's __eq__() called by remove(), as the lock would
+ * otherwise be taken recursively. Called with the GIL held. */
+static int
+Strgrp_check_reentry(StrgrpObject *self) {
+    if (self->writing && pthread_equal(self->writer, pthread_self())) {
+        PyErr_SetString(PyExc_RuntimeError,
+                "Strgrp accessed while its clusters are being changed");
+        return -1;
+    }
+    return 0;
+}
+
+/* Lock for lookups, with the GIL held. Returns 0 on success, or -1 with an
+ * exception set. */
+static int
+Strgrp_rdlock(StrgrpObject *self) {
+    int err;
+    if (Strgrp_check_reentry(self)) {
+        return -1;
+    }
+    err = pthread_rwlock_tryrdlock(&self->lock);
+    if (err == EBUSY) {
+        // Don't hold the GIL while waiting, the holder may need it to finish
+        Py_BEGIN_ALLOW_THREADS
+        err = pthread_rwlock_rdlock(&self->lock);
+        Py_END_ALLOW_THREADS
+    }
+    return err ? Strgrp_lock_error(err) : 0;
+}
+
+/* Lock for changes to the clusters, with the GIL held. Returns 0 on success,
+ * or -1 with an exception set. */
+static int
+Strgrp_wrlock(StrgrpObject *self) {
+    int err;
+    if (Strgrp_check_reentry(self)) {
+        return -1;
+    }
+    err = pthread_rwlock_trywrlock(&self->lock);
+    if (err == EBUSY) {
+        Py_BEGIN_ALLOW_THREADS
+        err = pthread_rwlock_wrlock(&self->lock);
+        Py_END_ALLOW_THREADS
+    }
+    if (err) {
+        return Strgrp_lock_error(err);
+    }
+    self->writer = pthread_self();
+    self->writing = true;
+    return 0;
+}
+
+/* Release either lock, with the GIL held. Returns 0 on success, or -1 with an
+ * exception set. */
+static int
+Strgrp_unlock(StrgrpObject *self) {
+    int err;
+    // Only the writer can hold the lock while writing is set
+    self->writing = false;
+    err = pthread_rwlock_unlock(&self->lock);
+    return err ? Strgrp_lock_error(err) : 0;
+}
+
+/* Take a query from the pool, or allocate one if the pool is empty. Returns
+ * NULL with an exception set on failure. */
+static struct strgrp_query *
+Strgrp_get_query(StrgrpObject *self) {
+    struct strgrp_query *q;
+    if (self->n_queries) {
+        return self->queries[--self->n_queries];
+    }
+    q = strgrp_query_new();
+    if (!q) {
+        PyErr_NoMemory();
+    }
+    return q;
+}
+
+// Return a query to the pool, which grows to the number of concurrent lookups
+static void
+Strgrp_put_query(StrgrpObject *self, struct strgrp_query *q) {
+    if (self->n_queries == self->queries_alloc) {
+        const Py_ssize_t n_alloc = self->queries_alloc ?
+            2 * self->queries_alloc : 4;
+        struct strgrp_query **queries =
+            PyMem_Realloc(self->queries, n_alloc * sizeof(*queries));
+        if (!queries) {
+            strgrp_query_free(q);
+            return;
+        }
+        self->queries = queries;
+        self->queries_alloc = n_alloc;
+    }
+    self->queries[self->n_queries++] = q;
+}
+
 //
 // strgrp_item
 //
 
 typedef struct {
     PyObject_HEAD;
+    StrgrpObject *owner;
     const struct strgrp_item *item;
 } ItemObject;
 
 static void
 Item_dealloc(PyObject *obj) {
+    ItemObject *self = (ItemObject *)obj;
+    Py_XDECREF(self->owner);
     Py_TYPE(obj)->tp_free(obj);
 }
 
@@ -26,7 +166,11 @@ Item_key(ItemObject *self) {
 static PyObject *
 Item_value(ItemObject *self) {
     PyObject *value = strgrp_item_value(self->item);
-    Py_XINCREF(value);
+    // The item has been removed from its cluster
+    if (!value) {
+        Py_RETURN_NONE;
+    }
+    Py_INCREF(value);
     return value;
 }
 
@@ -40,7 +184,7 @@ static PyMethodDef Item_methods[] = {
 
 static PyTypeObject ItemType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "strgrp.Item",           /* tp_name */
+    "pystrgrp.Item",           /* tp_name */
     sizeof(ItemObject),      /* tp_basicsize */
     0,                         /* tp_itemsize */
     &Item_dealloc,            /* tp_dealloc */
@@ -84,6 +228,7 @@ static PyTypeObject ItemType = {
 
 typedef struct {
     PyObject_HEAD;
+    StrgrpObject *owner;
     const struct strgrp_grp *grp;
     struct strgrp_grp_iter *iter;
 } GrpObject;
@@ -94,9 +239,35 @@ Grp_dealloc(PyObject *obj) {
     if (self->iter) {
         strgrp_grp_iter_free(self->iter);
     }
+    Py_XDECREF(self->owner);
     Py_TYPE(self)->tp_free((PyObject *)self);
 }
 
+/* Append the item keys and values of grp to the keys and values lists, either
+ * of which may be NULL. The caller holds the owner's lock. */
+static int
+Grp_collect(const struct strgrp_grp *grp, PyObject *keys, PyObject *values) {
+    const struct strgrp_item *item;
+    struct strgrp_grp_iter *iter = strgrp_grp_iter_new(grp);
+    int rc = 0;
+    if (!iter) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    while (!rc && (item = strgrp_grp_iter_next(iter))) {
+        if (keys) {
+            PyObject *key = PyUnicode_FromString(strgrp_item_key(item));
+            rc = !key || PyList_Append(keys, key);
+            Py_XDECREF(key);
+        }
+        if (!rc && values) {
+            rc = PyList_Append(values, strgrp_item_value(item));
+        }
+    }
+    strgrp_grp_iter_free(iter);
+    return rc ? -1 : 0;
+}
+
 static PyObject *
 Grp_iter(PyObject *self) {
     Py_INCREF(self);
@@ -106,7 +277,13 @@ Grp_iter(PyObject *self) {
 static PyObject *
 Grp_iternext(GrpObject *self) {
     if (!self->iter) {
+        if (Strgrp_rdlock(self->owner)) {
+            return NULL;
+        }
         self->iter = strgrp_grp_iter_new(self->grp);
+        if (Strgrp_unlock(self->owner)) {
+            return NULL;
+        }
         if (!self->iter) {
             return PyErr_NoMemory();
         }
@@ -115,8 +292,19 @@ Grp_iternext(GrpObject *self) {
     if (!item) {
         return PyErr_NoMemory();
     }
+    if (Strgrp_rdlock(self->owner)) {
+        Item_dealloc((PyObject *)item);
+        return NULL;
+    }
     item->item = strgrp_grp_iter_next(self->iter);
-    if (!item->item) {
+    if (Strgrp_unlock(self->owner)) {
+        Item_dealloc((PyObject *)item);
+        return NULL;
+    }
+    if (item->item) {
+        Py_INCREF(self->owner);
+        item->owner = self->owner;
+    } else {
         Item_dealloc((PyObject *)item);
         self->iter = NULL;
         /* Raising of standard StopIteration exception with empty value. */
@@ -134,15 +322,49 @@ Grp_key(GrpObject *self) {
     return py_key;
 }
 
+static PyObject *
+Grp_list(GrpObject *self, const bool keys) {
+    PyObject *list = PyList_New(0);
+    int rc;
+    if (!list) {
+        return NULL;
+    }
+    if (Strgrp_rdlock(self->owner)) {
+        Py_DECREF(list);
+        return NULL;
+    }
+    rc = Grp_collect(self->grp, keys ? list : NULL, keys ? NULL : list);
+    rc = Strgrp_unlock(self->owner) || rc;
+    if (rc) {
+        Py_DECREF(list);
+        return NULL;
+    }
+    return list;
+}
+
+static PyObject *
+Grp_keys(GrpObject *self) {
+    return Grp_list(self, true);
+}
+
+static PyObject *
+Grp_values(GrpObject *self) {
+    return Grp_list(self, false);
+}
+
 static PyMethodDef Grp_methods[] = {
     { "key", (PyCFunction)Grp_key, METH_NOARGS,
         "Fetch the description stored in the item" },
+    { "keys", (PyCFunction)Grp_keys, METH_NOARGS,
+        "Fetch the descriptions of the items in the cluster as a list" },
+    { "values", (PyCFunction)Grp_values, METH_NOARGS,
+        "Fetch the data of the items in the cluster as a list" },
     {NULL}
 };
 
 static PyTypeObject GrpType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "strgrp.Grp",           /* tp_name */
+    "pystrgrp.Grp",           /* tp_name */
     sizeof(GrpObject),      /* tp_basicsize */
     0,                         /* tp_itemsize */
     &Grp_dealloc,            /* tp_dealloc */
@@ -180,40 +402,185 @@ static PyTypeObject GrpType = {
     0,                         /* tp_alloc */
 };
 
+static PyObject *
+Grp_wrap(StrgrpObject *owner, const struct strgrp_grp *grp) {
+    GrpObject * const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
+    if (!grpobj) {
+        return PyErr_NoMemory();
+    }
+    Py_INCREF(owner);
+    grpobj->owner = owner;
+    grpobj->grp = grp;
+    return (PyObject *)grpobj;
+}
+
 //
 // Strgrp
 //
 
-typedef struct {
-    PyObject_HEAD;
-    double thresh;
-    struct strgrp *grp;
-    struct strgrp_iter *iter;
-} StrgrpObject;
-
 static PyObject *
 Strgrp_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 {
     StrgrpObject *self = (StrgrpObject *)type->tp_alloc(type, 0);
     if (self != NULL) {
+        pthread_rwlockattr_t attr;
+        int rc;
         self->thresh = 0.85;
         self->grp = NULL;
+        pthread_rwlockattr_init(&attr);
+#ifdef __GLIBC__
+        // Don't let a steady stream of lookups starve adds
+        pthread_rwlockattr_setkind_np(&attr,
+                PTHREAD_RWLOCK_PREFER_WRITER_NONRECURSIVE_NP);
+#endif
+        rc = pthread_rwlock_init(&self->lock, &attr);
+        pthread_rwlockattr_destroy(&attr);
+        if (rc) {
+            Py_DECREF(self);
+            return PyErr_NoMemory();
+        }
+        self->lock_init = true;
     }
     return (PyObject *)self;
 }
 
+/* Fold case and collapse whitespace in keys beyond ASCII as str.upper() and
+ * str.split() do, which strgrp can't. strgrp may call this without the GIL
+ * and from its own threads. Returns NULL on failure, leaving strgrp to fold
+ * the key's ASCII characters alone. */
+static char *
+Strgrp_fold(const char *str, unsigned int flags, void *arg) {
+    PyGILState_STATE gil = PyGILState_Ensure();
+    PyObject *key, *parts, *sep, *folded;
+    const char *ckey;
+    char *result = NULL;
+    Py_ssize_t len;
+    key = PyUnicode_FromString(str);
+    if (key && (flags & STRGRP_NORM_COLLAPSE)) {
+        parts = PyUnicode_Split(key, NULL, -1);
+        sep = parts ? PyUnicode_FromString(" ") : NULL;
+        Py_DECREF(key);
+        key = sep ? PyUnicode_Join(sep, parts) : NULL;
+        Py_XDECREF(sep);
+        Py_XDECREF(parts);
+    }
+    if (key && (flags & STRGRP_NORM_UPPER)) {
+        folded = PyObject_CallMethod(key, "upper", NULL);
+        Py_DECREF(key);
+        key = folded;
+    }
+    if (key && (ckey = PyUnicode_AsUTF8AndSize(key, &len))) {
+        if ((result = malloc(len + 1))) {
+            memcpy(result, ckey, len + 1);
+        }
+    }
+    if (PyErr_Occurred()) {
+        PyErr_WriteUnraisable(NULL);
+    }
+    Py_XDECREF(key);
+    PyGILState_Release(gil);
+    return result;
+}
+
+/* Configure the key normalisation of a new instance from the constructor
+ * arguments, where stop_arg may be NULL or None for no stop phrases. Returns 0
+ * on success, or -1 with an exception set. */
+static int
+Strgrp_set_normalise(StrgrpObject *self, int upper, int collapse,
+        PyObject *stop_arg) {
+    const unsigned int flags = (upper ? STRGRP_NORM_UPPER : 0) |
+        (collapse ? STRGRP_NORM_COLLAPSE : 0);
+    PyObject *stop;
+    const char **cstop;
+    Py_ssize_t i, n;
+    int rc = -1;
+    stop = (stop_arg && stop_arg != Py_None) ?
+        PySequence_Tuple(stop_arg) : PyTuple_New(0);
+    if (!stop) {
+        return -1;
+    }
+    n = PyTuple_GET_SIZE(stop);
+    cstop = PyMem_Malloc((n ? n : 1) * sizeof(*cstop));
+    if (!cstop) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (i = 0; i < n; i++) {
+        PyObject *phrase = PyTuple_GET_ITEM(stop, i);
+        if (!PyUnicode_Check(phrase)) {
+            PyErr_Format(PyExc_TypeError,
+                    "stop phrases must be str, not %.200s",
+                    Py_TYPE(phrase)->tp_name);
+            goto out;
+        }
+        if (!(cstop[i] = PyUnicode_AsUTF8(phrase))) {
+            goto out;
+        }
+        if (!*cstop[i]) {
+            PyErr_SetString(PyExc_ValueError,
+                    "stop phrases must not be empty");
+            goto out;
+        }
+    }
+    if (!strgrp_set_normalise(self->grp, flags, cstop, n)) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    strgrp_set_fold(self->grp, Strgrp_fold, NULL);
+    rc = 0;
+out:
+    PyMem_Free(cstop);
+    Py_DECREF(stop);
+    return rc;
+}
+
+// Names of the similarity measures, indexed by enum strgrp_metric
+static const char *const metric_names[] = { "nlcs", "jaccard", "dice" };
+
+#define N_METRICS (sizeof(metric_names) / sizeof(metric_names[0]))
+
 static int
 Strgrp_init(StrgrpObject *self, PyObject *args, PyObject *kwds) {
     double threshold = self->thresh;
-    static char *kwlist[] = {"threshold", NULL};
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|d", kwlist, &threshold)) {
+    int threads = 0, bands = 0, rows = 4, upper = 0, collapse = 0;
+    PyObject *stop = NULL;
+    const char *metric = metric_names[STRGRP_METRIC_NLCS];
+    size_t m;
+    static char *kwlist[] = {"threshold", "threads", "bands", "rows", "upper",
+        "collapse", "stop", "metric", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|diiippOs", kwlist,
+                &threshold, &threads, &bands, &rows, &upper, &collapse,
+                &stop, &metric)) {
+        return -1;
+    }
+    for (m = 0; m < N_METRICS && strcmp(metric, metric_names[m]); m++) {
+        continue;
+    }
+    if (m == N_METRICS) {
+        PyErr_SetString(PyExc_ValueError,
+                "metric must be one of 'nlcs', 'jaccard' or 'dice'");
+        return -1;
+    }
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "threads must not be negative");
         return -1;
     }
-    self->grp = strgrp_new(threshold);
+    if (bands < 0 || rows < 1 || bands > 1024 / rows) {
+        PyErr_SetString(PyExc_ValueError,
+                "bands must not be negative and rows must be positive, with "
+                "at most 1024 hashes");
+        return -1;
+    }
+    self->grp = bands ?
+        strgrp_new_lsh(threshold, bands, rows) : strgrp_new(threshold);
     if (!self->grp) {
+        PyErr_NoMemory();
         return -1;
     }
-    return 0;
+    strgrp_set_threads(self->grp, threads);
+    strgrp_set_metric(self->grp, (enum strgrp_metric)m);
+    self->thresh = threshold;
+    return Strgrp_set_normalise(self, upper, collapse, stop);
 }
 
 static void
@@ -224,7 +591,16 @@ xdecref(void *data) {
 static void
 Strgrp_dealloc(PyObject *obj) {
     StrgrpObject *self = (StrgrpObject *)obj;
-    strgrp_free_cb(self->grp, &xdecref);
+    if (self->grp) {
+        strgrp_free_cb(self->grp, &xdecref);
+    }
+    while (self->n_queries) {
+        strgrp_query_free(self->queries[--self->n_queries]);
+    }
+    PyMem_Free(self->queries);
+    if (self->lock_init) {
+        pthread_rwlock_destroy(&self->lock);
+    }
     Py_TYPE(self)->tp_free((PyObject *)self);
 }
 
@@ -235,16 +611,125 @@ Strgrp_grp_for(StrgrpObject *self, PyObject *args, PyObject *kwds) {
     if (!PyArg_ParseTupleAndKeywords(args, kwds, "s", kwlist, &key)) {
         return NULL;
     }
-    const struct strgrp_grp * grp = strgrp_grp_for(self->grp, key);
+    struct strgrp_query *q = Strgrp_get_query(self);
+    const struct strgrp_grp *grp;
+    if (!q) {
+        return NULL;
+    }
+    if (Strgrp_rdlock(self)) {
+        Strgrp_put_query(self, q);
+        return NULL;
+    }
+    // Lookups proceed concurrently, so search without the GIL
+    Py_BEGIN_ALLOW_THREADS
+    grp = strgrp_grp_for_query(self->grp, q, key);
+    Py_END_ALLOW_THREADS
+    Strgrp_put_query(self, q);
+    if (Strgrp_unlock(self)) {
+        return NULL;
+    }
     if (!grp) {
         Py_RETURN_NONE;
     }
-    GrpObject * const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
-    if (!grpobj) {
-        return PyErr_NoMemory();
+    return Grp_wrap(self, grp);
+}
+
+static PyObject *
+Strgrp_candidates(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    char *key;
+    Py_ssize_t k;
+    PyObject *thresh_arg = Py_None;
+    PyObject *result = NULL;
+    const struct strgrp_grp **grps = NULL;
+    double *scores = NULL;
+    double threshold = self->thresh;
+    struct strgrp_query *q;
+    struct strgrp_stats stats;
+    size_t i, n;
+    static char *kwlist[] = { "key", "k", "threshold", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sn|O", kwlist, &key, &k,
+                &thresh_arg)) {
+        return NULL;
     }
-    grpobj->grp = grp;
-    return (PyObject *)grpobj;
+    if (k < 0) {
+        PyErr_SetString(PyExc_ValueError, "k must not be negative");
+        return NULL;
+    }
+    if (thresh_arg != Py_None) {
+        threshold = PyFloat_AsDouble(thresh_arg);
+        if (threshold == -1.0 && PyErr_Occurred()) {
+            return NULL;
+        }
+    }
+    q = Strgrp_get_query(self);
+    if (!q) {
+        goto out;
+    }
+    if (Strgrp_rdlock(self)) {
+        Strgrp_put_query(self, q);
+        goto out;
+    }
+    // There is at most one candidate per group, which also bounds the
+    // allocations below however large k is
+    strgrp_stats(self->grp, &stats);
+    if ((size_t)k > stats.n_grps) {
+        k = stats.n_grps;
+    }
+    grps = PyMem_New(const struct strgrp_grp *, k ? k : 1);
+    scores = PyMem_New(double, k ? k : 1);
+    if (!grps || !scores) {
+        Strgrp_unlock(self);
+        Strgrp_put_query(self, q);
+        PyErr_NoMemory();
+        goto out;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    n = strgrp_grps_for_query(self->grp, q, key, threshold, grps, scores, k);
+    Py_END_ALLOW_THREADS
+    Strgrp_put_query(self, q);
+    if (Strgrp_unlock(self)) {
+        goto out;
+    }
+    if (n > (size_t)k) {
+        n = k;
+    }
+    result = PyList_New(n);
+    if (!result) {
+        goto out;
+    }
+    for (i = 0; i < n; i++) {
+        PyObject *grpobj = Grp_wrap(self, grps[i]);
+        PyObject *pair;
+        if (!grpobj) {
+            Py_CLEAR(result);
+            goto out;
+        }
+        pair = Py_BuildValue("(Nd)", grpobj, scores[i]);
+        if (!pair) {
+            Py_CLEAR(result);
+            goto out;
+        }
+        PyList_SET_ITEM(result, i, pair);
+    }
+out:
+    PyMem_Free(scores);
+    PyMem_Free(grps);
+    return result;
+}
+
+// The number of item additions still to fail as if out of memory, set by
+// _fail_adds() to exercise the error paths. Only accessed with the GIL held.
+static Py_ssize_t fail_adds;
+
+/* Add an item as strgrp_add() does, unless fail_adds calls for a failure.
+ * The caller holds the lock for writing and the GIL. */
+static const struct strgrp_grp *
+Strgrp_add_item(StrgrpObject *self, const char *key, PyObject *data) {
+    if (fail_adds) {
+        fail_adds--;
+        return NULL;
+    }
+    return strgrp_add(self->grp, key, data);
 }
 
 static PyObject *
@@ -258,17 +743,284 @@ Strgrp_add(StrgrpObject *self, PyObject *args, PyObject *kwds) {
     if (!data) {
         return NULL;
     }
+    if (Strgrp_wrlock(self)) {
+        return NULL;
+    }
     Py_INCREF(data);
-    const struct strgrp_grp * grp = strgrp_add(self->grp, key, data);
+    const struct strgrp_grp * grp = Strgrp_add_item(self, key, data);
     if (!grp) {
-        return PyErr_NoMemory();
+        Py_DECREF(data);
+        PyErr_NoMemory();
+        Strgrp_unlock(self);
+        return NULL;
     }
-    GrpObject * const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
-    if (!grpobj) {
-        return PyErr_NoMemory();
+    if (Strgrp_unlock(self)) {
+        // The item was added, so the reference it holds stays
+        return NULL;
     }
-    grpobj->grp = grp;
-    return (PyObject *)grpobj;
+    return Grp_wrap(self, grp);
+}
+
+// Select items by equality of their values, as list.remove() does
+static int
+Strgrp_match(void *data, void *arg) {
+    return PyObject_RichCompareBool(data, arg, Py_EQ);
+}
+
+/* Remove the item matching key and value, returning a new reference to its
+ * value or NULL with an exception set. The caller holds the lock for
+ * writing. */
+static PyObject *
+Strgrp_remove_item(StrgrpObject *self, const char *key, PyObject *value) {
+    void *data;
+    if (!strgrp_remove(self->grp, key, Strgrp_match, value, &data)) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_ValueError, "item not in Strgrp");
+        }
+        return NULL;
+    }
+    return data;
+}
+
+static PyObject *
+Strgrp_remove(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    char *key;
+    PyObject *value, *data;
+    static char *kwlist[] = { "key", "value", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sO", kwlist, &key, &value)) {
+        return NULL;
+    }
+    if (Strgrp_wrlock(self)) {
+        return NULL;
+    }
+    data = Strgrp_remove_item(self, key, value);
+    if (Strgrp_unlock(self)) {
+        Py_XDECREF(data);
+        return NULL;
+    }
+    if (!data) {
+        return NULL;
+    }
+    // Release the reference taken when the item was added
+    Py_DECREF(data);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Strgrp_rekey(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    char *key, *new_key;
+    PyObject *value, *data;
+    const struct strgrp_grp *grp = NULL;
+    bool restored = false;
+    static char *kwlist[] = { "key", "value", "new_key", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sOs", kwlist, &key, &value,
+                &new_key)) {
+        return NULL;
+    }
+    if (Strgrp_wrlock(self)) {
+        return NULL;
+    }
+    data = Strgrp_remove_item(self, key, value);
+    if (data) {
+        // The reference held by the removed item passes to the new one
+        grp = Strgrp_add_item(self, new_key, data);
+        // Rather than lose the item, put it back under its old key
+        restored = !grp && Strgrp_add_item(self, key, data);
+    }
+    if (data && !grp) {
+        if (!restored) {
+            Py_DECREF(data);
+        }
+        PyErr_NoMemory();
+    }
+    if (Strgrp_unlock(self) || !grp) {
+        return NULL;
+    }
+    return Grp_wrap(self, grp);
+}
+
+/* Extract the UTF-8 representation of each key in a tuple. The returned
+ * pointers are owned by the tuple's elements. */
+static const char **
+Strgrp_keys(PyObject *keys) {
+    const Py_ssize_t n = PyTuple_GET_SIZE(keys);
+    const char **ckeys = PyMem_Malloc((n ? n : 1) * sizeof(*ckeys));
+    Py_ssize_t i;
+    if (!ckeys) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    for (i = 0; i < n; i++) {
+        PyObject *key = PyTuple_GET_ITEM(keys, i);
+        Py_ssize_t len;
+        if (!PyUnicode_Check(key)) {
+            PyErr_Format(PyExc_TypeError, "keys must be str, not %.200s",
+                    Py_TYPE(key)->tp_name);
+            PyMem_Free(ckeys);
+            return NULL;
+        }
+        ckeys[i] = PyUnicode_AsUTF8AndSize(key, &len);
+        if (!ckeys[i]) {
+            PyMem_Free(ckeys);
+            return NULL;
+        }
+        if (strlen(ckeys[i]) != (size_t)len) {
+            PyErr_SetString(PyExc_ValueError, "embedded null character");
+            PyMem_Free(ckeys);
+            return NULL;
+        }
+    }
+    return ckeys;
+}
+
+static PyObject *
+Strgrp_add_many(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *keys_arg, *values_arg;
+    PyObject *keys = NULL, *values = NULL, *result = NULL;
+    const struct strgrp_grp **grps = NULL;
+    const char **ckeys = NULL;
+    Py_ssize_t i, n;
+    bool added;
+    static char *kwlist[] = { "keys", "values", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO", kwlist, &keys_arg,
+                &values_arg)) {
+        return NULL;
+    }
+    // Snapshot the sequences so they can't change while the GIL is released
+    keys = PySequence_Tuple(keys_arg);
+    if (!keys) {
+        goto out;
+    }
+    values = PySequence_Tuple(values_arg);
+    if (!values) {
+        goto out;
+    }
+    n = PyTuple_GET_SIZE(keys);
+    if (n != PyTuple_GET_SIZE(values)) {
+        PyErr_SetString(PyExc_ValueError,
+                "keys and values must be the same length");
+        goto out;
+    }
+    ckeys = Strgrp_keys(keys);
+    if (!ckeys) {
+        goto out;
+    }
+    grps = PyMem_Malloc((n ? n : 1) * sizeof(*grps));
+    if (!grps) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    if (Strgrp_wrlock(self)) {
+        goto out;
+    }
+    for (i = 0; i < n; i++) {
+        Py_INCREF(PyTuple_GET_ITEM(values, i));
+    }
+    Py_BEGIN_ALLOW_THREADS
+    added = strgrp_add_many(self->grp, ckeys,
+            (void *const *)PySequence_Fast_ITEMS(values), n, grps);
+    Py_END_ALLOW_THREADS
+    if (!added) {
+        // Drop the references we took for the values that were not added.
+        // Those that were stay clustered, so a failed batch is partly applied.
+        for (i = 0; i < n; i++) {
+            if (!grps[i]) {
+                Py_DECREF(PyTuple_GET_ITEM(values, i));
+            }
+        }
+        PyErr_NoMemory();
+    }
+    if (Strgrp_unlock(self) || !added) {
+        goto out;
+    }
+    result = PyList_New(n);
+    if (!result) {
+        goto out;
+    }
+    for (i = 0; i < n; i++) {
+        PyObject *grpobj = Grp_wrap(self, grps[i]);
+        if (!grpobj) {
+            Py_CLEAR(result);
+            goto out;
+        }
+        PyList_SET_ITEM(result, i, grpobj);
+    }
+out:
+    PyMem_Free(grps);
+    PyMem_Free(ckeys);
+    Py_XDECREF(values);
+    Py_XDECREF(keys);
+    return result;
+}
+
+static PyObject *
+Strgrp_grp_for_many(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *keys_arg;
+    PyObject *keys = NULL, *result = NULL;
+    const struct strgrp_grp **grps = NULL;
+    const char **ckeys = NULL;
+    Py_ssize_t i, n;
+    int threads = 0;
+    bool found;
+    static char *kwlist[] = { "keys", "threads", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|i", kwlist, &keys_arg,
+                &threads)) {
+        return NULL;
+    }
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "threads must not be negative");
+        return NULL;
+    }
+    keys = PySequence_Tuple(keys_arg);
+    if (!keys) {
+        goto out;
+    }
+    n = PyTuple_GET_SIZE(keys);
+    ckeys = Strgrp_keys(keys);
+    if (!ckeys) {
+        goto out;
+    }
+    grps = PyMem_Malloc((n ? n : 1) * sizeof(*grps));
+    if (!grps) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    if (Strgrp_rdlock(self)) {
+        goto out;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    found = strgrp_grp_for_many(self->grp, ckeys, n, grps, threads);
+    Py_END_ALLOW_THREADS
+    if (Strgrp_unlock(self)) {
+        goto out;
+    }
+    if (!found) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    result = PyList_New(n);
+    if (!result) {
+        goto out;
+    }
+    for (i = 0; i < n; i++) {
+        PyObject *grpobj;
+        if (grps[i]) {
+            grpobj = Grp_wrap(self, grps[i]);
+            if (!grpobj) {
+                Py_CLEAR(result);
+                goto out;
+            }
+        } else {
+            Py_INCREF(Py_None);
+            grpobj = Py_None;
+        }
+        PyList_SET_ITEM(result, i, grpobj);
+    }
+out:
+    PyMem_Free(grps);
+    PyMem_Free(ckeys);
+    Py_XDECREF(keys);
+    return result;
 }
 
 static PyObject *
@@ -280,7 +1032,13 @@ Strgrp_iter(PyObject *self) {
 static PyObject *
 Strgrp_iternext(StrgrpObject *self) {
     if (!self->iter) {
+        if (Strgrp_rdlock(self)) {
+            return NULL;
+        }
         self->iter = strgrp_iter_new(self->grp);
+        if (Strgrp_unlock(self)) {
+            return NULL;
+        }
         if (!self->iter) {
             return PyErr_NoMemory();
         }
@@ -289,8 +1047,19 @@ Strgrp_iternext(StrgrpObject *self) {
     if (!grp) {
         return PyErr_NoMemory();
     }
+    if (Strgrp_rdlock(self)) {
+        Grp_dealloc((PyObject *)grp);
+        return NULL;
+    }
     grp->grp = strgrp_iter_next(self->iter);
-    if (!grp->grp) {
+    if (Strgrp_unlock(self)) {
+        Grp_dealloc((PyObject *)grp);
+        return NULL;
+    }
+    if (grp->grp) {
+        Py_INCREF(self);
+        grp->owner = self;
+    } else {
         Grp_dealloc((PyObject *)grp);
         self->iter = NULL;
         /* Raising of standard StopIteration exception with empty value. */
@@ -300,17 +1069,306 @@ Strgrp_iternext(StrgrpObject *self) {
     return (PyObject *)grp;
 }
 
+/* Collect the item values in the order strgrp_load() expects them. The
+ * caller holds the lock. */
+static PyObject *
+Strgrp_values_locked(StrgrpObject *self) {
+    const struct strgrp_grp *grp;
+    struct strgrp_iter *iter;
+    int rc = 0;
+    PyObject *values = PyList_New(0);
+    if (!values) {
+        return NULL;
+    }
+    iter = strgrp_iter_new(self->grp);
+    if (!iter) {
+        Py_DECREF(values);
+        return PyErr_NoMemory();
+    }
+    while (!rc && (grp = strgrp_iter_next(iter))) {
+        rc = Grp_collect(grp, NULL, values);
+    }
+    strgrp_iter_free(iter);
+    if (rc) {
+        Py_DECREF(values);
+        return NULL;
+    }
+    return values;
+}
+
+/* Flatten the clusters into lists of cluster keys, item keys and item values,
+ * along with the offsets into the item lists at which each cluster starts */
+static PyObject *
+Strgrp_export(StrgrpObject *self) {
+    const struct strgrp_grp *grp;
+    struct strgrp_iter *iter;
+    PyObject *grp_keys, *item_keys, *item_values, *offsets, *obj;
+    int rc = 0;
+    grp_keys = PyList_New(0);
+    item_keys = PyList_New(0);
+    item_values = PyList_New(0);
+    offsets = PyList_New(0);
+    if (!grp_keys || !item_keys || !item_values || !offsets) {
+        goto fail;
+    }
+    if (Strgrp_rdlock(self)) {
+        goto fail;
+    }
+    iter = strgrp_iter_new(self->grp);
+    if (!iter) {
+        Strgrp_unlock(self);
+        PyErr_NoMemory();
+        goto fail;
+    }
+    while (!rc) {
+        obj = PyLong_FromSsize_t(PyList_GET_SIZE(item_keys));
+        rc = !obj || PyList_Append(offsets, obj);
+        Py_XDECREF(obj);
+        if (rc || !(grp = strgrp_iter_next(iter))) {
+            break;
+        }
+        obj = PyUnicode_FromString(strgrp_grp_key(grp));
+        rc = !obj || PyList_Append(grp_keys, obj);
+        Py_XDECREF(obj);
+        if (!rc) {
+            rc = Grp_collect(grp, item_keys, item_values);
+        }
+    }
+    strgrp_iter_free(iter);
+    rc = Strgrp_unlock(self) || rc;
+    if (rc) {
+        goto fail;
+    }
+    return Py_BuildValue("NNNN", grp_keys, item_keys, item_values, offsets);
+
+fail:
+    Py_XDECREF(grp_keys);
+    Py_XDECREF(item_keys);
+    Py_XDECREF(item_values);
+    Py_XDECREF(offsets);
+    return NULL;
+}
+
+static PyObject *
+Strgrp_stats(StrgrpObject *self) {
+    struct strgrp_stats stats;
+    if (Strgrp_rdlock(self)) {
+        return NULL;
+    }
+    strgrp_stats(self->grp, &stats);
+    if (Strgrp_unlock(self)) {
+        return NULL;
+    }
+    return Py_BuildValue("{s:k,s:k,s:k,s:k,s:k,s:k,s:k,s:k,s:k,s:d,s:d,s:d}",
+            "n_groups", stats.n_grps,
+            "n_items", stats.n_items,
+            "n_lookups", stats.n_lookups,
+            "n_cache_hits", stats.n_cache_hits,
+            "n_cache_misses", stats.n_cache_misses,
+            "n_cands", stats.n_cands,
+            "n_len_rejected", stats.n_len_rejected,
+            "n_cos_rejected", stats.n_cos_rejected,
+            "n_lcs", stats.n_lcs,
+            "t_lookup", stats.t_lookup,
+            "t_select", stats.t_select,
+            "t_score", stats.t_score);
+}
+
+static PyObject *
+Strgrp_reset_stats(StrgrpObject *self) {
+    if (Strgrp_wrlock(self)) {
+        return NULL;
+    }
+    strgrp_reset_stats(self->grp);
+    if (Strgrp_unlock(self)) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Strgrp_threads(StrgrpObject *self) {
+    return PyLong_FromLong(strgrp_threads(self->grp));
+}
+
+static PyObject *
+Strgrp_metric(StrgrpObject *self) {
+    return PyUnicode_FromString(metric_names[strgrp_metric(self->grp)]);
+}
+
+static PyObject *
+Strgrp_set_threads(StrgrpObject *self, PyObject *args) {
+    int threads;
+    if (!PyArg_ParseTuple(args, "i", &threads)) {
+        return NULL;
+    }
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError, "threads must not be negative");
+        return NULL;
+    }
+    if (Strgrp_wrlock(self)) {
+        return NULL;
+    }
+    strgrp_set_threads(self->grp, threads);
+    if (Strgrp_unlock(self)) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/* Serialise the clusters for strgrp_load(). The caller holds the lock. */
+static PyObject *
+Strgrp_save_locked(StrgrpObject *self) {
+    PyObject *data;
+    size_t len;
+    void *buf = strgrp_save(self->grp, &len);
+    if (!buf) {
+        return PyErr_NoMemory();
+    }
+    data = PyBytes_FromStringAndSize(buf, len);
+    free(buf);
+    return data;
+}
+
+static PyObject *
+Strgrp_save(StrgrpObject *self) {
+    PyObject *data;
+    if (Strgrp_rdlock(self)) {
+        return NULL;
+    }
+    data = Strgrp_save_locked(self);
+    if (Strgrp_unlock(self)) {
+        Py_XDECREF(data);
+        return NULL;
+    }
+    return data;
+}
+
+static PyObject *
+Strgrp_reduce(StrgrpObject *self) {
+    PyObject *module, *load, *data, *values;
+    module = PyImport_ImportModule("pystrgrp");
+    if (!module) {
+        return NULL;
+    }
+    load = PyObject_GetAttrString(module, "load");
+    Py_DECREF(module);
+    if (!load) {
+        return NULL;
+    }
+    // Take both snapshots under the one lock so a change can't fall between
+    // them, pairing the saved clusters with a different set of values
+    if (Strgrp_rdlock(self)) {
+        Py_DECREF(load);
+        return NULL;
+    }
+    data = Strgrp_save_locked(self);
+    values = data ? Strgrp_values_locked(self) : NULL;
+    if (Strgrp_unlock(self) || !values) {
+        Py_XDECREF(values);
+        Py_XDECREF(data);
+        Py_DECREF(load);
+        return NULL;
+    }
+    return Py_BuildValue("N(NN)", load, data, values);
+}
+
+// Construct an instance from the keyword arguments, and add the items
+static PyObject *
+Strgrp_build(PyObject *cls, PyObject *args, PyObject *kwds) {
+    PyObject *empty, *self, *grps;
+    empty = PyTuple_New(0);
+    if (!empty) {
+        return NULL;
+    }
+    self = PyObject_Call(cls, empty, kwds);
+    Py_DECREF(empty);
+    if (!self) {
+        return NULL;
+    }
+    grps = Strgrp_add_many((StrgrpObject *)self, args, NULL);
+    if (!grps) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    Py_DECREF(grps);
+    return self;
+}
+
 static PyMethodDef Strgrp_methods[] = {
     { "add", (PyCFunction)Strgrp_add, (METH_VARARGS | METH_KEYWORDS),
         "Cluster a string" },
     { "grp_for", (PyCFunction)Strgrp_grp_for, (METH_VARARGS | METH_KEYWORDS),
-        "Find a cluster for a string, if one exists" },
+        "Find a cluster for a string, if one exists. The GIL is released "
+        "while searching, and searches run concurrently with each other but "
+        "not with changes to the clusters" },
+    { "remove", (PyCFunction)Strgrp_remove, (METH_VARARGS | METH_KEYWORDS),
+        "Remove the first item clustered under key with a value equal to "
+        "value, and its cluster if left empty. Raises ValueError if there "
+        "is no such item. The comparisons run while the clusters are locked "
+        "for changes, so they must not use the Strgrp; doing so raises "
+        "RuntimeError and leaves the item in place" },
+    { "rekey", (PyCFunction)Strgrp_rekey, (METH_VARARGS | METH_KEYWORDS),
+        "Remove an item as for remove() and cluster its value under "
+        "new_key, returning the new cluster. If the value can't be clustered "
+        "under new_key it is clustered under key again and MemoryError "
+        "raised" },
+    { "add_many", (PyCFunction)Strgrp_add_many, (METH_VARARGS | METH_KEYWORDS),
+        "Cluster a sequence of strings with their associated values, "
+        "returning a list of the clusters. The clusters are those given by "
+        "adding each string in turn, but each distinct string is looked up "
+        "once and the lookups are spread over the threads. The GIL is "
+        "released while clustering. If memory runs out MemoryError is "
+        "raised, and the strings clustered before then remain" },
+    { "build", (PyCFunction)Strgrp_build,
+        (METH_VARARGS | METH_KEYWORDS | METH_CLASS),
+        "build(keys, values, **kwargs)\n\n"
+        "Construct a Strgrp from the keyword arguments and cluster the keys "
+        "with their values as add_many() does" },
+    { "grp_for_many", (PyCFunction)Strgrp_grp_for_many,
+        (METH_VARARGS | METH_KEYWORDS),
+        "Find clusters for a sequence of strings, returning a list holding "
+        "a cluster or None for each. The GIL is released while searching, "
+        "and the strings are searched in parallel over the given number of "
+        "threads, by default the instance's setting" },
+    { "candidates", (PyCFunction)Strgrp_candidates,
+        (METH_VARARGS | METH_KEYWORDS),
+        "Find the k clusters best matching a string, returning a list of "
+        "(cluster, score) pairs in descending order of score. Clusters "
+        "scoring below threshold, by default the instance's, are excluded" },
+    { "stats", (PyCFunction)Strgrp_stats, METH_NOARGS,
+        "Fetch statistics as a dict: the number of clusters and items, and "
+        "counters of the lookups, the lookups answered from and missing the "
+        "cache of added strings, the candidate clusters, the candidates "
+        "rejected by the length and cosine filters and those scored by LCS, "
+        "and the seconds spent in lookups and in selecting and scoring "
+        "candidates" },
+    { "reset_stats", (PyCFunction)Strgrp_reset_stats, METH_NOARGS,
+        "Zero the lookup counters and timers" },
+    { "threads", (PyCFunction)Strgrp_threads, METH_NOARGS,
+        "The maximum number of threads each lookup scores candidates with, "
+        "or 0 for all available" },
+    { "set_threads", (PyCFunction)Strgrp_set_threads, METH_VARARGS,
+        "Set the maximum number of threads each lookup scores candidates "
+        "with, 0 meaning all available. Lookups with few candidates are "
+        "scored serially regardless" },
+    { "metric", (PyCFunction)Strgrp_metric, METH_NOARGS,
+        "The name of the similarity measure clusters are formed by" },
+    { "export", (PyCFunction)Strgrp_export, METH_NOARGS,
+        "Flatten the clusters into a tuple of four lists: the cluster keys, "
+        "the item keys and the item values in cluster order, and the offset "
+        "into the item lists of each cluster followed by the item count" },
+    { "save", (PyCFunction)Strgrp_save, METH_NOARGS,
+        "Serialise the clusters to bytes. Item values are not included, "
+        "see pystrgrp.load()" },
+    { "__reduce__", (PyCFunction)Strgrp_reduce, METH_NOARGS,
+        "Support pickling of the clusters and their item values" },
     {NULL}
 };
 
 static PyTypeObject StrgrpType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "strgrp.Strgrp",           /* tp_name */
+    "pystrgrp.Strgrp",           /* tp_name */
     sizeof(StrgrpObject),      /* tp_basicsize */
     0,                         /* tp_itemsize */
     &Strgrp_dealloc,            /* tp_dealloc */
@@ -329,7 +1387,20 @@ static PyTypeObject StrgrpType = {
     0,                         /* tp_setattro */
     0,                         /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT,        /* tp_flags */
-    "Strgrp object",           /* tp_doc */
+    "Strgrp(threshold=0.85, threads=0, bands=0, rows=4, upper=False, "
+    "collapse=False, stop=None, metric='nlcs')\n\n"
+    "Cluster strings whose similarity is at least threshold. The similarity "
+    "is measured by the normalised LCS length for metric 'nlcs', by the "
+    "Jaccard similarity of the whitespace-separated tokens for 'jaccard', or "
+    "by the Dice coefficient of the character bigrams for 'dice'; the latter "
+    "two are much cheaper to score. If bands "
+    "is set, candidate clusters are selected approximately by bands of rows "
+    "MinHash values rather than exhaustively, which keeps lookups fast over "
+    "many clusters but may miss the best match. Keys are normalised before "
+    "use by replacing each of the stop phrases, matched case-sensitively, "
+    "with a space, then folding to upper case if upper is set and collapsing "
+    "runs of whitespace to a single space and trimming it if collapse is set, "
+    "as str.upper() and str.split() do", /* tp_doc */
     0,                         /* tp_traverse */
     0,                         /* tp_clear */
     0,                         /* tp_richcompare */
@@ -349,12 +1420,83 @@ static PyTypeObject StrgrpType = {
     Strgrp_new,                /* tp_new */
 };
 
+static PyObject *
+pystrgrp_load(PyObject *module, PyObject *args, PyObject *kwds) {
+    Py_buffer data;
+    PyObject *values_arg, *values = NULL;
+    StrgrpObject *self = NULL;
+    struct strgrp *grp;
+    void **cvalues = NULL;
+    Py_ssize_t i, n;
+    static char *kwlist[] = { "data", "values", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*O", kwlist, &data,
+                &values_arg)) {
+        return NULL;
+    }
+    values = PySequence_Tuple(values_arg);
+    if (!values) {
+        goto out;
+    }
+    n = PyTuple_GET_SIZE(values);
+    cvalues = PyMem_Malloc((n ? n : 1) * sizeof(*cvalues));
+    if (!cvalues) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (i = 0; i < n; i++) {
+        cvalues[i] = PyTuple_GET_ITEM(values, i);
+    }
+    self = (StrgrpObject *)Strgrp_new(&StrgrpType, NULL, NULL);
+    if (!self) {
+        goto out;
+    }
+    grp = strgrp_load(data.buf, data.len, cvalues, n);
+    if (!grp) {
+        PyErr_SetString(PyExc_ValueError,
+                "data is not a serialised Strgrp, or does not match values");
+        Py_CLEAR(self);
+        goto out;
+    }
+    // The loaded instance now holds a reference to each value
+    for (i = 0; i < n; i++) {
+        Py_INCREF(PyTuple_GET_ITEM(values, i));
+    }
+    strgrp_set_fold(grp, Strgrp_fold, NULL);
+    self->grp = grp;
+    self->thresh = strgrp_threshold(grp);
+out:
+    PyMem_Free(cvalues);
+    Py_XDECREF(values);
+    PyBuffer_Release(&data);
+    return (PyObject *)self;
+}
+
+static PyObject *
+pystrgrp_fail_adds(PyObject *module, PyObject *args) {
+    Py_ssize_t n;
+    if (!PyArg_ParseTuple(args, "n", &n)) {
+        return NULL;
+    }
+    fail_adds = n > 0 ? n : 0;
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef Module_methods[] = {
+    { "load", (PyCFunction)pystrgrp_load, (METH_VARARGS | METH_KEYWORDS),
+        "Reconstruct a Strgrp from the output of Strgrp.save() and the item "
+        "values, ordered as they are visited by iterating over each cluster" },
+    { "_fail_adds", (PyCFunction)pystrgrp_fail_adds, METH_VARARGS,
+        "Fail the next n additions of single items, by add() and rekey(), as "
+        "if out of memory. For testing the error paths" },
+    {NULL}
+};
+
 static PyModuleDef StrgrpModule = {
     PyModuleDef_HEAD_INIT,
-    "strgrp",
+    "pystrgrp",
     "Cluster strings based on longest common subsequence",
     -1,
-    NULL, NULL, NULL, NULL, NULL
+    Module_methods, NULL, NULL, NULL, NULL
 };
 
 PyMODINIT_FUNC
@@ -19,6 +19,7 @@
 import argparse
 import csv
 import collections
+import logging
 from pystrgrp import Strgrp
 import math
 from .core import categories
@@ -36,6 +37,8 @@ cmd_help = \
 Entry = collections.namedtuple("Entry", ("date", "amount", "description"))
 TaggedEntry = collections.namedtuple("TaggedEntry", ("entry", "tag"))
 
+logger = logging.getLogger(__name__)
+
 
 class _Tagger(object):
     def __init__(self, fuzzer=None):
@@ -64,7 +67,7 @@ class _Tagger(object):
             return _Tagger.find_category(needle, categories)
 
     def _bin2hist(self, grpbin):
-        return collections.Counter(x.value().tag for x in grpbin)
+        return collections.Counter(x.tag for x in grpbin.values())
 
     def _tag_for(self, grpbin):
         if grpbin is None:
@@ -112,6 +115,12 @@ class _Tagger(object):
     def add(self, entry, category):
         self._strgrp.add(entry.description, TaggedEntry(entry, category))
 
+    def add_many(self, tagged):
+        self._strgrp.add_many([ x.entry.description for x in tagged ], tagged)
+
+    def stats(self):
+        return self._strgrp.stats()
+
 def name():
     return __name__.split(".")[-1]
 
@@ -126,13 +135,29 @@ def parse_args(subparser=None):
             help="Prompt for confirmation after each entry has been annotated with a category")
     return [ parser ] if subparser else parser.parse_args()
 
+def _leading_tagged(rows):
+    """Collect the leading run of rows with known categories"""
+    tagged = []
+    for row in rows:
+        if 4 != len(row):
+            break
+        try:
+            category = _Tagger.resolve_category(row[3])
+        except ValueError:
+            break
+        tagged.append(TaggedEntry(Entry(*row[:3]), category))
+    return tagged
+
 def annotate(src, confirm=False):
-    annotated = []
+    # Skip empty lines
+    rows = [ row for row in src if 0 != len(row) ]
+    # The rows up to the first needing input are added in one batch, which
+    # groups them as adding them in turn would
+    tagged = _leading_tagged(rows)
     t = _Tagger()
-    for row in src:
-        if 0 == len(row):
-            # Skip empty lines
-            continue
+    t.add_many(tagged)
+    annotated = [ list(x.entry) + [ x.tag ] for x in tagged ]
+    for row in rows[len(tagged):]:
         entry = Entry(*row[:3])
         category = None
         if 4 == len(row):
@@ -154,6 +179,7 @@ def annotate(src, confirm=False):
         output.extend(entry)
         output.append(category)
         annotated.append(output)
+    logger.debug("Tagger statistics: %s", t.stats())
     return annotated
 
 def main(args=None):
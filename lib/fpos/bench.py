@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#
+#    Benchmarks the grouping of transaction descriptions
+#    Copyright (C) 2015  Andrew Jeffery <andrew@aj.id.au>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import csv
+from collections import Counter
+import sys
+import time
+import pystrgrp
+
+cmd_description = \
+        """Measures the grouping of transaction descriptions. The most recent
+        transactions in an IR document are grouped at a range of sample sizes
+        and thresholds, and the timings and filter counts are written as CSV.
+        Each similarity metric's grouping is compared pairwise with that of
+        the exact LCS measure: precision is the share of the metric's grouped
+        pairs also grouped by the LCS, and recall the share of the LCS's
+        grouped pairs also grouped by the metric. The output matches that of
+        ext/bench, which reads descriptions rather than an IR document"""
+
+cmd_help = \
+        """Benchmark the grouping of descriptions from an IR document"""
+
+columns = [ "threshold", "size", "groups", "metric", "pair_precision",
+        "pair_recall", "seconds", "lookups_per_s",
+        "select_s", "score_s", "candidates", "len_rejected", "cos_rejected",
+        "lcs_scored" ]
+
+# As printed by ext/bench
+formats = [ "{:.2f}", "{}", "{}", "{}", "{:.4f}", "{:.4f}", "{:.6f}", "{:.0f}",
+        "{:.6f}", "{:.6f}", "{}", "{}", "{}", "{}" ]
+
+metrics = [ "nlcs", "jaccard", "dice" ]
+
+def name():
+    return __name__.split(".")[-1]
+
+def parse_args(subparser=None):
+    parser_init = subparser.add_parser if subparser else argparse.ArgumentParser
+    parser = parser_init(name(), description=cmd_description, help=cmd_help)
+    parser.add_argument("infile", metavar="INPUT", type=argparse.FileType('r'),
+            help="The IR document providing the descriptions")
+    parser.add_argument("--sizes", metavar="N", type=int, nargs="+",
+            help="The sample sizes, by default multiples of --step")
+    parser.add_argument("--step", metavar="N", type=int, default=500,
+            help="The interval between the default sample sizes")
+    parser.add_argument("--runs", metavar="N", type=int, default=10,
+            help="The number of runs at each size and threshold")
+    parser.add_argument("--thresholds", metavar="T", type=float, nargs="+",
+            default=[ 0.85 ], help="The grouping thresholds")
+    parser.add_argument("--threads", metavar="N", type=int, default=0,
+            help="The number of threads to score candidates with, by default "
+            "all available")
+    parser.add_argument("--lsh", metavar=("BANDS", "ROWS"), type=int, nargs=2,
+            help="Select candidate groups approximately with the given "
+            "number of MinHash bands and rows per band")
+    parser.add_argument("--metrics", metavar="METRIC", nargs="+",
+            choices=metrics, default=[ "nlcs" ],
+            help="The similarity metrics to group with, of {}".format(
+                ", ".join(metrics)))
+    parser.add_argument("--samples", action="store_true", default=False,
+            help="Write the time of each run in the form of "
+            "scraps/*-strgrp-samples.csv")
+    return [ parser ] if subparser else parser.parse_args()
+
+def run(descriptions, threshold, threads=0, lsh=None, metric="nlcs"):
+    """Group the descriptions, returning the elapsed time, the index of each
+    description's group and the grouper's statistics"""
+    bands, rows = lsh or (0, 4)
+    grouper = pystrgrp.Strgrp(threshold, threads, bands, rows, metric=metric)
+    start = time.perf_counter()
+    grouper.add_many(descriptions, list(range(len(descriptions))))
+    elapsed = time.perf_counter() - start
+    _, _, values, offsets = grouper.export()
+    labels = [ 0 ] * len(descriptions)
+    for i, (s, e) in enumerate(zip(offsets, offsets[1:])):
+        for v in values[s:e]:
+            labels[v] = i
+    return elapsed, labels, grouper.stats()
+
+def _pairs(counts):
+    return sum(n * (n - 1) // 2 for n in counts)
+
+def agreement(expected, labels):
+    """The pairwise precision and recall of the grouping labels against the
+    grouping expected, both given as a group index per description"""
+    both = _pairs(Counter(zip(expected, labels)).values())
+    found = _pairs(Counter(labels).values())
+    wanted = _pairs(Counter(expected).values())
+    return (both / found if found else 1.0), (both / wanted if wanted else 1.0)
+
+def bench(descriptions, sizes, thresholds, runs, threads=0, lsh=None,
+        metrics=( "nlcs", )):
+    """Yield a tuple per threshold, sample size and metric of the run times and
+    a row of the columns for the fastest run"""
+    for threshold in thresholds:
+        for size in sizes:
+            sample = descriptions[-size:]
+            expected = None
+            for metric in metrics:
+                results = [ run(sample, threshold, threads, lsh, metric)
+                        for i in range(runs) ]
+                elapsed, labels, stats = min(results, key=lambda x: x[0])
+                if metric == "nlcs" and not lsh:
+                    expected = labels
+                elif expected is None:
+                    expected = run(sample, threshold, threads)[1]
+                precision, recall = agreement(expected, labels)
+                row = [ threshold, len(sample), len(set(labels)), metric,
+                        precision, recall, elapsed,
+                        stats["n_lookups"] / elapsed if elapsed > 0 else 0,
+                        stats["t_select"], stats["t_score"], stats["n_cands"],
+                        stats["n_len_rejected"], stats["n_cos_rejected"],
+                        stats["n_lcs"] ]
+                yield [ r[0] for r in results ], row
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+    descriptions = [ r[2].upper() for r in csv.reader(args.infile) if len(r) > 2 ]
+    sizes = args.sizes or list(range(args.step, len(descriptions) + 1, args.step))
+    results = bench(descriptions, sizes, args.thresholds, args.runs,
+            args.threads, args.lsh, args.metrics)
+    if args.samples:
+        for times, row in results:
+            print("{}, ".format(row[1]) +
+                    "".join("{:.2f}, ".format(t) for t in times))
+    else:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        for times, row in results:
+            writer.writerow(f.format(v) for f, v in zip(formats, row))
+
+if __name__ == "__main__":
+    main()
@@ -19,12 +19,15 @@
 import pystrgrp
 import csv
 import argparse
+import logging
 
 cmd_description = \
         """Coalesce transaction descriptions"""
 
 cmd_help = cmd_description
 
+logger = logging.getLogger(__name__)
+
 def name():
     return __name__.split(".")[-1]
 
@@ -35,9 +38,11 @@ def parse_args(subparser=None):
             help="The IR document containing un-categorised transactions")
     return [ parser ] if subparser else parser.parse_args()
 
+stop_phrases = [ "VISA DEBIT PURCHASE CARD", "EFTPOS", "\\" ]
+
 def sanitise(value, strip=None):
     if strip is None:
-        strip = [ "VISA DEBIT PURCHASE CARD", "EFTPOS", "\\" ]
+        strip = stop_phrases
     for phrase in strip:
         value = value.replace(phrase, " ")
     return value
@@ -87,25 +92,33 @@ def retain_unique_inter_tokens(groups):
                 prev = g[0]
     return rev_descs
 
+def grouped_values(grouper):
+    keys, _, values, offsets = grouper.export()
+    return [ [ k, values[s:e] ] for k, s, e in zip(keys, offsets, offsets[1:]) ]
+
 def cdesc(reader):
-    grouper = pystrgrp.Strgrp()
-    for r in reader:
-        grouper.add(" ".join(sanitise(r[2]).split()).upper(), r)
-    groups = [ [ [x.key(), x.value()] for x in g ] for g in grouper ]
+    rows = list(reader)
+    grouper = pystrgrp.Strgrp(upper=True, collapse=True, stop=stop_phrases)
+    grouper.add_many([ r[2] for r in rows ], rows)
+    _, keys, values, offsets = grouper.export()
+    groups = [ [ [ k, v ] for k, v in zip(keys[s:e], values[s:e]) ]
+            for s, e in zip(offsets, offsets[1:]) ]
+    logger.debug("Description grouping statistics: %s", grouper.stats())
     intra_common = []
     for g in groups:
         intra_common.append(retain_common_intra_tokens(g))
-    grouper2 = pystrgrp.Strgrp()
-    for g in intra_common:
-        for m in g:
-            grouper2.add(m[0].upper(), m[1])
-    groups2 = [ [ g.key(), [ x.value() for x in g ] ] for g in grouper2 ]
+    members = [ m for g in intra_common for m in g ]
+    grouper2 = pystrgrp.Strgrp(upper=True)
+    grouper2.add_many([ m[0] for m in members ],
+            [ m[1] for m in members ])
+    groups2 = grouped_values(grouper2)
+    logger.debug("Common token grouping statistics: %s", grouper2.stats())
     inter_unique = retain_unique_inter_tokens(groups2)
-    grouper3 = pystrgrp.Strgrp()
-    for g in inter_unique:
-        for m in g[1]:
-            grouper3.add(g[0].upper(), m)
-    groups3 = [ [ g.key(), [ x.value() for x in g ] ] for g in grouper3 ]
+    members = [ (g[0], m) for g in inter_unique for m in g[1] ]
+    grouper3 = pystrgrp.Strgrp(upper=True)
+    grouper3.add_many([ m[0] for m in members ], [ m[1] for m in members ])
+    groups3 = grouped_values(grouper3)
+    logger.debug("Unique token grouping statistics: %s", grouper3.stats())
     return [ x[1] for x in groups3 ]
 
 def main(args=None):
@@ -18,11 +18,10 @@
 
 import argparse
 import csv
-import datetime
 import hashlib
 import itertools
 import sys
-from .core import date_fmt
+from .core import row_cents, row_day
 
 cmd_description = \
         """Merges multiple IR documents into one time-ordered IR document. This
@@ -61,10 +60,9 @@ def combine(sources):
     def _gen():
         entries = dict((digest_entry(x), x)
                 for db in sources for x in db if 3 <= len(x))
-        datesort = lambda x: datetime.datetime.strptime(x[0], date_fmt).date()
-        costsort = lambda x: float(x[1])
-        descsort = lambda x: x[2]
-        for v in sorted(sorted(sorted(entries.values(), key=descsort), key=costsort), key=datesort):
+        # Order by date, then amount, then description
+        key = lambda x: (row_day(x), row_cents(x), x[2])
+        for v in sorted(entries.values(), key=key):
             yield v
     return _gen()
 
@@ -14,6 +14,10 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import importlib
+import sys
+from datetime import date, datetime
+from functools import lru_cache
+import numpy as np
 
 categories = [ "Cash", "Commitment", "Dining", "Education", "Entertainment",
 "Health", "Home", "Income", "Internal", "Shopping", "Transport", "Utilities" ]
@@ -24,9 +28,272 @@ fixed = [ x for x in categories if x not in flexible ]
 date_fmt = "%d/%m/%Y"
 month_fmt = "%m/%Y"
 
+# Transactions far outnumber the days they fall on, so date strings are parsed
+# once and the results cached. The bound covers decades of daily activity.
+date_cache_size = 1 << 15
+
+@lru_cache(maxsize=date_cache_size)
+def date_ordinal(datestr):
+    """Convert an IR date string to its proleptic Gregorian day ordinal"""
+    return datetime.strptime(datestr, date_fmt).toordinal()
+
+def date_datetime(datestr):
+    """Convert an IR date string to a datetime at midnight, as strptime()
+    would"""
+    return datetime.fromordinal(date_ordinal(datestr))
+
+@lru_cache(maxsize=date_cache_size)
+def date_month(datestr):
+    """Find the month of an IR date string, in month_fmt"""
+    return date.fromordinal(date_ordinal(datestr)).strftime(month_fmt)
+
+@lru_cache(maxsize=date_cache_size)
+def date_week(datestr):
+    """Find the year and Sunday-based week number of an IR date string, in
+    the form year:week"""
+    return date.fromordinal(date_ordinal(datestr)).strftime("%Y:%U")
+
+@lru_cache(maxsize=date_cache_size)
+def month_ordinal(monthstr):
+    """Convert a month in month_fmt to the day ordinal of its first day"""
+    return datetime.strptime(monthstr, month_fmt).toordinal()
+
+@lru_cache(maxsize=date_cache_size)
+def to_ir_date(datestr, fmt):
+    """Convert a date string in the strptime() format fmt to an IR date
+    string"""
+    return datetime.strptime(datestr, fmt).strftime(date_fmt)
+
+@lru_cache(maxsize=date_cache_size)
+def ordinal_date(ordinal):
+    """Convert a day ordinal to an IR date string"""
+    return date.fromordinal(ordinal).strftime(date_fmt)
+
 def money(value):
     return "{:.2f}".format(value)
 
+def to_cents(value):
+    """Convert an IR amount, as a string or number of dollars, to integer
+    cents"""
+    return int(round(float(value) * 100))
+
+def money_cents(cents):
+    """Format integer cents as an IR amount, as money() would the equivalent
+    dollars"""
+    sign = "-" if cents < 0 else ""
+    dollars, cents = divmod(abs(cents), 100)
+    return "{}{}.{:02d}".format(sign, dollars, cents)
+
+class Transaction(object):
+    """A compact, typed IR row
+
+    Dates are held as day ordinals, amounts as integer cents, and descriptions
+    and categories are interned, with a category of None marking an
+    unannotated transaction. Conversion to and from the string form happens
+    only at the CSV boundary through from_row() and to_row(), though a
+    Transaction can be indexed like the row it was parsed from so existing row
+    consumers continue to work.
+    """
+    __slots__ = ("day", "cents", "description", "category")
+
+    def __init__(self, day, cents, description, category=None):
+        self.day = day
+        self.cents = cents
+        self.description = description
+        self.category = category
+
+    @classmethod
+    def from_row(cls, row):
+        category = sys.intern(row[3]) if len(row) >= 4 and row[3] else None
+        return cls(date_ordinal(row[0]), to_cents(row[1]),
+                sys.intern(row[2]), category)
+
+    def to_row(self):
+        row = [ self.date, self.amount, self.description ]
+        if self.category is not None:
+            row.append(self.category)
+        return row
+
+    @property
+    def date(self):
+        return ordinal_date(self.day)
+
+    @property
+    def amount(self):
+        return money_cents(self.cents)
+
+    def __len__(self):
+        return 3 if self.category is None else 4
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.to_row()[i]
+        if i < 0:
+            i += len(self)
+        if 0 == i:
+            return self.date
+        if 1 == i:
+            return self.amount
+        if 2 == i:
+            return self.description
+        if 3 == i and self.category is not None:
+            return self.category
+        raise IndexError("Transaction index out of range")
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return ((self.day, self.cents, self.description, self.category) ==
+                (other.day, other.cents, other.description, other.category))
+
+    def __hash__(self):
+        return hash((self.day, self.cents, self.description, self.category))
+
+    def __repr__(self):
+        return "Transaction({})".format(self.to_row())
+
+def transactions(rows):
+    """Parse IR rows into Transactions, skipping empty rows"""
+    return ( Transaction.from_row(r) for r in rows if r )
+
+_epoch_ordinal = date(1970, 1, 1).toordinal()
+
+class TransactionTable(object):
+    """Columnar storage for a set of transactions
+
+    The columns are NumPy arrays: day (datetime64[D]), cents (int64), code
+    (int16 index into the categories list, -1 when unannotated) and
+    description (int32 index into the descriptions list, in which each
+    distinct description appears once). The categories list starts with the
+    known categories, in order, followed by any other category names found in
+    the table, so a table holds at most 32768 distinct categories. Tables are
+    immutable; filter(), take() and sort() return new tables sharing the
+    lists. Iterating a table yields Transactions.
+    """
+    def __init__(self, day, cents, code, description, descriptions,
+            categories):
+        self.day = day
+        self.cents = cents
+        self.code = code
+        self.description = description
+        self.descriptions = descriptions
+        self.categories = categories
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Load IR rows or Transactions, skipping empty rows. Raises
+        ValueError if the rows hold more distinct categories than the code
+        column can index."""
+        ids = {}
+        cats = dict((c, i) for i, c in enumerate(categories))
+        days, cents, codes, descs = [], [], [], []
+        for r in rows:
+            if not r:
+                continue
+            if not isinstance(r, Transaction):
+                r = Transaction.from_row(r)
+            days.append(r.day)
+            cents.append(r.cents)
+            codes.append(-1 if r.category is None else
+                    cats.setdefault(r.category, len(cats)))
+            descs.append(ids.setdefault(r.description, len(ids)))
+        if len(cats) > np.iinfo(np.int16).max + 1:
+            raise ValueError("Found {} distinct categories, at most {} are "
+                    "supported".format(len(cats), np.iinfo(np.int16).max + 1))
+        day = np.array(days, dtype=np.int64) - _epoch_ordinal
+        return cls(day.astype("datetime64[D]"), np.array(cents, dtype=np.int64),
+                np.array(codes, dtype=np.int16), np.array(descs, dtype=np.int32),
+                list(ids), list(cats))
+
+    def to_rows(self):
+        """Format the table as IR rows"""
+        return [ t.to_row() for t in self ]
+
+    def __len__(self):
+        return len(self.day)
+
+    def __iter__(self):
+        ordinals = self.ordinals().tolist()
+        descs = self.descriptions
+        cats = self.categories
+        for day, cents, desc, code in zip(ordinals, self.cents.tolist(),
+                self.description.tolist(), self.code.tolist()):
+            yield Transaction(day, cents, descs[desc],
+                    cats[code] if code >= 0 else None)
+
+    def take(self, indices):
+        """Select the rows at indices, or where indices is a True mask"""
+        return TransactionTable(self.day[indices], self.cents[indices],
+                self.code[indices], self.description[indices],
+                self.descriptions, self.categories)
+
+    def filter(self, mask):
+        """Select the rows for which the boolean array mask is True"""
+        return self.take(np.asarray(mask, dtype=bool))
+
+    def annotated(self):
+        """A mask of the rows carrying a category"""
+        return self.code >= 0
+
+    def category(self, name):
+        """A mask of the rows in the named category"""
+        if name not in self.categories:
+            return np.zeros(len(self), dtype=bool)
+        return self.code == self.categories.index(name)
+
+    def months(self):
+        """The day column truncated to months, as datetime64[M]"""
+        return self.day.astype("datetime64[M]")
+
+    def weeks(self):
+        """The year and Sunday-based week number of each row, as year * 100 +
+        week, matching the "%Y:%U" numbering of date_week()"""
+        days = self.day.astype(np.int64)
+        years = self.day.astype("datetime64[Y]")
+        yday = days - years.astype("datetime64[D]").astype(np.int64)
+        # 1970-01-01 was a Thursday, four days after a Sunday
+        wday = (days + 4) % 7
+        week = (yday + 7 - wday) // 7
+        return (years.astype(np.int64) + 1970) * 100 + week
+
+    def ordinals(self):
+        """The day ordinal of each row"""
+        return self.day.astype(np.int64) + _epoch_ordinal
+
+    def sort(self):
+        """Order rows by date, then amount, then description, as combine
+        does"""
+        rank = np.empty(len(self.descriptions), dtype=np.int32)
+        order = sorted(range(len(self.descriptions)),
+                key=self.descriptions.__getitem__)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+        return self.take(np.lexsort((rank[self.description], self.cents,
+            self.day)))
+
+    def group_by(self, key):
+        """Group rows by the values of the array key, returning the sorted
+        distinct keys and the index of each row's key in them"""
+        return np.unique(key, return_inverse=True)
+
+    def sum_by(self, key):
+        """Sum cents by the values of the array key, returning the sorted
+        distinct keys and the sum of each group"""
+        keys, inverse = self.group_by(key)
+        sums = np.bincount(inverse, weights=self.cents, minlength=len(keys))
+        return keys, sums.astype(np.int64)
+
+def row_day(row):
+    """Find the day ordinal of an IR row or Transaction"""
+    if isinstance(row, Transaction):
+        return row.day
+    return date_ordinal(row[0])
+
+def row_cents(row):
+    """Find the amount of an IR row or Transaction in integer cents"""
+    if isinstance(row, Transaction):
+        return row.cents
+    return to_cents(row[1])
+
 def global_module(env, module, package=None, name=None):
     env[module if name is None else name] = importlib.import_module(module, package)
 
@@ -18,10 +18,11 @@
 
 from .annotate import annotate
 from .combine import combine
+from .core import TransactionTable
 from configparser import ConfigParser
 from itertools import chain
 from .transform import transform
-from .window import window
+from .window import window_table
 from .visualise import visualise
 from xdg import BaseDirectory as bd
 import argparse
@@ -91,7 +92,9 @@ def db_show(args):
     config.read(config_file)
     db_file = config[args.nickname]["path"]
     with open(db_file, "r") as db:
-        visualise(list(window(csv.reader(db), relspan=12)), save=args.save)
+        table = window_table(TransactionTable.from_rows(csv.reader(db)),
+                relspan=12)
+        visualise(table, save=args.save)
 
 def parse_args(subparser):
     sc_init = subparser.add_parser("init")
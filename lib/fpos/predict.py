@@ -17,20 +17,21 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import logging
 import pystrgrp
 import csv
+import sys
 import numpy as np
 from datetime import datetime, timedelta
 from itertools import chain, cycle, islice
-from .core import money
+from .core import money, row_cents, row_day, TransactionTable
 import matplotlib.pyplot as plt
 
 cmd_description = \
         """Predict spending based on past habits"""
 cmd_help = cmd_description
 
-def pd(datestr):
-    return datetime.strptime(datestr, "%d/%m/%Y")
+logger = logging.getLogger(__name__)
 
 def group_deltas(group):
     """ group_deltas(group) -> list(int)
@@ -40,8 +41,8 @@ def group_deltas(group):
     list, or zero length if the input list is zero length. The input member
     list is sorted by ascending date order before the deltas are calculated.
     """
-    sm = sorted(group, key=lambda x: pd(x[0]))
-    return [ ( pd(e[0]) - pd(sm[p][0]) ).days for p, e in enumerate(sm[1:]) ]
+    days = sorted(row_day(e) for e in group)
+    return [ d - days[p] for p, d in enumerate(days[1:]) ]
 
 def group_delta_bins(deltas):
     """ group_delta_bins(deltas) -> list(int)
@@ -99,7 +100,7 @@ def last(members):
 
     Find the most recent date in a spend group.
     """
-    return max(pd(x[0]) for x in members)
+    return datetime.fromordinal(max(row_day(x) for x in members))
 
 def align(bins, delta):
     """ align(bins, delta) -> list(float)
@@ -144,7 +145,7 @@ def group_forecast(members, date, debug=False):
     if not members:
         raise ValueError("Requires at least one member in members list")
     bins = group_delta_bins(group_deltas(members))
-    mean = sum(float(e[1]) for e in members) / (sum(bins) + 1)
+    mean = sum(row_cents(e) for e in members) / 100 / (sum(bins) + 1)
     d = (date - last(members)).days
     if 0 == len(bins):
         return []
@@ -238,7 +239,7 @@ def forecast(groups, dates, length=32):
     spend = [ 0 ] * length
     income = [ 0 ] * length
     # noise values
-    nv = [ float(b[0][1]) for b in groups if len(b) <= 2 ]
+    nv = [ row_cents(b[0]) / 100 for b in groups if len(b) <= 2 ]
     ns, ni = 0, 0
     span = (dates[1] - dates[0]).days
     if nv and span:
@@ -250,10 +251,17 @@ def forecast(groups, dates, length=32):
             d[k] += v
     return [ (v + ns) for v in spend ], [ (v + ni) for v in income ]
 
-def graph_bar_cashflow(groups, dates):
-    fl = 31 # forecast length
+# The number of days forecast by graph_bar_cashflow()
+cashflow_days = 31
+
+def graph_bar_cashflow(groups, dates, flows=None):
+    """Graph the forecast cashflow. flows may supply the result of a forecast
+    over at least cashflow_days, in which case groups is not consulted"""
+    fl = cashflow_days # forecast length
     gl = fl + 2 # graph length
-    ey, iy = forecast(groups, dates, fl)
+    if flows is None:
+        flows = forecast(groups, dates, fl)
+    ey, iy = [ f[:fl] for f in flows ]
     bs = bottoms(list(chain(*zip(ey, iy))))
     ex = [ x + 0.1 for x in range(1, len(ey) + 1)]
     be = plt.bar(ex, ey, bottom=bs[::2], color="r", width=0.3)
@@ -282,7 +290,7 @@ def print_periodic_expenses(groups, date):
         len(gb[0]),
         #period(gb[1]),
         icmf(gb[1]),
-        sum(float(e[1]) for e in gb[0]) / (sum(gb[1]) + 1))
+        sum(row_cents(e) for e in gb[0]) / 100 / (sum(gb[1]) + 1))
             for gb in keep )
     ordered = sorted(list(table), key=lambda x: (365 / x[2]) * x[3])
     print("Description | N | Period | Mean Value | Annual Value | Monthly Value")
@@ -294,12 +302,18 @@ def print_periodic_expenses(groups, date):
 def main(args=None):
     if args is None:
         args = parse_args()
-    grouper = pystrgrp.Strgrp()
     reader = csv.reader(args.infile, dialect='excel')
-    dates = [ None, None ]
-    for r in reader:
-        if len(r) >= 4 and not "Internal" == r[3]:
-            grouper.add(r[2].upper(), r)
-            dates[0] = pd(r[0]) if not dates[0] else min(pd(r[0]), dates[0])
-            dates[1] = pd(r[0]) if not dates[1] else max(pd(r[0]), dates[1])
-    graph_bar_cashflow([ list(i.data() for i in g) for g in grouper ], dates, 32)
+    table = TransactionTable.from_rows(reader)
+    rows = list(table.filter(table.annotated() & ~table.category("Internal")))
+    if not rows:
+        print("No annotated transactions outside the Internal category in {}, "
+                "cannot predict".format(args.infile.name))
+        sys.exit(1)
+    grouper = pystrgrp.Strgrp(upper=True)
+    grouper.add_many([ t.description for t in rows ], rows)
+    logger.debug("Description grouping statistics: %s", grouper.stats())
+    days = [ datetime.fromordinal(t.day) for t in rows ]
+    dates = [ min(days), max(days) ]
+    _, _, values, offsets = grouper.export()
+    graph_bar_cashflow([ values[s:e] for s, e in zip(offsets, offsets[1:]) ],
+            dates)
@@ -18,12 +18,13 @@
 
 import argparse
 import csv
+import re
 import sys
-from datetime import datetime
+from collections import Counter
 import dateutil.parser as dp
 from .core import money
-from .core import date_fmt
-from itertools import chain
+from .core import to_ir_date
+from itertools import chain, islice
 
 transform_choices = sorted([ "auto", "anz", "commbank", "stgeorge", "nab", "bankwest", "woolworths" ])
 cmd_description = \
@@ -78,17 +79,52 @@ sense[(_DATE, _STRING, _EMPTY, _NUMBER, _NUMBER, _STRING, _STRING, _EMPTY)] = "w
 sense[(_DATE, _STRING, _NUMBER, _EMPTY, _NUMBER, _STRING, _STRING, _EMPTY)] = "woolworths"
 sense[(_DATE, _STRING, _NUMBER, _EMPTY, _EMPTY, _STRING, _STRING, _EMPTY)] = "woolworths"
 
+# The number of leading rows sampled to sense the form of a document
+sense_rows = 100
+
+_months = "jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec"
+_day = r"(?:0?[1-9]|[12]\d|3[01])"
+
+# The date formats the supported banks emit: dd/mm/yyyy (and the IR's own),
+# dd-Mon-yy (NAB) and dd Mon yyyy (Woolworths). Each alternative is a group,
+# and _bank_date_fmts holds the strptime() format of each in turn.
+_bank_date = re.compile(r"({d}/(?:0?[1-9]|1[0-2])/\d{{4}})"
+        r"|({d}/(?:0?[1-9]|1[0-2])/\d{{2}})"
+        r"|({d}-(?:{m})-\d{{2}})"
+        r"|({d}-(?:{m})-\d{{4}})"
+        r"|({d} (?:{m}) \d{{4}})".format(d=_day, m=_months), re.IGNORECASE)
+_bank_date_fmts = [ "%d/%m/%Y", "%d/%m/%y", "%d-%b-%y", "%d-%b-%Y",
+        "%d %b %Y" ]
+
 def _is_empty(x):
     return x is None or "" == x
 
-def _is_date(x):
+def _parses_as_date(x):
     try:
         dp.parse(x)
         return True
+    except (ValueError, OverflowError):
+        pass
+    return False
+
+def _is_bank_date(x):
+    # The pattern doesn't check the day against the month, so confirm a match
+    # with strptime()
+    m = _bank_date.fullmatch(x)
+    if not m:
+        return False
+    try:
+        to_ir_date(x, _bank_date_fmts[m.lastindex - 1])
+        return True
     except ValueError:
         pass
     return False
 
+def _is_date(x):
+    # dateutil is slow and accepts all manner of strings, so only ask it about
+    # cells that aren't in a bank's format
+    return _is_bank_date(x) or _parses_as_date(x)
+
 def _is_number(x):
     try:
         float(x)
@@ -109,8 +145,33 @@ def _compute_cell_type(x):
             raise ValueError("Parameter is None when it should not be")
         return _STRING
 
-def _compute_type_tuple(row):
-    return tuple(_compute_cell_type(x) for x in row)
+def _fast_cell_type(x):
+    """The type of the cell if it can be found without dateutil, otherwise
+    None"""
+    if _is_empty(x):
+        return _EMPTY
+    elif _is_number(x):
+        return _NUMBER
+    elif _is_bank_date(x):
+        return _DATE
+    return None
+
+def _compute_type_tuple(row, cells=None):
+    """Find the type of each cell in the row. If cells is a dict, it memoises
+    the types of the cells left for dateutil by their text. Descriptions
+    repeat across the rows of a document, so most then need no dateutil call
+    after their first."""
+    if cells is None:
+        return tuple(_compute_cell_type(x) for x in row)
+    types = []
+    for x in row:
+        t = _fast_cell_type(x)
+        if t is None:
+            t = cells.get(x)
+            if t is None:
+                t = cells[x] = _compute_cell_type(x)
+        types.append(t)
+    return tuple(types)
 
 def _sense_form(row, debug=False):
     if debug:
@@ -120,10 +181,24 @@ def _sense_form(row, debug=False):
         print(tt)
     return sense[tt]
 
-def _acquire_form(row):
+def _sense_rows(rows):
+    """Sense the form of a document from a sample of its rows, taking the form
+    of the most rows. Rows matching no form, such as headers, are ignored, and
+    ties go to the form seen first. Raises KeyError if no row matches."""
+    cells = {}
+    votes = Counter()
+    for row in rows:
+        form = sense.get(_compute_type_tuple(row, cells))
+        if form:
+            votes[form] += 1
+    if not votes:
+        raise KeyError("No row matches a known form")
+    return votes.most_common(1)[0][0]
+
+def _acquire_form(rows):
     guess = None
     try:
-        guess = _sense_form(row)
+        guess = _sense_rows(rows)
     except KeyError:
         pass
     need = True
@@ -142,9 +217,9 @@ def _acquire_form(row):
     return form
 
 def transform_auto(csv, confirm):
-    first = next(csv)
-    form = _acquire_form(first, confirm) if confirm else _sense_form(first)
-    return transform(form, chain([first], csv))
+    sample = list(islice(csv, sense_rows))
+    form = _acquire_form(sample) if confirm else _sense_rows(sample)
+    return transform(form, chain(sample, csv))
 
 def transform_commbank(csv, args=None):
     # Commbank format:
@@ -177,7 +252,7 @@ def transform_nab(csv, args=None):
     def _gen():
         for l in csv:
             if l:
-                ir_date = datetime.strptime(l[0], _nab_date_fmt).strftime(date_fmt)
+                ir_date = to_ir_date(l[0], _nab_date_fmt)
                 ir_amount = money(float(l[1]))
                 ir_description = " ".join(e for e in l[4:6] if (e is not None and "" != e ))
                 yield [ ir_date, ir_amount, ir_description ]
@@ -209,7 +284,7 @@ def transform_woolworths(csv, args=None):
             else:
                 # Credit
                 amount = money(float(line[3]))
-            date = datetime.strptime(line[0], _woolies_date_fmt).strftime(date_fmt)
+            date = to_ir_date(line[0], _woolies_date_fmt)
             yield [date, amount, line[1]]
     return _gen()
 
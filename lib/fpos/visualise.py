@@ -22,11 +22,13 @@ import calendar
 from datetime import datetime, timedelta
 import itertools
 import math
+import numpy as np
 from .core import categories, flexible, fixed
-from .core import money
-from .core import date_fmt, month_fmt
+from .core import money, month_fmt, row_cents, TransactionTable
+from .core import date_month, date_ordinal, date_week, month_ordinal
 import pystrgrp
-from .predict import forecast, graph_bar_cashflow, print_periodic_expenses
+from .predict import cashflow_days, forecast, graph_bar_cashflow
+from .predict import print_periodic_expenses
 from .cdesc import cdesc
 
 cmd_description = \
@@ -45,12 +47,12 @@ cmd_help = \
 blacklist = ("Income", "Internal")
 whitelist = [x for x in categories if x not in blacklist]
 
-extract_month = lambda x: datetime.strptime(x, date_fmt).strftime("%m/%Y")
-extract_week = lambda x: datetime.strptime(x, date_fmt).strftime("%Y:%U")
+extract_month = date_month
+extract_week = date_week
 extract_day = lambda x: x
-datesort = lambda x : datetime.strptime(x, date_fmt).date()
-monthsort = lambda x : datetime.strptime(x, month_fmt).date()
-monthname = lambda x : datetime.strptime(x, month_fmt).strftime("%b")
+datesort = date_ordinal
+monthsort = month_ordinal
+monthname = lambda x : datetime.fromordinal(month_ordinal(x)).strftime("%b")
 
 class PeriodGroup(object):
     def __init__(self, *extractors):
@@ -76,8 +78,8 @@ class PeriodGroup(object):
 def sum_categories(data):
     summed = dict((x, 0) for x in categories)
     for row in data:
-        summed[row[3]] += float(row[1])
-    return summed
+        summed[row[3]] += row_cents(row)
+    return dict((k, v / 100) for k, v in summed.items())
 
 def sum_expenses(expenses):
     summed = {}
@@ -125,6 +127,43 @@ def surplus(expenses, income):
         s[m] = income[m] + sum(c.values())
     return s
 
+class PeriodMatrix(object):
+    """Dense period by category sums of a TransactionTable
+
+    key assigns each row of the table to a period. The distinct keys, in sorted
+    order, label the rows of sums, a float array of dollars whose columns
+    follow categories. The matrix is computed in a single pass by bincount over
+    the combined period and category codes; unannotated rows are ignored.
+    """
+    def __init__(self, table, key):
+        n_cats = len(categories)
+        valid = (table.code >= 0) & (table.code < n_cats)
+        self.periods, inverse = table.group_by(key)
+        flat = inverse[valid] * n_cats + table.code[valid]
+        cents = np.bincount(flat, weights=table.cents[valid],
+                minlength=len(self.periods) * n_cats)
+        self.sums = cents.reshape(len(self.periods), n_cats) / 100
+
+    def __len__(self):
+        return len(self.periods)
+
+    def column(self, category):
+        return self.sums[:, categories.index(category)]
+
+    def columns(self, names):
+        return self.sums[:, [ categories.index(c) for c in names ]]
+
+    def expenses(self):
+        """Sums of the whitelisted categories, one column per category"""
+        return self.columns(whitelist)
+
+    def income(self):
+        return self.column("Income")
+
+def month_labels(periods):
+    """Format datetime64[M] periods in month_fmt"""
+    return [ m.strftime(month_fmt) for m in periods.astype(object) ]
+
 def colours(n):
     return plt.cm.BuPu(np.linspace(0, 1.0, n))
 
@@ -162,22 +201,19 @@ def bar_label(plot, rects, values, oriented="v", offset=130):
         text = '\${}'.format(int(values[i]))
         plot.text(x, y, text, ha='center', va='bottom')
 
-def q1(boxprop):
-    return boxprop.get_data()[1][2]
-
-def q3(boxprop):
-    return boxprop.get_data()[1][1]
-
 def mean_error(data, level=0.95):
-    n, min_max, mean, var, skew, kurt = stats.describe(data)
-    dscale = math.sqrt(var) / math.sqrt(len(data))
+    """Half the width of the confidence interval of the mean of each column
+    of data"""
+    mean = np.mean(data, axis=0)
+    dscale = np.std(data, axis=0, ddof=1) / math.sqrt(len(data))
     R = stats.norm.interval(level, loc=mean, scale=dscale)
     return R[1] - mean
 
-def graph_stacked_bar_expenses(months, monthlies, expenses, m_income, remaining):
-    # Looks like:
-    # { "04/2013" : 3905.07, ... }
-    m_margin = surplus(expenses, m_income)
+def graph_stacked_bar_expenses(months, monthly, remaining):
+    expenses = monthly.expenses()
+    m_income = monthly.income()
+    spent = expenses.sum(axis=1)
+    m_margin = m_income + spent
     # Plot table/bar-graph of expenses
     n_months = len(months)
     y_offset = np.array([0.0] * n_months)
@@ -186,13 +222,13 @@ def graph_stacked_bar_expenses(months, monthlies, expenses, m_income, remaining)
     palette = colours(len(whitelist))
     # Add colours for metadata rows total, income and surplus
     plt.figure(1)
-    for i, row in enumerate(monthlies):
+    for i, row in enumerate(expenses.T):
         plt.bar(np.arange(n_months) + 0.3, row, bar_width, bottom=y_offset, color=palette[i])
         y_offset = y_offset + row
-        cell_text.append([money(float(x)) for x in row])
-    cell_text.append([money(sum(expenses[m].values())) for m in months])
-    cell_text.append([money(m_income[k]) for k in months])
-    cell_text.append([money(m_margin[k]) for k in months])
+        cell_text.append([money(x) for x in row])
+    cell_text.append([money(x) for x in spent])
+    cell_text.append([money(x) for x in m_income])
+    cell_text.append([money(x) for x in m_margin])
     plt.table(cellText=cell_text,
         rowLabels=whitelist + [ "Expenditure", "Income", "Surplus" ],
         # Add white for metadata
@@ -206,24 +242,22 @@ def graph_stacked_bar_expenses(months, monthlies, expenses, m_income, remaining)
     plt.grid(axis="y")
     plt.title("Expenditures by Category per Month\n{} Day(s) Remaining in {}".format(remaining, months[-1]))
 
-def graph_bar_margin(months, m_income, expenses, remaining, save=0):
+def graph_bar_margin(months, monthly, remaining, save=0):
     if 1 == len(months):
         # Need more than one month's data
         print("Cannot display bar_margin, not enough data")
         return
-    # Looks like:
-    # { "04/2013" : 3905.07, ... }
-    m_margin = surplus(expenses, m_income)
+    m_margin = monthly.income() + monthly.expenses().sum(axis=1)
     # Plot bar graph of margin
     f = plt.figure(2)
-    _graph_bar_margin_previous(plt.subplot(121), months[:-1], m_margin)
-    _graph_bar_margin_current(plt.subplot(222), months, m_income, expenses, save)
-    _graph_bar_margin_spending(plt.subplot(224), months, m_income, expenses, save, remaining)
+    _graph_bar_margin_previous(plt.subplot(121), months[:-1], m_margin[:-1])
+    _graph_bar_margin_current(plt.subplot(222), monthly, save)
+    _graph_bar_margin_spending(plt.subplot(224), monthly, save, remaining)
     f.suptitle("Remaining Capital after Expenses\n{} Days Remaining".format(remaining))
 
-def _graph_bar_margin_previous(plot, months, m_margin):
+def _graph_bar_margin_previous(plot, months, margins):
     n_months = len(months)
-    sorted_margins = [m_margin[k] for k in months]
+    sorted_margins = list(margins)
     mbar = plot.bar(np.arange(n_months), sorted_margins, 0.6, align="center")
     bar_label(plot, mbar, sorted_margins)
     plot.axhline(0, color="black")
@@ -235,12 +269,12 @@ def _graph_bar_margin_previous(plot, months, m_margin):
     plot.set_xticklabels(months, rotation=30)
     plot.grid(axis="y")
 
-def _graph_bar_margin_current(plot, months, m_income, expenses, save):
-    c_month = months[-1]
-    c_expenses = sum(expenses[c_month].values())
-    c_income = m_income[c_month]
+def _graph_bar_margin_current(plot, monthly, save):
+    m_income = monthly.income()
+    c_expenses = monthly.expenses()[-1].sum()
+    c_income = m_income[-1]
     margin = c_income + c_expenses
-    mean_income = np.mean(list(m_income[m] for m in months[:-1]))
+    mean_income = np.mean(m_income[:-1])
     title = "Earnings and Margins"
     ylabels = [ "Income", "Margin" ]
     earnt = [ c_income, margin ]
@@ -264,11 +298,11 @@ def _graph_bar_margin_current(plot, months, m_income, expenses, save):
     plot.grid(axis="x")
     plot.legend((be, bm), ("Earnt", "Projected"))
 
-def _graph_bar_margin_spending(plot, months, m_income, expenses, save, remaining):
-    mean_income = np.mean(list(m_income[m] for m in months[:-1]))
-    c_month = months[-1]
-    c_expenses = sum(expenses[c_month].values())
-    c_income = m_income[c_month]
+def _graph_bar_margin_spending(plot, monthly, save, remaining):
+    m_income = monthly.income()
+    c_expenses = monthly.expenses()[-1].sum()
+    c_income = m_income[-1]
+    mean_income = np.mean(m_income[:-1])
     c_margin = c_income + c_expenses
     p_margin = mean_income + c_expenses
     e_per_day = max(0, (c_margin - save) / remaining)
@@ -292,24 +326,24 @@ def _graph_bar_margin_spending(plot, months, m_income, expenses, save, remaining
     plot.set_title("Spending Targets for Earnt and Projected Income")
     plot.legend(( b1, b2 ), ( "Earnt", "Projected"), loc="lower right")
 
-def graph_box_categories(months, categorized):
+def graph_box_categories(months, monthly):
     if 1 == len(months):
         # Need more than one month's data
         print("Cannot display box_categories, not enough data")
         return
     # Plot box-and-whisker plot of categories
     plt.figure(3)
-    cs = []
-    for c in whitelist:
-        # Excludes the in-progress month
-        cs.append([categorized[c][m] for m in months[:-1]])
-    bpvs = plt.boxplot(cs)
+    # Excludes the in-progress month
+    cs = monthly.expenses()[:-1]
+    plt.boxplot(cs)
+    # Expenses are negative, so the quartiles and extremes of spending are
+    # taken from the opposite ends of each column
     plt.table(cellText=[
-        [money(x.get_data()[1][0]) for x in bpvs["medians"]],
-        [money(q1(x)) for x in bpvs["boxes"]],
-        [money(q3(x)) for x in bpvs["boxes"]],
-        [money(max(c)) for c in cs],
-        [money(min(c)) for c in cs]],
+        [money(x) for x in np.median(cs, axis=0)],
+        [money(x) for x in np.percentile(cs, 75, axis=0)],
+        [money(x) for x in np.percentile(cs, 25, axis=0)],
+        [money(x) for x in cs.max(axis=0)],
+        [money(x) for x in cs.min(axis=0)]],
             rowLabels=["Median", "First Quartile", "Third Quartile", "Minimum", "Maximum"],
             colLabels=[x[:3] for x in whitelist],
             loc="bottom")
@@ -319,19 +353,19 @@ def graph_box_categories(months, categorized):
     plt.grid(axis="y")
     plt.title("Box-plot of Expenses per Month\nSamples per category: {}".format(len(months) - 1))
 
-def graph_xy_categories(months, categorized, remaining):
+def graph_xy_categories(months, monthly, remaining):
     if 1 == len(months):
         # Need more than one month's data
         print("Cannot display xy_categories, not enough data")
         return
     # XY plot of expenditure per category
-    f, plts = plt.subplots(2, int(len(categorized) / 2), sharex=True)
+    f, plts = plt.subplots(2, int(len(whitelist) / 2), sharex=True)
     f.suptitle("XY Plot of Monthly Expenditure per Category")
     complete = months[:-1]
     monthr = np.arange(len(complete))
     monthns = [ monthname(x) for x in complete ]
-    for p, k in zip(itertools.chain(*plts), whitelist):
-        v = [ categorized[k][m] for m in complete ]
+    expenses = monthly.expenses()[:-1]
+    for p, k, v in zip(itertools.chain(*plts), whitelist, expenses.T):
         # Values
         p.plot(monthr, v, 'o-')
         # Linear regression
@@ -345,9 +379,7 @@ def graph_xy_categories(months, categorized, remaining):
 
 def graph_xy_weekly(weekly):
     # Weekly XY plot with regression
-    w_summed = [(i, sum(float(r[1]) for r in weekly[w] if r[3] in whitelist))
-            for i,w in enumerate(sorted(weekly.keys()))]
-    w_xys = list(zip(*w_summed))
+    w_xys = [ np.arange(len(weekly)), weekly.expenses().sum(axis=1) ]
     plt.figure(5)
     plt.plot(w_xys[0], w_xys[1], "bo-")
     a, b = polyfit(w_xys[0], w_xys[1], 1)
@@ -358,23 +390,24 @@ def graph_xy_weekly(weekly):
     plt.ylabel("Expenditure ($)")
     plt.grid(axis="both")
 
-def graph_bar_targets(months, monthlies, expenses, m_income, remaining, want_save):
+def graph_bar_targets(months, monthly, remaining, want_save):
     if 1 == len(months):
         # Need more than one month's data
         print("Cannot display bar_targets, not enough data")
         return
     # Target bar-graph - Current spending per category against mean
     plt.figure(6)
-    # Remove the current month from monthlies
-    prev_monthlies = [ e[:-1] for e in monthlies ]
+    expenses = monthly.expenses()
+    # Remove the current month
+    prev_monthlies = expenses[:-1]
     # Calculate the means for each category of each complete month
-    mean_prev_monthlies = np.mean(prev_monthlies, axis=1)
-    error_prev_monthlies = [ mean_error(e) for e in prev_monthlies ]
-    curr_expenses = expenses[months[-1]]
+    mean_prev_monthlies = np.mean(prev_monthlies, axis=0)
+    error_prev_monthlies = mean_error(prev_monthlies)
+    curr_expenses = dict(zip(whitelist, expenses[-1]))
 
     ms = dict(zip(whitelist, mean_prev_monthlies))
     # Calculate mean monthly income
-    mean_income = np.mean([m_income[m] for m in months[:-1]])
+    mean_income = np.mean(monthly.income()[:-1])
     cash = mean_income
     # Subtract fixed costs
     cash -= abs(sum(v for k, v in ms.items() if k in fixed))
@@ -480,15 +513,14 @@ class ProgressiveMean(object):
             s.extend(x)
         return "\n".join(s)
 
-def graph_xy_progressive_mean(months, dailies, m_income, groups, dates):
-    d_categories = dict((d, sum_categories(v)) for d, v in dailies.items())
-    d_expenses = ignore(d_categories, *blacklist)
-    d_spending = dict((d, sum(v.values())) for d, v in d_expenses.items())
+def graph_xy_progressive_mean(months, dailies, m_income, spend, dates):
+    d_spending = dailies.expenses().sum(axis=1)
     pm = None
-    for k in sorted(d_spending.keys(), key=datesort):
+    for o, spent in zip(dailies.periods.tolist(), d_spending.tolist()):
+        day = datetime.fromordinal(o)
         if not pm:
-            pm = ProgressiveMean(datetime.strptime(k, date_fmt))
-        pm.update(datetime.strptime(k, date_fmt), d_spending[k])
+            pm = ProgressiveMean(day)
+        pm.update(day, spent)
     plt.figure(7)
     days_per_month = max(len(x) for x in pm.means.values())
     xs = list(range(1, days_per_month + 1))
@@ -498,7 +530,7 @@ def graph_xy_progressive_mean(months, dailies, m_income, groups, dates):
     d_current = pm.head()
     mr = calendar.monthrange(pm.prev.year, pm.prev.month)
     remaining = (mr[1] - dates[1].day)
-    for i, df in enumerate(forecast(groups, dates, remaining)[0]):
+    for i, df in enumerate(spend[:remaining]):
         pm.update(dates[1] + timedelta(1 + i), df)
     d_forecast = pm.head()
     forecast_plt, = plt.plot(xs[dates[1].day - 1:mr[1]], d_forecast[dates[1].day - 1:], ls="-", marker="o", color="orange")
@@ -508,7 +540,7 @@ def graph_xy_progressive_mean(months, dailies, m_income, groups, dates):
     mean_spend = sum(v[-1] for v in tvs) / len(tvs)
     mean_plt, = plt.plot(xs, [ mean_spend ] * days_per_month)
     mean_plt.set_label("Typical daily spend")
-    mean_income = np.mean([m_income[m] for m in months[:-1]])
+    mean_income = np.mean(m_income[:-1])
     max_plt, = plt.plot(xs, [ -1 * mean_income / days_per_month ] * days_per_month)
     max_plt.set_label("Maximum daily spend");
     plt.legend(loc="lower right")
@@ -518,84 +550,117 @@ def graph_xy_progressive_mean(months, dailies, m_income, groups, dates):
     plt.xlim([min(xs) - 1, max(xs) + 1])
     plt.show()
 
+def lazy(f):
+    """Decorate a method as a property computed on first access and memoised
+    on the instance"""
+    key = "_" + f.__name__
+    def get(self):
+        if key not in self.__dict__:
+            self.__dict__[key] = f(self)
+        return self.__dict__[key]
+    return property(get, doc=f.__doc__)
+
+class Analysis(object):
+    """The data graphed by visualise(), computed on demand
+
+    Each property is computed the first time it is needed, pulling in only the
+    properties it depends on, and is then shared by every graph of the run.
+    """
+    def __init__(self, table, current_date=False):
+        self.table = table
+        self.current_date = current_date
+
+    @lazy
+    def monthly(self):
+        return PeriodMatrix(self.table, self.table.months())
+
+    @lazy
+    def months(self):
+        """The sorted months covered by the table, in month_fmt"""
+        return month_labels(self.monthly.periods)
+
+    @lazy
+    def weekly(self):
+        return PeriodMatrix(self.table, self.table.weeks())
+
+    @lazy
+    def daily(self):
+        return PeriodMatrix(self.table, self.table.ordinals())
+
+    @lazy
+    def description_groups(self):
+        t = self.table
+        return cdesc(t.filter(t.annotated() & ~t.category("Internal")))
+
+    @lazy
+    def span(self):
+        """The dates of the first and most recent transactions"""
+        ordinals = self.table.ordinals()
+        return [ datetime.fromordinal(int(ordinals.min())),
+                datetime.fromordinal(int(ordinals.max())) ]
+
+    @lazy
+    def last_transaction(self):
+        return datetime.today() if self.current_date else self.span[1]
+
+    @lazy
+    def remaining(self):
+        return days_remaining(self.last_transaction)
+
+    @lazy
+    def forecast(self):
+        """Forecast expenditure and income over the cashflow graph's span,
+        which covers the remainder of any month"""
+        return forecast(self.description_groups, self.span, cashflow_days)
+
+# Graphs in the order they are drawn, with the scipy facilities they need:
+# "fit" for polyfit() and polyval(), "stats" for scipy.stats
+_graphs = [
+    ("stacked_bar_expenses", None, lambda a, save:
+        graph_stacked_bar_expenses(a.months, a.monthly, a.remaining)),
+    ("bar_margin", None, lambda a, save:
+        graph_bar_margin(a.months, a.monthly, a.remaining, save)),
+    ("box_categories", None, lambda a, save:
+        graph_box_categories(a.months, a.monthly)),
+    ("xy_categories", "fit", lambda a, save:
+        graph_xy_categories(a.months, a.monthly, a.remaining)),
+    ("xy_weekly", "fit", lambda a, save:
+        graph_xy_weekly(a.weekly)),
+    ("bar_targets", "stats", lambda a, save:
+        graph_bar_targets(a.months, a.monthly, a.remaining, save)),
+    ("xy_progressive_mean", None, lambda a, save:
+        graph_xy_progressive_mean(a.months, a.daily, a.monthly.income(),
+            a.forecast[0], a.span)),
+    ("bar_cashflow", None, lambda a, save:
+        graph_bar_cashflow(a.description_groups, a.span, a.forecast)),
+    ("periodic_expenses", None, lambda a, save:
+        print_periodic_expenses(a.description_groups, a.last_transaction)),
+]
+
 def visualise(table, current_date=False, graph=None, save=0):
     from .core import global_module, global_symbol
-    global_symbol(globals(), "scipy", "polyfit")
-    global_symbol(globals(), "scipy", "polyval")
-    global_module(globals(), "scipy.stats", name="stats")
     global_module(globals(), "matplotlib.pyplot", name="plt")
-    global_module(globals(), "numpy", name="np")
-
-    # Core data, used across multiple plots
-    period_grouper = PeriodGroup(extract_month, extract_week, extract_day)
-    for row in table:
-        period_grouper.add(row)
-    m_grouped, w_grouped, d_grouped = period_grouper.groups()
-    description_groups = cdesc(row for row in table
-            if len(row) >= 4 and not row[3] == "Internal")
-
-    # m_summed: Looks like:
-    #
-    #  { "04/2013" : { "Cash" : -882.50, ... }, ... }
-    m_summed = dict((m, sum_categories(v)) for m, v in m_grouped.items())
-
-    # expenses: Looks like m_summed, but without blacklisted keys
-    expenses = ignore(m_summed, *blacklist)
-
-    # months: A list, containing the sorted set of months from expenses
-    months = sorted(expenses, key=monthsort)
-
-    # categorized: Looks like:
-    #
-    #  { "Cash" : { "04/2013" : -882.50, ... }, ... }
-    categorized = invert(expenses, whitelist)
-
-    # monthlies: Looks like:
-    #
-    # [
-    #   [ -882.50, ... ], # Cash expenses per month
-    #   [ -832.82, ... ], # Commitment expenses per month
-    #   ...
-    # ]
-    monthlies = category_sum_matrix(categorized)
-
-    # m_income: Looks like summed, but contains only income
-    m_income = income(m_summed)
-
-
-    # Grab the date of the most recent transaction in the database
-    first_transaction = datetime.strptime(m_grouped[months[0]][0][0], date_fmt)
-    last_transaction = datetime.strptime(m_grouped[months[-1]][-1][0], date_fmt)
-    span = [first_transaction, last_transaction]
-    if current_date:
-        last_transaction = datetime.today()
-    remaining = days_remaining(last_transaction)
-
-    if (should_graph(graph, "stacked_bar_expenses")):
-        graph_stacked_bar_expenses(months, monthlies, expenses, m_income, remaining)
-    if (should_graph(graph, "bar_margin")):
-        graph_bar_margin(months, m_income, expenses, remaining, save)
-    if (should_graph(graph, "box_categories")):
-        graph_box_categories(months, categorized)
-    if (should_graph(graph, "xy_categories")):
-        graph_xy_categories(months, categorized, remaining)
-    if (should_graph(graph, "xy_weekly")):
-        graph_xy_weekly(w_grouped)
-    if (should_graph(graph, "bar_targets")):
-        graph_bar_targets(months, monthlies, expenses, m_income, remaining, save)
-    if (should_graph(graph, "xy_progressive_mean")):
-        graph_xy_progressive_mean(months, d_grouped, m_income, description_groups, span)
-    if (should_graph(graph, "bar_cashflow")):
-        graph_bar_cashflow(description_groups, span)
-    if (should_graph(graph, "periodic_expenses")):
-        print_periodic_expenses(description_groups, last_transaction)
+    drawn = [ g for g in _graphs if should_graph(graph, g[0]) ]
+    needs = set(g[1] for g in drawn)
+    if "fit" in needs:
+        global_symbol(globals(), "scipy", "polyfit")
+        global_symbol(globals(), "scipy", "polyval")
+    if "stats" in needs:
+        global_module(globals(), "scipy.stats", name="stats")
+
+    if not isinstance(table, TransactionTable):
+        table = TransactionTable.from_rows(table)
+    analysis = Analysis(table, current_date)
+    for _, _, draw in drawn:
+        draw(analysis, save)
     plt.show()
 
 def main(args=None):
     if args is None:
         args = parse_args()
 
-    visualise(list(csv.reader(args.database)), args.current_date, args.graph, args.save)
+    table = TransactionTable.from_rows(csv.reader(args.database))
+    visualise(table, args.current_date, args.graph, args.save)
 
 
 if __name__ == "__main__":
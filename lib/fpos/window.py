@@ -20,7 +20,9 @@ import argparse
 import csv
 from datetime import datetime as dt
 from collections import defaultdict, deque
+import numpy as np
 from .core import date_fmt, month_fmt
+from .core import date_datetime, date_month, month_ordinal
 
 cmd_description = \
         """Outputs an IR document containing only transactions inside a
@@ -57,13 +59,15 @@ def gen_span_oracle(start, end):
     if None is start and None is end:
         return o_true
     if None is not start:
-        oracle["start"] = lambda x: x >= dt.strptime(start, month_fmt)
+        lower = dt.strptime(start, month_fmt)
+        oracle["start"] = lambda x: x >= lower
     if None is not end:
-        oracle["end"] = lambda x: x < dt.strptime(end, month_fmt)
+        upper = dt.strptime(end, month_fmt)
+        oracle["end"] = lambda x: x < upper
     return lambda x: oracle["start"](x) and oracle["end"](x)
 
 def day2month(datestr):
-    return dt.strftime(dt.strptime(datestr, date_fmt), month_fmt)
+    return date_month(datestr)
 
 def window(source, start=None, end=None, relspan=None):
     if relspan and not (start or end):
@@ -72,9 +76,8 @@ def window(source, start=None, end=None, relspan=None):
             for row in source:
                 months[day2month(row[0])].append(row)
             dq = deque([], relspan)
-            for k in sorted(dt.strptime(dstr, month_fmt)
-                    for dstr in months.keys()):
-                dq.append(months[dt.strftime(k, month_fmt)])
+            for k in sorted(months.keys(), key=month_ordinal):
+                dq.append(months[k])
             for m in dq:
                 for e in m:
                     yield e
@@ -82,10 +85,27 @@ def window(source, start=None, end=None, relspan=None):
     in_span = gen_span_oracle(start, end)
     def _gen_se():
         for e in source:
-            if in_span(dt.strptime(e[0], date_fmt)):
+            if in_span(date_datetime(e[0])):
                 yield e
     return _gen_se()
 
+def window_table(table, start=None, end=None, relspan=None):
+    """Window a TransactionTable as window() does a sequence of rows"""
+    months = table.months()
+    if relspan and not (start or end):
+        if not len(table):
+            return table
+        mask = months >= np.unique(months)[-relspan:][0]
+        # Rows are emitted month by month, in source order within each month
+        order = np.argsort(months[mask], kind="stable")
+        return table.filter(mask).take(order)
+    mask = np.ones(len(table), dtype=bool)
+    if None is not start:
+        mask &= table.day >= np.datetime64(dt.strptime(start, month_fmt), "D")
+    if None is not end:
+        mask &= table.day < np.datetime64(dt.strptime(end, month_fmt), "D")
+    return table.filter(mask)
+
 def main(args=None):
     if args is None:
         args = parse_args()
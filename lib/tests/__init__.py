@@ -18,10 +18,17 @@
 
 import matplotlib
 matplotlib.use('Agg')
+import argparse
+import contextlib
 from datetime import datetime as dt
+import io
 from itertools import islice, cycle
+import pickle
+import threading
 import unittest
 from fpos import annotate, combine, core, transform, visualise, window, predict
+from fpos import bench
+import pystrgrp
 
 money = visualise.money
 
@@ -168,6 +175,49 @@ class TransformTest(unittest.TestCase):
     def test__sense_form_woolworths_credit(self):
         self.assertEquals("woolworths", transform._sense_form("01 Mar 2016,Avogadros number - space -,,60221409,NaN,Financial,BPAY Payments,".split(',')))
 
+    def test__is_date_dmy_bank(self):
+        self.assertTrue(transform._is_date("20 Mar 2016"))
+
+    def test__is_date_fallback(self):
+        self.assertTrue(transform._is_date("2014-01-31"))
+
+    def test__is_date_impossible_bank(self):
+        self.assertFalse(transform._is_date("31/02/2024"))
+        self.assertFalse(transform._is_date("29/02/2023"))
+        self.assertFalse(transform._is_date("31-Apr-14"))
+        self.assertFalse(transform._is_date("31 Jun 2016"))
+        self.assertTrue(transform._is_date("29/02/2024"))
+        self.assertEquals(transform._STRING,
+                transform._compute_cell_type("31/02/2024"))
+
+    def test__compute_type_tuple_cells(self):
+        cells = {}
+        rows = [ [ "2014-01-31", "-1.0", "WOOLWORTHS 5518", "1.0" ],
+                [ "2014-02-28", "-2.0", "WOOLWORTHS 5518", "2.0" ],
+                [ "01/01/2014", "-1.0", "2024 13", "1.0" ],
+                [ "01/01/2014", "-1.0", "2024 12", "1.0" ],
+                [ "31/02/2024", "-1.0", "WOOLWORTHS 5518", "1.0" ] ]
+        for row in rows:
+            self.assertEquals(transform._compute_type_tuple(row),
+                    transform._compute_type_tuple(row, cells))
+        # dateutil's answer depends on the digits, so cells differing only
+        # in their digits are typed separately
+        self.assertNotEqual(cells["2024 13"], cells["2024 12"])
+        self.assertEquals(6, len(cells))
+
+    def test__sense_rows_majority(self):
+        rows = [ [ "Date", "Amount", "Description", "Balance" ],
+                [ "01/01/2014", "-1.0", "description", "-1.0" ],
+                [ "01/01/2014", "-1.0", "description" ],
+                [ "02/01/2014", "-1.0", "description", "-2.0" ] ]
+        self.assertEquals("commbank", transform._sense_rows(rows))
+        self.assertRaises(KeyError, transform._sense_rows, rows[:1])
+
+    def test_transform_auto(self):
+        commbank = [ [ "01/01/2014", "1.0", "Positive", "1.0" ],
+                [ "01/01/2014", "-1.0", "Negative", "0.0" ] ]
+        self.assertEquals(self.expected, list(transform.transform("auto", commbank)))
+
 class WindowTest(unittest.TestCase):
     def test_gen_span_oracle_date_in_default(self):
         d = dt.strptime("01/01/2014", window.date_fmt)
@@ -226,6 +276,23 @@ class WindowTest(unittest.TestCase):
         expected = ir[1:]
         self.assertEquals(expected, list(window.window(ir, relspan=2)))
 
+    def test_table_bounded_start_bounded_end(self):
+        ir =  [ [ "31/12/2013", "-1.00", "Description" ],
+                [ "31/01/2014", "-1.00", "Description" ],
+                [ "01/02/2014", "-1.00", "Description" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        expected = [ ir[1] ]
+        self.assertEquals(expected,
+                window.window_table(table, "01/2014", "02/2014").to_rows())
+
+    def test_table_span_2(self):
+        ir =  [ [ "01/02/2014", "-1.00", "Description" ],
+                [ "31/12/2013", "-1.00", "Description" ],
+                [ "31/01/2014", "-1.00", "Description" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        expected = list(window.window(ir, relspan=2))
+        self.assertEquals(expected, window.window_table(table, relspan=2).to_rows())
+
 class VisualiseTest(unittest.TestCase):
     def test_group_period_empty(self):
         pg = visualise.PeriodGroup()
@@ -280,6 +347,55 @@ class VisualiseTest(unittest.TestCase):
         data = [ [ "01/01/2014", money(spent), "Foo", cat ] ] * 2
         self.assertEquals(len(data) * spent, visualise.sum_categories(data)[cat])
 
+    def test_sum_categories_transactions_exact(self):
+        cat = visualise.whitelist[0]
+        data = [ core.Transaction.from_row([ "01/01/2014", "0.10", "Foo", cat ]) ] * 3
+        self.assertEquals(0.30, visualise.sum_categories(data)[cat])
+
+    def test_period_matrix_months(self):
+        ir = [ [ "01/01/2014", "-1.00", "Foo", "Cash" ],
+                [ "09/01/2014", "-2.50", "Bar", "Cash" ],
+                [ "01/02/2014", "10.00", "Baz", "Income" ],
+                [ "02/02/2014", "-4.00", "Foo", "Internal" ],
+                [ "03/02/2014", "-8.00", "Foo" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        pm = visualise.PeriodMatrix(table, table.months())
+        self.assertEquals([ "01/2014", "02/2014" ], visualise.month_labels(pm.periods))
+        self.assertEquals([ -3.50, 0 ], pm.column("Cash").tolist())
+        self.assertEquals([ 0, 10.00 ], pm.income().tolist())
+        self.assertEquals([ -3.50, 0 ], pm.expenses().sum(axis=1).tolist())
+
+    def test_period_matrix_matches_sum_categories(self):
+        ir = [ [ "01/01/2014", "-1.10", "Foo", "Cash" ],
+                [ "04/01/2014", "-2.20", "Bar", "Dining" ],
+                [ "05/01/2014", "3.30", "Baz", "Income" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        pm = visualise.PeriodMatrix(table, table.weeks())
+        expected = visualise.PeriodGroup(visualise.extract_week)
+        expected.add_all(ir)
+        weeks = expected.groups()[0]
+        self.assertEquals(len(weeks), len(pm))
+        for row, week in zip(pm.sums, sorted(weeks)):
+            summed = visualise.sum_categories(weeks[week])
+            self.assertEquals([ summed[c] for c in core.categories ], row.tolist())
+
+    def test_analysis_lazy(self):
+        ir = [ [ "01/01/2014", "-1.00", "Foo", "Cash" ],
+                [ "09/02/2014", "-2.00", "Bar", "Cash" ] ]
+        analysis = visualise.Analysis(core.TransactionTable.from_rows(ir))
+        self.assertEquals([ "01/2014", "02/2014" ], analysis.months)
+        self.assertTrue("_monthly" in analysis.__dict__)
+        self.assertFalse("_description_groups" in analysis.__dict__)
+        self.assertFalse("_weekly" in analysis.__dict__)
+        self.assertTrue(analysis.monthly is analysis.monthly)
+
+    def test_analysis_span(self):
+        ir = [ [ "09/02/2014", "-2.00", "Bar", "Cash" ],
+                [ "01/01/2014", "-1.00", "Foo", "Cash" ] ]
+        analysis = visualise.Analysis(core.TransactionTable.from_rows(ir))
+        self.assertEquals([ dt(2014, 1, 1), dt(2014, 2, 9) ], analysis.span)
+        self.assertEquals(20, analysis.remaining)
+
     def test_income_only_two_months(self):
         month = [ "01/2014", "02/2014" ]
         amount = 1.00
@@ -414,7 +530,112 @@ class CombineTest(unittest.TestCase):
         expected = [ sources[0][0], sources[1][0] ]
         self.assertEquals(expected, list(combine.combine(sources)))
 
+class BenchTest(unittest.TestCase):
+    def test_bench(self):
+        descriptions = [ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+                "WOOLWORTHS 5519 TORRENSVILLE" ]
+        results = list(bench.bench(descriptions, [ 2, 3 ], [ 0.85 ], 2))
+        self.assertEquals(2, len(results))
+        times, row = results[1]
+        self.assertEquals(2, len(times))
+        self.assertEquals(len(bench.columns), len(row))
+        self.assertEquals([ 0.85, 3, 2 ], row[:3])
+        # The second WOOLWORTHS description is the only one to be LCS scored
+        self.assertEquals(1, row[-1])
+        results = list(bench.bench(descriptions, [ 3 ], [ 0.85 ], 1,
+                metrics=[ "nlcs", "jaccard" ]))
+        self.assertEquals([ "nlcs", 1.0, 1.0 ], results[0][1][3:6])
+        # Jaccard splits the WOOLWORTHS descriptions on their store numbers
+        self.assertEquals([ 3, "jaccard", 1.0, 0.0 ], results[1][1][2:6])
+
 class CoreTest(unittest.TestCase):
+    def test_date_codec(self):
+        self.assertEquals(dt(2014, 1, 31), core.date_datetime("31/01/2014"))
+        self.assertEquals(1, core.date_ordinal("01/02/2014") -
+                core.date_ordinal("31/01/2014"))
+        self.assertEquals("01/2014", core.date_month("31/01/2014"))
+        self.assertEquals("2014:04", core.date_week("31/01/2014"))
+        self.assertEquals(core.date_ordinal("01/02/2014"),
+                core.month_ordinal("02/2014"))
+        self.assertEquals("28/04/2014", core.to_ir_date("28-Apr-14", "%d-%b-%y"))
+        self.assertRaises(ValueError, core.date_ordinal, "31/02/2014")
+
+    def test_money_cents(self):
+        self.assertEquals(-123, core.to_cents("-1.23"))
+        self.assertEquals(29, core.to_cents(0.29))
+        self.assertEquals("-1.23", core.money_cents(-123))
+        self.assertEquals("-0.05", core.money_cents(-5))
+        self.assertEquals("10.00", core.money_cents(1000))
+
+    def test_transaction(self):
+        row = [ "31/01/2014", "-1.50", "foo", "Dining" ]
+        t = core.Transaction.from_row(row)
+        self.assertEquals(core.date_ordinal("31/01/2014"), t.day)
+        self.assertEquals(-150, t.cents)
+        self.assertEquals("Dining", t.category)
+        self.assertEquals(row, t.to_row())
+        self.assertEquals(row, list(t))
+        self.assertEquals(4, len(t))
+        self.assertEquals("foo", t[-2])
+        self.assertEquals(t, core.Transaction.from_row(row))
+
+    def test_transaction_unannotated(self):
+        t = core.Transaction.from_row([ "31/01/2014", "2", "foo" ])
+        self.assertEquals(None, t.category)
+        self.assertEquals(3, len(t))
+        self.assertEquals([ "31/01/2014", "2.00", "foo" ], t.to_row())
+
+    def test_transaction_table_round_trip(self):
+        ir = [ [ "31/01/2014", "-1.50", "Foo", "Dining" ],
+                [ "01/01/2014", "2.00", "Bar" ],
+                [],
+                [ "01/01/2014", "-3.00", "Foo", "Cash" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        self.assertEquals(3, len(table))
+        self.assertEquals([ "Foo", "Bar" ], table.descriptions)
+        self.assertEquals([ r for r in ir if r ], table.to_rows())
+        self.assertEquals(list(core.transactions(ir)), list(table))
+
+    def test_transaction_table_filter_sort(self):
+        ir = [ [ "31/01/2014", "-1.50", "Foo", "Dining" ],
+                [ "01/01/2014", "2.00", "Bar" ],
+                [ "01/01/2014", "2.00", "Baz", "Income" ],
+                [ "01/01/2014", "-3.00", "Foo", "Cash" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        self.assertEquals([ ir[3], ir[1], ir[2], ir[0] ], table.sort().to_rows())
+        self.assertEquals([ ir[0], ir[2], ir[3] ],
+                table.filter(table.annotated()).to_rows())
+        self.assertEquals([ ir[2] ], table.filter(table.category("Income")).to_rows())
+        self.assertEquals([], table.filter(table.category("Unknown")).to_rows())
+
+    def test_transaction_table_unknown_categories(self):
+        ir = [ [ "31/01/2014", "-1.50", "Foo", "Groceries" ],
+                [ "01/01/2014", "2.00", "Bar", "Income" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        self.assertEquals(ir, table.to_rows())
+        self.assertEquals([ ir[0] ],
+                table.filter(table.category("Groceries")).to_rows())
+        self.assertEquals(core.categories + [ "Groceries" ], table.categories)
+        # Unknown names are coded per table, not registered globally
+        other = core.TransactionTable.from_rows([ ir[1] ])
+        self.assertEquals(core.categories, other.categories)
+        many = [ [ "01/01/2014", "1.00", "Foo", "C{}".format(i) ]
+                for i in range(32768 - len(core.categories)) ]
+        self.assertEquals(32768, len(core.TransactionTable.from_rows(many).categories))
+        many.append([ "01/01/2014", "1.00", "Foo", "Overflow" ])
+        self.assertRaises(ValueError, core.TransactionTable.from_rows, many)
+
+    def test_transaction_table_group_by(self):
+        ir = [ [ "31/01/2014", "-1.50", "Foo" ],
+                [ "01/02/2014", "2.00", "Bar" ],
+                [ "01/01/2014", "-3.00", "Foo" ] ]
+        table = core.TransactionTable.from_rows(ir)
+        keys, inverse = table.group_by(table.months())
+        self.assertEquals([ "2014-01", "2014-02" ], [ str(k) for k in keys ])
+        self.assertEquals([ 0, 1, 0 ], inverse.tolist())
+        keys, sums = table.sum_by(table.months())
+        self.assertEquals([ -450, 200 ], sums.tolist())
+
     def test_lcs_empty(self):
         self.assertEquals(0, core.lcs("", ""))
 
@@ -446,6 +667,16 @@ class CoreTest(unittest.TestCase):
         self.assertEquals(1, core.lcs("abbb", "aaaa"))
 
 class PredictTest(unittest.TestCase):
+    def test_main_no_annotated(self):
+        infile = io.StringIO("01/01/2015,-1.00,FOO\n"
+                "02/01/2015,-1.00,BAR,Internal\n")
+        infile.name = "unannotated.csv"
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            with self.assertRaises(SystemExit) as cm:
+                predict.main(argparse.Namespace(infile=infile))
+        self.assertEquals(1, cm.exception.code)
+        self.assertIn("unannotated.csv", out.getvalue())
+
     def test_group_deltas_empty(self):
         data = []
         expected = []
@@ -644,3 +875,436 @@ class PredictTest(unittest.TestCase):
 
     def test_bottoms_two(self):
         self.assertSequenceEqual([ 0, -10 ], predict.bottoms([ -10, -20 ]))
+
+class StrgrpTest(unittest.TestCase):
+    def test_add_similar(self):
+        grouper = pystrgrp.Strgrp()
+        first = grouper.add("WOOLWORTHS 5518 TORRENSVILLE", 1)
+        second = grouper.add("WOOLWORTHS 5519 TORRENSVILLE", 2)
+        self.assertEquals(first.key(), second.key())
+        self.assertEquals(1, len(list(grouper)))
+
+    def test_add_different(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add("WOOLWORTHS 5518 TORRENSVILLE", 1)
+        grouper.add("CALTRAIN TVM SAN CARLOS", 2)
+        self.assertEquals(2, len(list(grouper)))
+
+    def test_grp_for_long_keys(self):
+        # Keys longer than 64 characters take the multi-word LCS path
+        base = "VISA DEBIT PURCHASE CARD CATHRYN ISAAC WESLEY HOHN CLARISSA ADELAIDE"
+        self.assertTrue(len(base) > 64)
+        grouper = pystrgrp.Strgrp()
+        grouper.add(base + " [72307398]", 1)
+        grp = grouper.grp_for(base + " [12345678]")
+        self.assertIsNotNone(grp)
+        self.assertEquals([ 1 ], [ x.value() for x in grp ])
+
+    def test_grp_for_none(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add("WOOLWORTHS 5518 TORRENSVILLE", 1)
+        self.assertIsNone(grouper.grp_for("CALTRAIN TVM SAN CARLOS"))
+
+    def test_threshold_zero_single_group(self):
+        grouper = pystrgrp.Strgrp(0.0)
+        for i, key in enumerate([ "A", "", "WOOLWORTHS", "CALTRAIN TVM SAN CARLOS" ]):
+            grouper.add(key, i)
+        self.assertEquals(1, len(list(grouper)))
+
+    def test_threshold_one_identical_only(self):
+        grouper = pystrgrp.Strgrp(1.0)
+        for i, key in enumerate([ "AB", "BA", "AB", "ABC" ]):
+            grouper.add(key, i)
+        self.assertEquals([ [ 0, 2 ], [ 1 ], [ 3 ] ],
+                [ [ x.value() for x in g ] for g in grouper ])
+
+    def test_add_many(self):
+        grouper = pystrgrp.Strgrp()
+        keys = [ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+                "WOOLWORTHS 5519 TORRENSVILLE" ]
+        grps = grouper.add_many(keys, [ 0, 1, 2 ])
+        self.assertEquals(3, len(grps))
+        self.assertEquals(grps[0].key(), grps[2].key())
+        self.assertEquals([ [ 0, 2 ], [ 1 ] ],
+                [ [ x.value() for x in g ] for g in grouper ])
+
+    def test_build(self):
+        keys = [ "MERCHANT {} STORE {}".format(i * 7919 % 400, i % 13)
+                for i in range(1000) ]
+        serial = pystrgrp.Strgrp()
+        for i, k in enumerate(keys):
+            serial.add(k, i)
+        for threads in [ 1, 4 ]:
+            built = pystrgrp.Strgrp.build(keys, range(len(keys)),
+                    threads=threads)
+            self.assertEquals(threads, built.threads())
+            self.assertEquals(serial.export(), built.export())
+            self.assertEquals(serial.stats()["n_lookups"],
+                    built.stats()["n_lookups"])
+        approx = pystrgrp.Strgrp(bands=8, rows=4)
+        for i, k in enumerate(keys):
+            approx.add(k, i)
+        built = pystrgrp.Strgrp.build(keys, range(len(keys)), bands=8, rows=4,
+                threads=4)
+        self.assertEquals(approx.export(), built.export())
+        self.assertRaises(TypeError, pystrgrp.Strgrp.build, keys)
+
+    def test_export(self):
+        grouper = pystrgrp.Strgrp()
+        keys = [ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+                "WOOLWORTHS 5519 TORRENSVILLE" ]
+        grouper.add_many(keys, [ 0, 1, 2 ])
+        self.assertEquals(([ keys[0], keys[1] ], [ keys[0], keys[2], keys[1] ],
+                [ 0, 2, 1 ], [ 0, 2, 3 ]), grouper.export())
+        self.assertEquals([ [ keys[0], keys[2] ], [ keys[1] ] ],
+                [ g.keys() for g in grouper ])
+        self.assertEquals([ [ 0, 2 ], [ 1 ] ], [ g.values() for g in grouper ])
+        self.assertEquals(([], [], [], [ 0 ]), pystrgrp.Strgrp().export())
+
+    def test_stats(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add_many([ "WOOLWORTHS 5518 TORRENSVILLE",
+            "CALTRAIN TVM SAN CARLOS", "WOOLWORTHS 5519 TORRENSVILLE" ],
+            [ 0, 1, 2 ])
+        grouper.grp_for("CALTRAIN TVM SAN CARLOS")
+        stats = grouper.stats()
+        self.assertEquals(2, stats["n_groups"])
+        self.assertEquals(3, stats["n_items"])
+        self.assertEquals(4, stats["n_lookups"])
+        self.assertEquals(1, stats["n_cache_hits"])
+        self.assertEquals(3, stats["n_cache_misses"])
+        self.assertEquals(stats["n_cands"], stats["n_len_rejected"] +
+                stats["n_cos_rejected"] + stats["n_lcs"])
+        self.assertTrue(stats["n_lcs"] >= 1)
+        self.assertTrue(stats["t_lookup"] >= stats["t_select"] + stats["t_score"])
+        grouper.reset_stats()
+        grouper.remove("CALTRAIN TVM SAN CARLOS", 1)
+        stats = grouper.stats()
+        self.assertEquals(0, stats["n_lookups"])
+        self.assertEquals(0.0, stats["t_lookup"])
+        self.assertEquals([ 1, 2 ], [ stats["n_groups"], stats["n_items"] ])
+
+    def test_threads(self):
+        self.assertEquals(0, pystrgrp.Strgrp().threads())
+        self.assertRaises(ValueError, pystrgrp.Strgrp, 0.85, -1)
+        keys = [ "MERCHANT {} STORE {}".format(i * 7919 % 1000, i % 13)
+                for i in range(1000) ]
+        serial = pystrgrp.Strgrp(threads=1)
+        parallel = pystrgrp.Strgrp(threads=4)
+        self.assertEquals(4, parallel.threads())
+        serial.add_many(keys, keys)
+        parallel.add_many(keys, keys)
+        self.assertEquals(serial.export(), parallel.export())
+        parallel.set_threads(0)
+        self.assertEquals(0, parallel.threads())
+        self.assertRaises(ValueError, parallel.set_threads, -1)
+
+    def test_concurrent_lookups(self):
+        keys = [ "MERCHANT {} STORE {}".format(i * 7919 % 1000, i % 13)
+                for i in range(600) ]
+        grouper = pystrgrp.Strgrp()
+        grouper.add_many(keys[:300], keys[:300])
+        expected = [ grouper.grp_for(k).key() for k in keys[:300] ]
+        grouper.reset_stats()
+        found = [ [] for i in range(4) ]
+        def lookup(i):
+            for k in keys[:300]:
+                found[i].append(grouper.grp_for(k).key())
+        def add():
+            for k in keys[300:]:
+                grouper.add(k, k)
+        threads = [ threading.Thread(target=lookup, args=(i,))
+                for i in range(len(found)) ]
+        threads.append(threading.Thread(target=add))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals([ expected ] * len(found), found)
+        stats = grouper.stats()
+        self.assertEquals(300 * len(found) + 300, stats["n_lookups"])
+        self.assertEquals(600, stats["n_items"])
+
+    def test_remove(self):
+        grouper = pystrgrp.Strgrp()
+        keys = [ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+                "WOOLWORTHS 5519 TORRENSVILLE", "WOOLWORTHS 5518 TORRENSVILLE" ]
+        grouper.add_many(keys, [ 0, 1, 2, 3 ])
+        grouper.remove(keys[0], 3)
+        self.assertEquals([ [ 0, 2 ], [ 1 ] ], [ g.values() for g in grouper ])
+        grouper.remove(keys[1], 1)
+        self.assertEquals([ [ 0, 2 ] ], [ g.values() for g in grouper ])
+        self.assertIsNone(grouper.grp_for(keys[1]))
+        grouper.remove(keys[0], 0)
+        grouper.remove(keys[2], 2)
+        self.assertEquals([], list(grouper))
+        self.assertIsNone(grouper.grp_for(keys[0]))
+        grouper.add(keys[1], 4)
+        self.assertEquals([ [ 4 ] ], [ g.values() for g in grouper ])
+        self.assertEquals([ [ 4 ] ], [ g.values()
+                for g in pickle.loads(pickle.dumps(grouper)) ])
+
+    def test_remove_missing(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add("WOOLWORTHS 5518 TORRENSVILLE", 0)
+        item = next(iter(grouper.grp_for("WOOLWORTHS 5518 TORRENSVILLE")))
+        with self.assertRaises(ValueError):
+            grouper.remove("WOOLWORTHS 5518 TORRENSVILLE", 1)
+        with self.assertRaises(ValueError):
+            grouper.remove("WOOLWORTHS 5519 TORRENSVILLE", 0)
+        grouper.remove("WOOLWORTHS 5518 TORRENSVILLE", 0)
+        self.assertIsNone(item.value())
+
+    def test_rekey(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add_many([ "WOOLWORTHS 5518 TORRENSVILLE",
+            "CALTRAIN TVM SAN CARLOS", "WOOLWORTHS 5519 TORRENSVILLE" ],
+            [ 0, 1, 2 ])
+        grp = grouper.rekey("WOOLWORTHS 5519 TORRENSVILLE", 2,
+                "CALTRAIN TVM SAN CARLOS")
+        self.assertEquals("CALTRAIN TVM SAN CARLOS", grp.key())
+        self.assertEquals([ [ 0 ], [ 1, 2 ] ], [ g.values() for g in grouper ])
+
+    def test_rekey_add_fails(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add_many([ "WOOLWORTHS 5518 TORRENSVILLE",
+            "CALTRAIN TVM SAN CARLOS", "WOOLWORTHS 5519 TORRENSVILLE" ],
+            [ 0, 1, 2 ])
+        try:
+            pystrgrp._fail_adds(1)
+            with self.assertRaises(MemoryError):
+                grouper.rekey("WOOLWORTHS 5519 TORRENSVILLE", 2,
+                        "CALTRAIN TVM SAN CARLOS")
+        finally:
+            pystrgrp._fail_adds(0)
+        # The value is back under its old key rather than lost
+        self.assertEquals([ [ 0, 2 ], [ 1 ] ], [ g.values() for g in grouper ])
+        self.assertEquals([ "WOOLWORTHS 5518 TORRENSVILLE",
+            "WOOLWORTHS 5519 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS" ],
+            [ x.key() for g in grouper for x in g ])
+        grp = grouper.rekey("WOOLWORTHS 5519 TORRENSVILLE", 2,
+                "CALTRAIN TVM SAN CARLOS")
+        self.assertEquals("CALTRAIN TVM SAN CARLOS", grp.key())
+
+    def test_remove_reentrant(self):
+        grouper = pystrgrp.Strgrp()
+        key = "WOOLWORTHS 5518 TORRENSVILLE"
+
+        class Lookup(object):
+            def __eq__(self, other):
+                grouper.grp_for(key)
+                return True
+
+        grouper.add(key, 0)
+        with self.assertRaises(RuntimeError):
+            grouper.remove(key, Lookup())
+        with self.assertRaises(RuntimeError):
+            grouper.rekey(key, Lookup(), "CALTRAIN TVM SAN CARLOS")
+        # The failed removals leave the clusters and the lock intact
+        self.assertEquals([ [ 0 ] ], [ g.values() for g in grouper ])
+        add = threading.Thread(target=grouper.add,
+                args=("CALTRAIN TVM SAN CARLOS", 1))
+        add.start()
+        add.join(5)
+        self.assertFalse(add.is_alive())
+        self.assertEquals([ [ 0 ], [ 1 ] ], [ g.values() for g in grouper ])
+
+    def test_add_many_length_mismatch(self):
+        grouper = pystrgrp.Strgrp()
+        with self.assertRaises(ValueError):
+            grouper.add_many([ "A", "B" ], [ 0 ])
+
+    def test_grp_for_many(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add("WOOLWORTHS 5518 TORRENSVILLE", 0)
+        grps = grouper.grp_for_many([ "WOOLWORTHS 5519 TORRENSVILLE",
+            "CALTRAIN TVM SAN CARLOS" ])
+        self.assertEquals("WOOLWORTHS 5518 TORRENSVILLE", grps[0].key())
+        self.assertIsNone(grps[1])
+
+    def test_save_load(self):
+        grouper = pystrgrp.Strgrp(0.9)
+        keys = [ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+                "WOOLWORTHS 5519 TORRENSVILLE" ]
+        grouper.add_many(keys, [ 0, 1, 2 ])
+        loaded = pystrgrp.load(grouper.save(), [ 0, 2, 1 ])
+        self.assertEquals([ [ 0, 2 ], [ 1 ] ],
+                [ [ x.value() for x in g ] for g in loaded ])
+        self.assertEquals(keys[0], loaded.grp_for("WOOLWORTHS 5520 TORRENSVILLE").key())
+        self.assertIsNone(loaded.grp_for("WOOLWORTHS"))
+
+    def test_load_invalid(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add("WOOLWORTHS 5518 TORRENSVILLE", 0)
+        data = grouper.save()
+        with self.assertRaises(ValueError):
+            pystrgrp.load(data, [])
+        with self.assertRaises(ValueError):
+            pystrgrp.load(data[:-1], [ 0 ])
+
+    def test_load_repeated_char(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add("AB", 0)
+        data = bytearray(grouper.save())
+        self.assertEquals(b"A\x01\x00B\x01\x00", bytes(data[35:41]))
+        data[38] = ord("A")
+        with self.assertRaises(ValueError):
+            pystrgrp.load(bytes(data), [ 0 ])
+
+    def test_lsh(self):
+        keys = [ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+                "WOOLWORTHS 5519 TORRENSVILLE", "CALTRAIN TVM SAN CARLO",
+                "AB", "AB" ]
+        exact = pystrgrp.Strgrp()
+        exact.add_many(keys, keys)
+        approx = pystrgrp.Strgrp(bands=32, rows=4)
+        approx.add_many(keys, keys)
+        self.assertEquals(exact.export(), approx.export())
+        loaded = pickle.loads(pickle.dumps(approx))
+        self.assertEquals(approx.export(), loaded.export())
+        self.assertEquals(keys[1], loaded.grp_for("CALTRAIN TVM SAN CARLOS 2").key())
+        self.assertRaises(ValueError, pystrgrp.Strgrp, bands=-1)
+        self.assertRaises(ValueError, pystrgrp.Strgrp, bands=1, rows=0)
+        self.assertRaises(ValueError, pystrgrp.Strgrp, bands=512, rows=4)
+
+    def test_normalise(self):
+        stop = [ "VISA DEBIT PURCHASE CARD", "EFTPOS", "\\" ]
+        grouper = pystrgrp.Strgrp(upper=True, collapse=True, stop=stop)
+        grouper.add("  EFTPOS Woolworths\t5518  \\ TORRENSVILLE ", 0)
+        grouper.add("VISA DEBIT PURCHASE CARD 1234 WOOLWORTHS 5518", 1)
+        keys = grouper.export()[1]
+        self.assertEquals([ "WOOLWORTHS 5518 TORRENSVILLE",
+            "1234 WOOLWORTHS 5518" ], keys)
+        self.assertEquals(keys[0],
+                grouper.grp_for("woolworths 5518 torrensville").key())
+        loaded = pickle.loads(pickle.dumps(grouper))
+        self.assertEquals(keys[0],
+                loaded.grp_for("EFTPOS WOOLWORTHS 5518 TORRENSVILLE").key())
+        loaded.remove("woolworths   5518 torrensville", 0)
+        self.assertEquals([ keys[1] ], loaded.export()[1])
+        plain = pystrgrp.Strgrp(stop=[ "AB", "BC" ])
+        plain.add("xABCx", 0)
+        self.assertEquals([ "x Cx" ], plain.export()[1])
+        self.assertRaises(ValueError, pystrgrp.Strgrp, stop=[ "" ])
+        self.assertRaises(TypeError, pystrgrp.Strgrp, stop=[ 1 ])
+
+    def test_normalise_stop_before_folding(self):
+        # Stop phrases match the raw key before its case is folded and its
+        # whitespace collapsed, as cdesc's sanitise() then split() and upper()
+        from fpos import cdesc
+        grouper = pystrgrp.Strgrp(upper=True, collapse=True,
+                stop=cdesc.stop_phrases)
+        descs = [ "eftpos woolworths 123", "EFTPOS woolworths 123",
+                "VISA  DEBIT PURCHASE CARD 1234 WOOLWORTHS",
+                "VISA DEBIT PURCHASE CARD 1234 WOOLWORTHS",
+                "visa debit purchase card 99 COLES", "EFTPOSEFTPOS\\X",
+                " \\ ", "EFTPOS", "café eftpos", "CAFÉ\xa0 X", "straße",
+                "eftpos\xa0x", "\u3000VISA DEBIT PURCHASE CARD über",
+                "A\x1cB" ]
+        expected = [ " ".join(cdesc.sanitise(d).split()).upper()
+                for d in descs ]
+        self.assertEquals([ "EFTPOS WOOLWORTHS 123", "WOOLWORTHS 123",
+            "VISA DEBIT PURCHASE CARD 1234 WOOLWORTHS", "1234 WOOLWORTHS",
+            "VISA DEBIT PURCHASE CARD 99 COLES", "X", "", "", "CAFÉ EFTPOS",
+            "CAFÉ X", "STRASSE", "EFTPOS X", "ÜBER", "A B" ], expected)
+        for d, e in zip(descs, expected):
+            grouper = pystrgrp.Strgrp(upper=True, collapse=True,
+                    stop=cdesc.stop_phrases)
+            grouper.add(d, 0)
+            self.assertEquals([ e ], grouper.export()[1])
+            loaded = pickle.loads(pickle.dumps(grouper))
+            self.assertEquals(e, loaded.grp_for(d).key())
+        grouper = pystrgrp.Strgrp(upper=True, collapse=True,
+                stop=cdesc.stop_phrases)
+        grouper.add_many(descs, descs)
+        self.assertEquals(sorted(expected),
+                sorted(grouper.export()[1]))
+        upper = pystrgrp.Strgrp(upper=True)
+        upper.add("straße\xa0x", 0)
+        self.assertEquals([ "straße\xa0x".upper() ], upper.export()[1])
+        plain = pystrgrp.Strgrp(collapse=True, stop=[ " " ])
+        plain.add("A  B", 0)
+        self.assertEquals([ "A B" ], plain.export()[1])
+
+    def test_metric(self):
+        keys = [ "WOOLWORTHS 5518 TORRENSVILLE", "TORRENSVILLE WOOLWORTHS 5518",
+                "WOOLWORTHS 5519 TORRENSVILLE", "AB", "AB " ]
+        expected = { "nlcs" : [ keys[0], keys[1], keys[0], "AB", "AB " ],
+                "jaccard" : [ keys[0], keys[0], keys[2], "AB", "AB" ],
+                "dice" : [ keys[0], keys[0], keys[0], "AB", "AB " ] }
+        for metric, grps in expected.items():
+            grouper = pystrgrp.Strgrp(metric=metric)
+            grouper.add_many(keys, keys)
+            self.assertEquals(metric, grouper.metric())
+            self.assertEquals(grps, [ grouper.grp_for(k).key() for k in keys ])
+            loaded = pickle.loads(pickle.dumps(grouper))
+            self.assertEquals(metric, loaded.metric())
+            self.assertEquals(grouper.export(), loaded.export())
+        self.assertEquals("nlcs", pystrgrp.Strgrp().metric())
+        self.assertRaises(ValueError, pystrgrp.Strgrp, metric="lcs")
+
+    def test_pickle(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add_many([ "A", "CALTRAIN TVM SAN CARLOS", "A" ],
+                [ [ 0 ], { 1 : 2 }, "x" ])
+        loaded = pickle.loads(pickle.dumps(grouper))
+        self.assertEquals([ [ "A", "A" ], [ "CALTRAIN TVM SAN CARLOS" ] ],
+                [ [ x.key() for x in g ] for g in loaded ])
+        self.assertEquals([ [ [ 0 ], "x" ], [ { 1 : 2 } ] ],
+                [ [ x.value() for x in g ] for g in loaded ])
+        grp = loaded.add("CALTRAIN TVM SAN CARLO", 3)
+        self.assertEquals("CALTRAIN TVM SAN CARLOS", grp.key())
+
+    def test_pickle_concurrent_add(self):
+        grouper = pystrgrp.Strgrp()
+        keys = [ "DESCRIPTION {}".format(i) for i in range(2000) ]
+        def add():
+            for k in keys:
+                grouper.add(k, k)
+        adder = threading.Thread(target=add)
+        adder.start()
+        while adder.is_alive():
+            loaded = pickle.loads(pickle.dumps(grouper))
+            self.assertEquals([ [ x.key() for x in g ] for g in loaded ],
+                    [ [ x.value() for x in g ] for g in loaded ])
+        adder.join()
+
+    def test_candidates(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add_many([ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+            "WOOLWORTHS METRO" ], [ 0, 1, 2 ])
+        cands = grouper.candidates("WOOLWORTHS 5519 TORRENSVILLE", 3)
+        self.assertEquals([ "WOOLWORTHS 5518 TORRENSVILLE" ],
+                [ g.key() for g, _ in cands ])
+        self.assertAlmostEqual(27 / 28, cands[0][1])
+        cands = grouper.candidates("WOOLWORTHS 5519 TORRENSVILLE", 3, 0.0)
+        self.assertEquals([ "WOOLWORTHS 5518 TORRENSVILLE", "WOOLWORTHS METRO",
+            "CALTRAIN TVM SAN CARLOS" ], [ g.key() for g, _ in cands ])
+        self.assertEquals(sorted([ s for _, s in cands ], reverse=True),
+                [ s for _, s in cands ])
+        self.assertEquals(2, len(grouper.candidates("WOOLWORTHS", 2, 0.0)))
+        self.assertEquals([], grouper.candidates("WOOLWORTHS", 0))
+
+    def test_candidates_huge_k(self):
+        grouper = pystrgrp.Strgrp()
+        keys = [ "DESCRIPTION {}".format(i) for i in range(3000) ]
+        grouper.add_many(keys, list(range(len(keys))))
+        n_groups = grouper.stats()["n_groups"]
+        cands = grouper.candidates("DESCRIPTION 1", 2**61, threshold=0.0)
+        self.assertEquals(n_groups, len(cands))
+        cands = grouper.candidates("DESCRIPTION 1", 2**63 - 1, threshold=0.0)
+        self.assertEquals(n_groups, len(cands))
+
+    def test_grp_for_many_threads(self):
+        grouper = pystrgrp.Strgrp()
+        keys = [ "WOOLWORTHS 5518 TORRENSVILLE", "CALTRAIN TVM SAN CARLOS",
+                "WOOLWORTHS METRO" ]
+        grouper.add_many(keys, [ 0, 1, 2 ])
+        queries = [ k + s for k in keys for s in [ "", " 1", " 23" ] ] * 10
+        expected = [ grouper.grp_for(q) for q in queries ]
+        expected = [ g.key() if g else None for g in expected ]
+        for threads in [ 1, 2, 4 ]:
+            found = grouper.grp_for_many(queries, threads)
+            self.assertEquals(expected, [ g.key() if g else None for g in found ])
+        with self.assertRaises(ValueError):
+            grouper.grp_for_many(queries, -1)